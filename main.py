@@ -1,43 +1,298 @@
 import argparse
 import os
 import time
-from src.utils import load_image_safe 
-from src.analyzer import ImageAnalyzer
-from src.prompt_mixer import PromptMixer
-from src.generator import ImageGenerator
+# ⚡ 启动加速: src.* 会间接引入 google.genai / PIL / pillow_heif 等重量级依赖，
+# 这里只导入标准库，业务模块在参数校验通过后才导入 (见 main)，
+# 因此 --help 和参数错误几乎是瞬时返回的。可用 test/bench_startup.py 回归检测。
 
-def main():
+def print_run_stats(analyzer):
+    """
+    打印各级缓存的命中情况
+    """
+    from src.utils import image_cache
+    from src.payload import payload_preparer
+    print(image_cache.report())
+    print(payload_preparer.report())
+    if analyzer.cache is not None:
+        print(analyzer.cache.report())
+    print(analyzer.prompt_cache.report())
+    if analyzer.batch_stats["requests"]:
+        print(analyzer.batch_report())
+    print(analyzer.gateway.report())
+
+def open_journal(args, registry):
+    """
+    批量模式 / resume 使用的任务日志 (settings.yaml -> journal)
+    """
+    from src.job_journal import JobJournal
+    settings = registry.settings.get("journal", {})
+    return JobJournal(args.journal or settings.get("path", ".cache/jobs.sqlite3"),
+                      lease_seconds=settings.get("lease_seconds", 900),
+                      max_attempts=settings.get("max_attempts", 3))
+
+def run_batch(args, analyzer, mixer, generator, journal=None):
+    """
+    批量目录模式：分析与绘图两个阶段重叠执行
+    """
+    from src.pipeline import BatchPipeline, list_input_images
+    image_paths = list_input_images(args.input_dir)
+    if not image_paths:
+        print(f"⚠️ 目录 '{args.input_dir}' 中没有可处理的图片。")
+        return []
+
+    print(f"📁 批量模式: 共 {len(image_paths)} 张图片\n")
+    pipeline = BatchPipeline(analyzer, mixer, generator, top_k=args.top_k,
+                             concurrency=args.concurrency, queue_size=args.queue_size,
+                             analysis_batch=args.analysis_batch,
+                             dedupe_threshold=args.dedupe, render_once=args.render_once, journal=journal)
+    photos = pipeline.run(image_paths)
+
+    generated = sum(1 for photo in photos for _, path, _ in photo["results"] if path)
+    planned = sum(len(photo["results"]) for photo in photos)
+    print(f"\n✨ === 批量完成! 共生成 {generated}/{planned} 张壁纸 ===")
+    for photo in photos:
+        for style_key, path, error in photo["results"]:
+            if not path:
+                print(f"   ✖ {os.path.basename(photo['input'])} / {style_key}: {error}")
+    pipeline.print_summary()
+    if journal is not None:
+        print(journal.report())
+    print_run_stats(analyzer)
+    return photos
+
+def run_resume(args, analyzer, mixer, generator, journal):
+    """
+    resume 命令：只完成任务日志里剩下的工作
+    1. 本机已退出进程留下的 running 任务放回队列，未达重试上限的失败任务重新排队
+    2. 登记过但还没分析的照片补做分析并写入任务
+    3. 多线程领取剩余任务绘制 (可同时在多个进程/机器上运行，共同消费同一个日志)
+    """
+    from src.pipeline import drain_journal
+    start_time = time.time()
+    released = journal.release_dead()
+    requeued = journal.requeue_failed()
+    print(f"📒 [Journal] 恢复: 回收中断任务 {released} 个 | 失败任务重新排队 {requeued} 个")
+    if args.input_dir:
+        # 顺带登记目录里新增的照片
+        from src.pipeline import list_input_images
+        journal.register_inputs(list_input_images(args.input_dir), args.top_k)
+    print(journal.report())
+
+    for path, top_k in journal.unanalyzed():
+        if not os.path.exists(path):
+            print(f"⚠️ [Journal] 跳过不存在的输入: {path}")
+            continue
+        analysis = analyzer.analyze_and_recommend(path, top_k=top_k)
+        if analysis.get('recommendations'):
+            journal.enqueue(path, analysis, top_k)
+
+    workers = args.concurrency or analyzer.registry.settings.get("journal", {}).get("workers", 4)
+    results = drain_journal(journal, generator, mixer, workers=workers)
+    generated = sum(1 for _, _, path, _ in results if path)
+    print(f"\n✨ === resume 完成! 本进程生成 {generated}/{len(results)} 张壁纸, 耗时 {time.time() - start_time:.2f}s ===")
+    for path, style_key, output, error in results:
+        if not output:
+            print(f"   ✖ {os.path.basename(path)} / {style_key}: {error}")
+    print(journal.report())
+    print_run_stats(analyzer)
+
+    photos = {}
+    for path, style_key, output, error in results:
+        photos.setdefault(path, []).append((style_key, output, error))
+    return [{"input": path, "description": "", "results": r} for path, r in photos.items()]
+
+def build_parser():
     # 1. 命令行参数设置
     parser = argparse.ArgumentParser(description="AI Wallpaper Agent (Google Powered)")
-    parser.add_argument("--input", required=True, help="输入图片路径 (支持 HEIC/JPG/PNG)")
+    parser.add_argument("command", nargs="?", choices=("run", "resume", "serve", "catalog"), default="run",
+                        help="run = 正常运行 (默认); resume = 只完成任务日志里剩下的批量任务; "
+                             "serve = 启动常驻 HTTP 服务; catalog = 查询已生成的资产")
+    source = parser.add_mutually_exclusive_group()
+    source.add_argument("--input", help="输入图片路径 (支持 HEIC/JPG/PNG)")
+    source.add_argument("--input-dir", help="批量模式: 处理目录下的所有图片")
     parser.add_argument("--top_k", type=int, default=3, help="生成几种推荐风格 (默认: 3)")
+    parser.add_argument("--concurrency", type=int, default=0, help="同时生成的风格数上限 (默认: 0 = 全部并发, 1 = 串行)")
+    parser.add_argument("--no-cache", action="store_true", help="跳过分析结果缓存，强制重新请求 Gemini")
+    parser.add_argument("--image-cache-mb", type=int, default=512, help="已解码图片缓存的内存预算 (MB, 默认: 512)")
+    parser.add_argument("--profile", action="store_true", help="结束时打印各阶段耗时 p50/p95 汇总")
+    parser.add_argument("--trace-file", help="把阶段追踪写入文件 (.json = Chrome Trace, 其他 = JSON Lines)")
+    parser.add_argument("--queue-size", type=int, default=2, help="批量模式下分析与绘图阶段之间的队列长度 (默认: 2)")
+    parser.add_argument("--no-context-cache", action="store_true", help="不使用上下文缓存，每次请求都内联完整 Prompt")
+    parser.add_argument("--stream", action="store_true",
+                        help="单图模式下流式接收分析结果，每解析出一个推荐就立即开始绘制")
+    parser.add_argument("--export", nargs="?", const="all",
+                        help="导出多分辨率变体: 不带参数 = 全部规格，或逗号分隔的规格名 (见 settings.yaml export)")
+    parser.add_argument("--export-workers", type=int, default=0, help="导出进程数 (默认: 0 = CPU 核数)")
+    parser.add_argument("--dedupe", type=int, nargs="?", const=8, default=None, metavar="DISTANCE",
+                        help="批量模式: 按感知哈希合并连拍/近似照片，同组只分析一次 (可选汉明距离阈值, 默认 8)")
+    parser.add_argument("--render-once", action="store_true",
+                        help="配合 --dedupe: 同组照片只绘制代表图，其余直接复用其壁纸")
+    parser.add_argument("--analysis-batch", type=int, default=8,
+                        help="批量模式下每次分析请求合并的照片数 (默认: 8, 1 = 逐张分析)")
+    parser.add_argument("--shortlist", type=int, default=0, metavar="N",
+                        help="本地预排序出 N 个候选风格写进分析 Prompt (默认: 0 = 不使用)")
+    parser.add_argument("--local-only", action="store_true",
+                        help="只用本地预排序选风格，完全跳过 Gemini 分析请求 (适合大批量任务)")
+    parser.add_argument("--journal", metavar="PATH",
+                        help="任务日志数据库路径 (默认: settings.yaml 的 journal.path)")
+    parser.add_argument("--no-journal", action="store_true", help="批量模式下不记录任务日志 (无法 resume)")
+    parser.add_argument("--style", help="catalog 模式: 只列出该风格的资产")
+    parser.add_argument("--prune", action="store_true", help="catalog 模式: 删除文件已不存在的资产记录")
+    parser.add_argument("--host", default="127.0.0.1", help="serve 模式监听地址 (默认: 127.0.0.1)")
+    parser.add_argument("--port", type=int, default=8765, help="serve 模式监听端口 (默认: 8765)")
+    return parser
+
+def main():
+    parser = build_parser()
     args = parser.parse_args()
+    if args.command == "run" and not (args.input or args.input_dir):
+        parser.error("run 需要 --input 或 --input-dir")
 
     # 检查输入文件是否存在
-    if not os.path.exists(args.input):
+    if args.input and not os.path.exists(args.input):
         print(f"❌ 错误: 找不到输入图片 '{args.input}'")
         return
+    if args.input_dir and not os.path.isdir(args.input_dir):
+        print(f"❌ 错误: 找不到输入目录 '{args.input_dir}'")
+        return
+
+    if args.command == "catalog":
+        # 只查本地索引，不需要 API Key
+        run_catalog(args)
+        return
+
+    # 参数校验通过，开始真正干活时才导入业务模块
+    from src.tracing import tracer
+    if args.profile or args.trace_file:
+        tracer.enable()
+    try:
+        run(args)
+    finally:
+        if args.trace_file:
+            tracer.export(args.trace_file)
+        if args.profile:
+            tracer.print_summary()
+
+def run(args):
+    """
+    执行一次完整流程 (单图或批量目录)，返回每张照片的结果:
+    [{"input": path, "description": str, "results": [(style_key, save_path, error), ...]}, ...]
+    """
+    from src.utils import image_cache
+    from src.analyzer import ImageAnalyzer
+    from src.analysis_cache import AnalysisCache
+    from src.prompt_mixer import PromptMixer
+    from src.generator import ImageGenerator
+    from src.clients import get_registry
+
+    image_cache.set_budget(args.image_cache_mb * 1024 * 1024)
 
     print("\n🚀 === 启动 AI 壁纸生成 Agent (Google Gemini 2.5 全栈) ===\n")
 
     try:
         # 2. 初始化核心模块
-        analyzer = ImageAnalyzer() 
+        # 所有模块共用一个客户端注册表 (连接池 + 调用网关)
+        registry = get_registry()
+        if args.no_context_cache:
+            registry.prompt_cache.enabled = False
+        analysis_cache = None if args.no_cache else AnalysisCache()
+        analyzer = ImageAnalyzer(cache=analysis_cache, registry=registry,
+                                 shortlist=args.shortlist, local_only=args.local_only)
         mixer = PromptMixer()
-        generator = ImageGenerator()
+        exporter = None
+        if args.export:
+            from src.exporter import VariantExporter
+            names = None if args.export == "all" else [n.strip() for n in args.export.split(",") if n.strip()]
+            exporter = VariantExporter(names=names, workers=args.export_workers or None)
+        generator = ImageGenerator(registry=registry, exporter=exporter)
         
     except Exception as e:
         print(f"❌ 初始化失败: {e}")
         print("💡 提示: 请检查 .env 文件配置是否正确")
-        return
+        return []
+
+    try:
+        if args.command == "serve":
+            return run_serve(args, analyzer, mixer, generator)
+        if args.command == "resume":
+            return run_resume(args, analyzer, mixer, generator, open_journal(args, registry))
+        if args.input_dir:
+            journal = None if args.no_journal else open_journal(args, registry)
+            return run_batch(args, analyzer, mixer, generator, journal)
+        return run_single(args, analyzer, mixer, generator)
+    finally:
+        if exporter is not None:
+            # 等待进程池里剩余的导出任务
+            exporter.close()
+
+def run_catalog(args):
+    """
+    catalog 命令：从资产目录 (src/catalog.py) 查询产物，不遍历 outputs 目录
+    - --input / --input-dir: 列出这些照片的壁纸及其导出、视频、循环版本
+    - --style: 列出某个风格最近的壁纸
+    - --prune: 删除文件已不存在的记录 (查询结果本身已跳过这些记录)
+    """
+    from src.catalog import get_catalog
+    from src.utils import file_sha256
+    catalog = get_catalog()
+    if args.prune:
+        print(f"🧹 [Catalog] 清理了 {catalog.prune()} 条文件已不存在的记录")
+    if args.input or args.input_dir:
+        from src.pipeline import list_input_images
+        for path in [args.input] if args.input else list_input_images(args.input_dir):
+            wallpapers = catalog.for_source(file_sha256(path), kind="wallpaper", style_key=args.style)
+            print(f"🖼️ {os.path.basename(path)}: {len(wallpapers)} 张壁纸")
+            for asset in wallpapers:
+                print(f"   👉 {asset['style_key']} ({asset['creativity']}, {asset['width']}x{asset['height']}): "
+                      f"{asset['path']}")
+                for child in catalog.derivatives(asset["path"]):
+                    print(f"      ↳ {child['kind']}: {child['path']}")
+                    for loop in (catalog.derivatives(child["path"]) if child["kind"] == "video" else []):
+                        print(f"         ↳ {loop['kind']}: {loop['path']}")
+    elif args.style:
+        for asset in catalog.by_style(args.style, limit=50):
+            print(f"   👉 {asset['path']}")
+    print(catalog.report())
+
+def run_serve(args, analyzer, mixer, generator):
+    """
+    serve 命令：常驻 HTTP 服务，客户端/风格库只初始化一次 (接口说明见 src/server.py)
+    """
+    import asyncio
+    from src.server import WallpaperService
+    registry = analyzer.registry
+    # 预热: 提前创建 GenAI 客户端与连接池，第一个请求不用再等
+    registry.client
+    service = WallpaperService(analyzer, generator, mixer, settings=registry.settings.get("server", {}))
+    try:
+        asyncio.run(service.serve(args.host, args.port))
+    except KeyboardInterrupt:
+        print("\n👋 [Server] 已停止")
+    finally:
+        service.close()
+        print(service.report())
+        print_run_stats(analyzer)
+    return []
+
+def run_single(args, analyzer, mixer, generator):
+    """
+    单图模式：分析 -> 绘图 -> 总结
+    """
+    from src.pipeline import render_recommendations, stream_and_render
 
     # ---------------------------------------------------------
     # Step 1: 视觉分析 (Visual Analysis)
     # ---------------------------------------------------------
     start_time = time.time()
     
-    # 获取 Gemini 的分析结果
-    analysis_result = analyzer.analyze_and_recommend(args.input, top_k=args.top_k)
+    if args.stream:
+        # 流式模式: 分析与绘图重叠，拿到第一个推荐就开始画
+        analysis_result, results, first_seconds = stream_and_render(
+            analyzer, generator, mixer, args.input, top_k=args.top_k, concurrency=args.concurrency)
+    else:
+        # 获取 Gemini 的分析结果
+        analysis_result = analyzer.analyze_and_recommend(args.input, top_k=args.top_k)
+        results, first_seconds = None, None
     
     description = analysis_result.get('description', '')
     # ✅ 适配新结构: 获取 'recommendations' 列表 (里面包含 style_key 和 creativity)
@@ -52,45 +307,25 @@ def main():
 
     if not recommendations:
         print("⚠️ 未能获取推荐风格，程序终止。")
-        return
+        return []
 
     # ---------------------------------------------------------
     # Step 2: 批量绘图 (Batch Generation)
     # ---------------------------------------------------------
-    print(f"\n🎨 开始生成 {len(recommendations)} 张壁纸...\n")
-
-    generated_files = []
-
-    # ✅ 适配新循环: 遍历字典列表
-    for i, item in enumerate(recommendations, 1):
-        # 从字典中提取 key 和 creativity
-        style_key = item.get('style_key')
-        creativity = item.get('creativity', 'Medium') # 默认中等
-        
-        print(f"[{i}/{len(recommendations)}] 正在处理: {style_key} (策略: {creativity}) ...")
-        
-        try:
-            # A. 组装 Prompt (混合风格模板 + 描述)
-            prompt_data = mixer.mix_prompt(style_key, description)
-            
-            # ✅ 关键点: 将 analyzer 决定的 creativity 塞入 prompt_data
-            # 这样 generator 里的 generate_with_ref_image 就能读到了
-            prompt_data['creativity'] = creativity
-            
-            # B. 调用 Gemini Vision 生成 (原图 + 文本 + 策略)
-            save_path = generator.generate_with_ref_image(args.input, prompt_data)
-            
-            if save_path:
-                generated_files.append(save_path)
-            
-        except Exception as e:
-            print(f"   ⚠️ 风格 {style_key} 生成出错: {e}")
+    if results is None:
+        print(f"\n🎨 开始生成 {len(recommendations)} 张壁纸...\n")
+        results = render_recommendations(generator, mixer, args.input, description,
+                                         recommendations, concurrency=args.concurrency)
+    generated_files = [path for _, path, _ in results if path]
+    failed = [(style_key, error) for style_key, path, error in results if not path]
 
     # ---------------------------------------------------------
     # Step 3: 总结 (Summary)
     # ---------------------------------------------------------
     duration = time.time() - start_time
     print(f"\n✨ === 全部完成! 耗时: {duration:.2f}s ===")
+    if first_seconds is not None:
+        print(f"⏱️ 首张壁纸耗时: {first_seconds:.2f}s")
     
     if generated_files:
         print(f"📂 生成结果保存在 (原图所在目录的 outputs 文件夹):")
@@ -99,5 +334,13 @@ def main():
     else:
         print("❌ 本次没有生成任何图片。")
 
+    if failed:
+        print(f"⚠️ 失败风格 ({len(failed)}/{len(results)}):")
+        for style_key, error in failed:
+            print(f"   ✖ {style_key}: {error}")
+
+    print_run_stats(analyzer)
+    return [{"input": args.input, "description": description, "results": results}]
+
 if __name__ == "__main__":
     main()
\ No newline at end of file
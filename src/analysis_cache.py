@@ -0,0 +1,80 @@
+import os
+import json
+import time
+import hashlib
+import sqlite3
+import threading
+
+
+class AnalysisCache:
+    """
+    ImageAnalyzer 结果的持久化缓存 (本地 SQLite)。
+    Key = 图片内容哈希 + 风格菜单哈希 + top_k + 模型名，任一变化都会重新分析。
+    - ttl_seconds: 过期时间，过期条目视为未命中
+    - max_entries: 条目上限，超出后按最近使用时间淘汰
+    """
+    def __init__(self, db_path=".cache/analysis.sqlite3", ttl_seconds=30 * 24 * 3600, max_entries=5000):
+        self.db_path = db_path
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+        db_dir = os.path.dirname(db_path)
+        if db_dir:
+            os.makedirs(db_dir, exist_ok=True)
+        with self._connect() as conn:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS analysis (
+                    key TEXT PRIMARY KEY,
+                    result TEXT NOT NULL,
+                    created_at REAL NOT NULL,
+                    last_used REAL NOT NULL
+                )
+            """)
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_analysis_last_used ON analysis(last_used)")
+
+    def _connect(self):
+        # 每次操作新建连接：流水线里分析阶段跑在独立线程上
+        return sqlite3.connect(self.db_path, timeout=30)
+
+    @staticmethod
+    def make_key(image_hash, menu_hash, top_k, model_name):
+        raw = f"{image_hash}|{menu_hash}|{top_k}|{model_name}"
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+    def get(self, key):
+        now = time.time()
+        with self._lock, self._connect() as conn:
+            row = conn.execute("SELECT result, created_at FROM analysis WHERE key = ?", (key,)).fetchone()
+            if row is None or now - row[1] > self.ttl_seconds:
+                self.misses += 1
+                return None
+            conn.execute("UPDATE analysis SET last_used = ? WHERE key = ?", (now, key))
+            self.hits += 1
+            return json.loads(row[0])
+
+    def put(self, key, result):
+        now = time.time()
+        with self._lock, self._connect() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO analysis (key, result, created_at, last_used) VALUES (?, ?, ?, ?)",
+                (key, json.dumps(result, ensure_ascii=False), now, now)
+            )
+            self._evict(conn, now)
+
+    def _evict(self, conn, now):
+        conn.execute("DELETE FROM analysis WHERE created_at < ?", (now - self.ttl_seconds,))
+        conn.execute("""
+            DELETE FROM analysis WHERE key IN (
+                SELECT key FROM analysis ORDER BY last_used DESC LIMIT -1 OFFSET ?
+            )
+        """, (self.max_entries,))
+
+    def clear(self):
+        with self._lock, self._connect() as conn:
+            conn.execute("DELETE FROM analysis")
+
+    def report(self):
+        return f"💾 [AnalysisCache] 命中 {self.hits} / 未命中 {self.misses} ({self.db_path})"
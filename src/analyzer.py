@@ -1,42 +1,148 @@
 import os
 import json
-import yaml
-from google import genai
-from dotenv import load_dotenv
-from src.utils import load_image_safe 
+import math
+from collections import deque
+from src.payload import payload_preparer
+from src.utils import file_sha256
+from src.clients import get_registry
+from src.style_registry import get_style_registry
+from src.tracing import span
+
+# 每个 768x768 tile 的图片输入 token 数 (Gemini 2.5)
+IMAGE_TILE_TOKENS = 258
+
+# 多图分析的结构化输出: 每张图一条记录，用 index 对应输入顺序
+BATCH_RESPONSE_SCHEMA = {
+    "type": "OBJECT",
+    "properties": {
+        "images": {
+            "type": "ARRAY",
+            "items": {
+                "type": "OBJECT",
+                "properties": {
+                    "index": {"type": "INTEGER"},
+                    "description": {"type": "STRING"},
+                    "recommendations": {
+                        "type": "ARRAY",
+                        "items": {
+                            "type": "OBJECT",
+                            "properties": {
+                                "style_key": {"type": "STRING"},
+                                "creativity": {"type": "STRING", "enum": ["High", "Medium", "Low"]},
+                            },
+                            "required": ["style_key", "creativity"],
+                        },
+                    },
+                    "reasoning": {"type": "STRING"},
+                },
+                "required": ["index", "description", "recommendations"],
+            },
+        },
+    },
+    "required": ["images"],
+}
 
-load_dotenv()
 
 class ImageAnalyzer:
-    def __init__(self, styles_config_path="config/styles.yaml"):
-        api_key = os.getenv("GOOGLE_API_KEY")
-        if not api_key: raise ValueError("❌ 未找到 GOOGLE_API_KEY")
-        self.client = genai.Client(api_key=api_key)
+    def __init__(self, styles_config_path="config/styles.yaml", cache=None, registry=None,
+                 shortlist=0, local_only=False):
+        # 共享的客户端注册表 (连接池 + 调用网关)，可注入假客户端
+        self.registry = registry or get_registry()
+        if not self.registry.available:
+            raise ValueError("❌ 未找到 GOOGLE_API_KEY")
         self.model_name = "gemini-2.5-flash" 
+        # 统一调用网关 (限流 + 重试)
+        self.gateway = self.registry.gateway
         
-        # 读取配置
-        if not os.path.exists(styles_config_path):
-             raise FileNotFoundError(f"❌ 找不到配置: {styles_config_path}")
-        with open(styles_config_path, 'r', encoding='utf-8') as f:
-            self.full_config = yaml.safe_load(f)
-            self.style_menu = {k: v['name'] for k, v in self.full_config.get('styles', {}).items()}
+        # 读取配置 (共享的 StyleRegistry，文件修改后自动热加载)
+        self.style_registry = get_style_registry(styles_config_path)
 
-    def analyze_and_recommend(self, image_path, top_k=3):
-        print(f"🧠 [Analyzer] Gemini 2.5 正在分析图片与规划重绘策略...")
-        try:
-            img = load_image_safe(image_path)
-            
-            # 🔥 升级版 Prompt：要求返回 creativity_level
-            prompt = f"""
-            Act as an expert AI Art Director. 
-            Styles Library: {json.dumps(self.style_menu, ensure_ascii=False)}
-            
-            Task:
-            1. Recommend TOP {top_k} styles for this image.
-            2. For EACH style, determine the optimal "Creativity Level" (how much to deviate from the original image):
+        # 持久化结果缓存 (AnalysisCache)，为 None 时每次都请求模型
+        self.cache = cache
+        # 静态 Prompt 前缀的上下文缓存 (不可用时自动内联)
+        self.prompt_cache = self.registry.prompt_cache
+
+        # 多图合并分析的装箱参数 (settings.yaml -> analysis_batch)
+        batch = self.registry.settings.get("analysis_batch", {})
+        self.batch_max_images = max(1, batch.get("max_images", 8))
+        self.batch_max_bytes = int(batch.get("max_request_mb", 16) * 1024 * 1024)
+        self.batch_max_input_tokens = batch.get("max_input_tokens", 100000)
+        self.batch_max_output_tokens = batch.get("max_output_tokens", 8192)
+        self.batch_output_per_image = batch.get("output_tokens_per_image", 120)
+        self.batch_output_per_style = batch.get("output_tokens_per_style", 40)
+        # 自适应批大小: 失败减半，整批成功后 +1，上限 batch_max_images
+        self.batch_limit = self.batch_max_images
+        self.batch_stats = {"requests": 0, "images": 0, "splits": 0, "fallbacks": 0}
+
+        # 本地风格预排序: shortlist > 0 时把本地候选写进 Prompt；local_only 时完全不调用模型
+        self.shortlist = shortlist
+        self.local_only = local_only
+        self.ranker = None
+        if shortlist or local_only:
+            from src.style_ranker import get_style_ranker
+            self.ranker = get_style_ranker(styles_config_path, self.registry.settings.get("style_ranker", {}))
+
+    @property
+    def client(self):
+        # 首次调用模型时才创建 (并导入) GenAI 客户端，缓存命中的运行不需要它
+        return self.registry.client
+
+    @property
+    def full_config(self):
+        return self.style_registry.config
+
+    @property
+    def style_menu(self):
+        return self.style_registry.style_menu
+
+    @property
+    def menu_hash(self):
+        return self.style_registry.menu_hash
+
+    def _static_prompt(self):
+        """
+        单图与多图分析共用的静态前缀，只随风格库变化，可作为缓存上下文复用
+        """
+        # 风格详情让模型知道每个 style_key 实际会画成什么样；前缀因此超过上下文缓存的最小 token 数
+        return f"""
+            Act as an expert AI Art Director.
+            Styles Library: {self.style_registry.style_menu_json}
+
+            Style Reference (what each style_key renders as; "Avoid" lists what the style suppresses):
+{self.style_registry.library_text}
+
+            "Creativity Level" means how much to deviate from the original image:
                - "High": For abstract/artistic styles (e.g., Cubism, Impressionism). Change structure freely.
                - "Medium": For illustrative styles (e.g., Anime, 3D). Keep composition, change textures.
                - "Low": For realistic styles. Keep strict structure, only change lighting/color.
+
+            Rules:
+               - "style_key" must be copied exactly from the Styles Library keys. Never invent keys.
+               - Recommend each style at most once per image, best match first.
+               - Prefer styles whose Look suits the subject, lighting and mood of the photo; avoid styles
+                 whose "Avoid" list removes what makes the photo interesting (e.g. color for a sunset).
+               - "creativity" must be exactly one of "High", "Medium", "Low".
+               - The description is an objective English description of the subject, composition,
+                 lighting and colors (2-4 sentences). It is inserted into the style templates, so do
+                 not mention any art style in it.
+               - Reply with JSON only, no markdown fences.
+            """
+
+    @staticmethod
+    def _task_prompt(top_k, shortlist=None):
+        # 🔥 升级版 Prompt：要求返回 creativity_level
+        # 静态前缀 (角色 + 风格库 + 创意等级说明) 走上下文缓存，这里只发送任务部分
+        # description 放在最前面，流式输出时可以先拿到描述再逐个拿推荐
+        hint = ""
+        if shortlist:
+            hint = f"""
+            Local pre-ranker shortlist (best visual matches first): {", ".join(shortlist)}
+            Prefer styles from this shortlist unless another library style clearly fits better.
+            """
+        return hint + f"""
+            Task:
+            1. Recommend TOP {top_k} styles for this image.
+            2. For EACH style, determine the optimal "Creativity Level" as defined above.
             3. Write a visual description.
 
             Output JSON:
@@ -50,20 +156,348 @@ class ImageAnalyzer:
             }}
             """
 
-            response = self.client.models.generate_content(
-                model=self.model_name,
-                contents=[img, prompt],
+    def _cache_key(self, image_path, top_k):
+        # 带本地候选的 Prompt 结果可能不同，与不带候选的结果分开缓存
+        model = f"{self.model_name}+shortlist{self.shortlist}" if self.shortlist else self.model_name
+        return self.cache.make_key(file_sha256(image_path), self.menu_hash, top_k, model)
+
+    def _shortlists(self, image_paths):
+        """
+        本地预排序得到每张图的候选风格 (一次批量计算)；未开启或读取失败时为 None
+        """
+        if not self.shortlist or not image_paths:
+            return [None] * len(image_paths)
+        try:
+            ranked = self.ranker.rank(image_paths)
+        except Exception as e:
+            print(f"⚠️ [Ranker] 本地预排序失败，不带候选: {e}")
+            return [None] * len(image_paths)
+        return [[key for key, _ in styles[:self.shortlist]] for _, styles in ranked]
+
+    def analyze_local(self, image_path, top_k=3):
+        """
+        纯本地分析 (--local-only)：不调用模型、不写分析缓存，读取失败时用保底方案
+        """
+        try:
+            result = self.ranker.analyze_local(image_path, top_k)
+        except Exception as e:
+            print(f"❌ [异常] 本地分析 {os.path.basename(image_path)} 失败: {e}")
+            return self._fallback(top_k)
+        picks = ", ".join(r["style_key"] for r in result["recommendations"])
+        print(f"🧭 [Ranker] {os.path.basename(image_path)} 本地推荐: {picks}")
+        return result
+
+    def analyze_and_recommend(self, image_path, top_k=3):
+        if self.local_only:
+            return self.analyze_local(image_path, top_k)
+        cache_key = None
+        if self.cache is not None and os.path.exists(image_path):
+            cache_key = self._cache_key(image_path, top_k)
+            cached = self.cache.get(cache_key)
+            if cached is not None:
+                print(f"💾 [Analyzer] 命中分析缓存: {os.path.basename(image_path)}")
+                return cached
+
+        print(f"🧠 [Analyzer] Gemini 2.5 正在分析图片与规划重绘策略...")
+        try:
+            # 分析只需低分辨率: 缩放到 1024px 以内再上传
+            img = payload_preparer.to_part(image_path, "analysis")
+            
+            prompt = self._task_prompt(top_k, self._shortlists([image_path])[0])
+
+            response = self.prompt_cache.generate_content(
+                self.model_name, "analyzer", self._static_prompt(), [img], prompt,
                 config={"response_mime_type": "application/json"}
             )
             
-            result = json.loads(response.text)
+            with span("analyzer.parse"):
+                result = json.loads(response.text)
             print(f"✅ [推荐] 方案已生成")
+            # 只缓存真实的模型结果，保底方案不落盘
+            if cache_key:
+                self.cache.put(cache_key, result)
             return result
 
         except Exception as e:
             print(f"❌ [异常] 分析失败: {e}")
-            # 保底返回
-            return {
-                "description": "A nice photo",
-                "recommendations": [{"style_key": k, "creativity": "Medium"} for k in list(self.style_menu.keys())[:top_k]]
-            }
\ No newline at end of file
+            print(f"⚠️ [Analyzer] 使用保底方案: 前 {top_k} 个风格")
+            return self._fallback(top_k)
+
+    def analyze_streaming(self, image_path, top_k=3, on_recommendation=None):
+        """
+        流式分析：边接收 JSON 边解析，每解析出一个推荐 (且 description 已就绪) 就回调
+        on_recommendation(description, item)，调用方可以立刻开始绘制。
+        返回值与 analyze_and_recommend 相同；缓存命中或走保底时也会逐个回调。
+        """
+        from src.json_stream import IncrementalJSONParser
+        emitted = []
+        description = None
+        waiting = []
+
+        def emit(item):
+            emitted.append(item)
+            if on_recommendation is not None:
+                on_recommendation(description or "", item)
+
+        def finish(result):
+            # 补发流式阶段没来得及回调的推荐 (缓存命中 / 保底 / 解析器漏掉的)
+            for item in result.get("recommendations", [])[len(emitted):]:
+                emit(item)
+            return result
+
+        if self.local_only:
+            local = self.analyze_local(image_path, top_k)
+            description = local["description"]
+            return finish(local)
+
+        cache_key = None
+        if self.cache is not None and os.path.exists(image_path):
+            cache_key = self._cache_key(image_path, top_k)
+            cached = self.cache.get(cache_key)
+            if cached is not None:
+                print(f"💾 [Analyzer] 命中分析缓存: {os.path.basename(image_path)}")
+                description = cached.get("description", "")
+                return finish(cached)
+
+        print(f"🧠 [Analyzer] Gemini 2.5 正在流式分析图片...")
+        parser = IncrementalJSONParser(array_keys=("recommendations",), string_keys=("description",))
+        try:
+            img = payload_preparer.to_part(image_path, "analysis")
+            stream = self.prompt_cache.stream_content(
+                self.model_name, "analyzer", self._static_prompt(), [img],
+                self._task_prompt(top_k, self._shortlists([image_path])[0]),
+                config={"response_mime_type": "application/json"}
+            )
+            for chunk in stream:
+                for kind, key, value in parser.feed(getattr(chunk, "text", None) or ""):
+                    if kind == "field":
+                        description = value
+                        print(f"📝 [Analyzer] 描述已就绪，开始接收推荐")
+                        for item in waiting:
+                            emit(item)
+                        waiting.clear()
+                    else:
+                        print(f"✅ [推荐] {value.get('style_key')} ({value.get('creativity', 'Medium')})")
+                        if description is None:
+                            waiting.append(value)
+                        else:
+                            emit(value)
+
+            with span("analyzer.parse"):
+                result = parser.result()
+            if cache_key:
+                self.cache.put(cache_key, result)
+            description = result.get("description", description)
+            for item in waiting:
+                emit(item)
+            return finish(result)
+
+        except Exception as e:
+            print(f"❌ [异常] 流式分析失败: {e}")
+            if emitted or waiting:
+                # 已经拿到部分推荐: 保留它们，不再用保底方案覆盖
+                for item in waiting:
+                    emit(item)
+                return {"description": description or "A nice photo", "recommendations": list(emitted)}
+            print(f"⚠️ [Analyzer] 使用保底方案: 前 {top_k} 个风格")
+            fallback = self._fallback(top_k)
+            description = fallback["description"]
+            return finish(fallback)
+
+    def _fallback(self, top_k):
+        # 保底返回
+        return {
+            "description": "A nice photo",
+            "recommendations": [{"style_key": k, "creativity": "Medium"} for k in list(self.style_menu.keys())[:top_k]]
+        }
+
+    # ------------------------------------------------------------------
+    # 多图合并分析
+    # ------------------------------------------------------------------
+    def analyze_many(self, image_paths, top_k=3):
+        """
+        一次请求分析多张照片，返回与 image_paths 顺序一致的结果列表 (结构同 analyze_and_recommend)。
+        - 先查 AnalysisCache，只把未命中的图片打包
+        - 按图片体积、输入/输出 token 预算与当前自适应批大小装箱
+        - 某一批失败 (异常、JSON 截断、缺少条目) 时对半拆分重试，单张仍失败才用保底方案
+        """
+        if self.local_only:
+            return [self.analyze_local(path, top_k) for path in image_paths]
+        results = [None] * len(image_paths)
+        cache_keys = {}
+        pending = []
+        for i, path in enumerate(image_paths):
+            if self.cache is not None and os.path.exists(path):
+                cache_keys[i] = self._cache_key(path, top_k)
+                cached = self.cache.get(cache_keys[i])
+                if cached is not None:
+                    print(f"💾 [Analyzer] 命中分析缓存: {os.path.basename(path)}")
+                    results[i] = cached
+                    continue
+            pending.append(i)
+
+        payloads = {}
+        for i in pending:
+            try:
+                payloads[i] = payload_preparer.prepare(image_paths[i], "analysis_batch")
+            except Exception as e:
+                print(f"❌ [异常] 读取 {os.path.basename(image_paths[i])} 失败: {e}")
+                results[i] = self._fallback(top_k)
+                self.batch_stats["fallbacks"] += 1
+
+        readable = [i for i in pending if i in payloads]
+        shortlists = dict(zip(readable, self._shortlists([image_paths[i] for i in readable])))
+        todo = deque(self._pack(readable, payloads, top_k))
+        self.batch_stats["images"] += len(payloads)
+        if todo:
+            print(f"🧠 [Analyzer] 合并分析 {len(payloads)} 张图片 ({len(todo)} 个请求)...")
+        while todo:
+            batch = todo.popleft()
+            parsed = self._analyze_batch([image_paths[i] for i in batch], [payloads[i] for i in batch], top_k,
+                                         [shortlists[i] for i in batch])
+            missing = []
+            for i, result in zip(batch, parsed):
+                if result is None:
+                    missing.append(i)
+                    continue
+                results[i] = result
+                if i in cache_keys:
+                    self.cache.put(cache_keys[i], result)
+
+            if not missing:
+                self.batch_limit = min(self.batch_max_images, self.batch_limit + 1)
+                continue
+            if len(missing) == 1 and len(batch) == 1:
+                # 单张单独请求仍然失败，才用保底方案
+                i = missing[0]
+                print(f"⚠️ [Analyzer] {os.path.basename(image_paths[i])} 分析失败，使用保底方案")
+                results[i] = self._fallback(top_k)
+                self.batch_stats["fallbacks"] += 1
+                continue
+            self.batch_limit = max(1, len(batch) // 2)
+            self.batch_stats["splits"] += 1
+            if len(missing) == 1:
+                # 多图批次里只缺一张: 单独重试一次
+                print(f"✂️ [Analyzer] {os.path.basename(image_paths[missing[0]])} 未返回结果，单独重试")
+                todo.appendleft(missing)
+                continue
+            # 拆成两半放回队首，优先重试
+            half = len(missing) // 2
+            print(f"✂️ [Analyzer] {len(missing)} 张图片未返回结果，拆分为 {half} + {len(missing) - half} 重试")
+            todo.appendleft(missing[half:])
+            todo.appendleft(missing[:half])
+        return results
+
+    def _estimate_output_tokens(self, top_k):
+        return self.batch_output_per_image + self.batch_output_per_style * top_k
+
+    @staticmethod
+    def _estimate_image_tokens(max_side):
+        tiles = math.ceil(max_side / 768) ** 2
+        return IMAGE_TILE_TOKENS * tiles
+
+    def _pack(self, indices, payloads, top_k):
+        """
+        贪心装箱: 按输入顺序依次放入，超出任一预算就开新批
+        """
+        prompt_tokens = len(self._static_prompt() + self._batch_prompt(self.batch_max_images, top_k)) // 4
+        image_tokens = self._estimate_image_tokens(payload_preparer.profiles["analysis_batch"].max_side)
+        output_tokens = self._estimate_output_tokens(top_k)
+
+        batches, current, size, tokens_in, tokens_out = [], [], 0, prompt_tokens, 0
+        for i in indices:
+            data_len = len(payloads[i].data)
+            over = current and (
+                len(current) >= self.batch_limit
+                or size + data_len > self.batch_max_bytes
+                or tokens_in + image_tokens > self.batch_max_input_tokens
+                or tokens_out + output_tokens > self.batch_max_output_tokens
+            )
+            if over:
+                batches.append(current)
+                current, size, tokens_in, tokens_out = [], 0, prompt_tokens, 0
+            current.append(i)
+            size += data_len
+            tokens_in += image_tokens
+            tokens_out += output_tokens
+        if current:
+            batches.append(current)
+        return batches
+
+    def _batch_prompt(self, count, top_k):
+        return f"""
+            You are given {count} images, each preceded by a label "Image N".
+            {"Labels may carry a local pre-ranker shortlist; prefer those styles unless another clearly fits better." if self.shortlist else ""}
+            Task, for EACH of the {count} images independently:
+            1. Recommend TOP {top_k} styles for that image.
+            2. For EACH style, determine the optimal "Creativity Level" as defined above.
+            3. Write a visual description.
+
+            Output JSON with exactly one entry per image, "index" being the image label number:
+            {{
+                "images": [
+                    {{
+                        "index": 1,
+                        "description": "...",
+                        "recommendations": [
+                            {{ "style_key": "style1", "creativity": "High" }}
+                        ],
+                        "reasoning": "..."
+                    }}
+                ]
+            }}
+            """
+
+    def _analyze_batch(self, paths, payloads, top_k, shortlists=None):
+        """
+        发送一个多图请求；返回与 paths 对齐的结果列表，缺失或无效的条目为 None
+        """
+        from google.genai import types
+        contents = []
+        for n, payload in enumerate(payloads, 1):
+            shortlist = shortlists[n - 1] if shortlists else None
+            if shortlist:
+                contents.append(f"Image {n} (local pre-ranker shortlist, best first: {', '.join(shortlist)}):")
+            else:
+                contents.append(f"Image {n}:")
+            contents.append(types.Part.from_bytes(data=payload.data, mime_type=payload.mime_type))
+
+        self.batch_stats["requests"] += 1
+        try:
+            response = self.prompt_cache.generate_content(
+                self.model_name, "analyzer", self._static_prompt(), contents,
+                self._batch_prompt(len(paths), top_k),
+                config={
+                    "response_mime_type": "application/json",
+                    "response_schema": BATCH_RESPONSE_SCHEMA,
+                    "max_output_tokens": self.batch_max_output_tokens,
+                },
+            )
+            with span("analyzer.parse", images=len(paths)):
+                entries = json.loads(response.text).get("images", [])
+        except Exception as e:
+            print(f"❌ [异常] 合并分析 {len(paths)} 张图片失败: {e}")
+            return [None] * len(paths)
+
+        parsed = [None] * len(paths)
+        for entry in entries:
+            index = entry.get("index") if isinstance(entry, dict) else None
+            if not isinstance(index, int) or not 1 <= index <= len(paths):
+                continue
+            recommendations = entry.get("recommendations")
+            if not isinstance(recommendations, list) or not recommendations:
+                continue
+            parsed[index - 1] = {
+                "description": entry.get("description", ""),
+                "recommendations": recommendations[:top_k],
+                "reasoning": entry.get("reasoning", ""),
+            }
+        done = sum(1 for r in parsed if r is not None)
+        print(f"✅ [推荐] 合并请求返回 {done}/{len(paths)} 张图片的方案")
+        return parsed
+
+    def batch_report(self):
+        s = self.batch_stats
+        saved = s["images"] - s["requests"]
+        return (f"🧺 [Analyzer] 合并分析 {s['images']} 张图片 / {s['requests']} 次请求 (节省 {max(0, saved)} 次) | "
+                f"拆分 {s['splits']} | 保底 {s['fallbacks']} | 当前批大小 {self.batch_limit}")
\ No newline at end of file
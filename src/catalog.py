@@ -0,0 +1,217 @@
+import os
+import json
+import time
+import sqlite3
+import threading
+
+DEFAULT_PATH = ".cache/catalog.sqlite3"
+
+# 资产类型: 壁纸原图 / 多分辨率导出 / Veo 视频 / 无缝循环视频
+KINDS = ("wallpaper", "export", "video", "loop")
+
+# 派生资产 (导出/视频/循环) 没有显式给出时，从父资产继承的字段
+INHERITED = ("source_path", "source_hash", "style_key", "creativity")
+
+_COLUMNS = ("path", "kind", "parent", "source_path", "source_hash", "style_key", "creativity", "engine",
+            "prompt_hash", "job_key", "width", "height", "bytes", "extra", "created_at", "updated_at")
+
+
+def image_size(path):
+    """
+    只读文件头获取图片宽高，读取失败时返回 (None, None)
+    """
+    try:
+        from src.utils import import_pil
+        with import_pil().open(path) as img:
+            return img.size
+    except Exception:
+        return None, None
+
+
+class AssetCatalog:
+    """
+    生成资产的索引目录 (本地 SQLite)：每张壁纸、导出变体、视频与循环视频各一行。
+    - 记录来源图片哈希、style_key、重绘策略、引擎、Prompt 哈希、尺寸与时间
+    - 派生资产通过 parent 指向来源资产，并继承它的来源与风格信息
+    - source_hash / style_key / parent 上都有索引，几十万张壁纸也不需要遍历 outputs 目录
+    """
+    def __init__(self, db_path=DEFAULT_PATH):
+        self.db_path = db_path
+        self._lock = threading.Lock()
+
+        db_dir = os.path.dirname(db_path)
+        if db_dir:
+            os.makedirs(db_dir, exist_ok=True)
+        with self._connect() as conn:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS assets (
+                    path TEXT PRIMARY KEY,
+                    kind TEXT NOT NULL,
+                    parent TEXT,
+                    source_path TEXT,
+                    source_hash TEXT,
+                    style_key TEXT,
+                    creativity TEXT,
+                    engine TEXT,
+                    prompt_hash TEXT,
+                    job_key TEXT,
+                    width INTEGER,
+                    height INTEGER,
+                    bytes INTEGER,
+                    extra TEXT,
+                    created_at REAL NOT NULL,
+                    updated_at REAL NOT NULL
+                )
+            """)
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_assets_source ON assets(source_hash, kind)")
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_assets_style ON assets(style_key, kind)")
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_assets_parent ON assets(parent)")
+
+    def _connect(self):
+        # 每次操作新建连接：绘图线程与导出回调会并发写入
+        conn = sqlite3.connect(self.db_path, timeout=30)
+        conn.row_factory = sqlite3.Row
+        return conn
+
+    @staticmethod
+    def _key(path):
+        return os.path.abspath(path)
+
+    def record(self, path, kind, parent=None, **fields):
+        """
+        登记 (或更新) 一个资产；图片未给出尺寸时读取文件头。extra 之外的未知字段会放进 extra。
+        """
+        if kind not in KINDS:
+            raise ValueError(f"❌ 未知的资产类型: {kind}")
+        row = {c: fields.pop(c) for c in _COLUMNS if c in fields and c != "extra"}
+        extra = dict(fields.pop("extra", None) or {}, **fields)
+        row.update(path=self._key(path), kind=kind, parent=self._key(parent) if parent else None,
+                   extra=json.dumps(extra, ensure_ascii=False) if extra else None)
+        if row.get("source_path"):
+            row["source_path"] = self._key(row["source_path"])
+        if os.path.exists(path):
+            if not row.get("bytes"):
+                row["bytes"] = os.path.getsize(path)
+            if kind in ("wallpaper", "export") and not row.get("width"):
+                row["width"], row["height"] = image_size(path)
+        now = time.time()
+
+        with self._lock, self._connect() as conn:
+            if parent:
+                inherited = conn.execute(
+                    f"SELECT {', '.join(INHERITED)} FROM assets WHERE path = ?", (row["parent"],)
+                ).fetchone()
+                if inherited is not None:
+                    for column in INHERITED:
+                        if not row.get(column):
+                            row[column] = inherited[column]
+            columns = [c for c in _COLUMNS if c not in ("created_at", "updated_at") and c in row]
+            conn.execute(f"""
+                INSERT INTO assets ({', '.join(columns)}, created_at, updated_at)
+                VALUES ({', '.join('?' * len(columns))}, ?, ?)
+                ON CONFLICT (path) DO UPDATE SET
+                    {', '.join(f'{c} = excluded.{c}' for c in columns if c != 'path')},
+                    updated_at = excluded.updated_at
+            """, [row[c] for c in columns] + [now, now])
+
+    def lookup(self, path):
+        """
+        按文件路径查资产，返回字典或 None
+        """
+        with self._connect() as conn:
+            row = conn.execute("SELECT * FROM assets WHERE path = ?", (self._key(path),)).fetchone()
+        return self._to_dict(row) if row else None
+
+    def style_for(self, path):
+        asset = self.lookup(path)
+        return asset["style_key"] if asset else None
+
+    def _select(self, sql, params, limit=None):
+        """
+        执行查询，跳过文件已经不存在的资产 (被手动删除、临时目录已清理)；limit 按过滤后的数量计
+        """
+        assets = []
+        with self._connect() as conn:
+            for row in conn.execute(sql, params):
+                if not os.path.exists(row["path"]):
+                    continue
+                assets.append(self._to_dict(row))
+                if limit and len(assets) >= limit:
+                    break
+        return assets
+
+    def for_source(self, source_hash, kind=None, style_key=None):
+        """
+        一张原图的所有产物 (可按类型/风格过滤)，按创建时间排序
+        """
+        sql, params = "SELECT * FROM assets WHERE source_hash = ?", [source_hash]
+        if kind:
+            sql += " AND kind = ?"
+            params.append(kind)
+        if style_key:
+            sql += " AND style_key = ?"
+            params.append(style_key)
+        return self._select(sql + " ORDER BY created_at", params)
+
+    def by_style(self, style_key, kind="wallpaper", limit=None):
+        sql = "SELECT * FROM assets WHERE style_key = ? AND kind = ? ORDER BY created_at DESC"
+        return self._select(sql, (style_key, kind), limit=limit)
+
+    def derivatives(self, path):
+        """
+        由某个资产派生出的资产 (导出变体、视频；视频的循环版本)
+        """
+        return self._select("SELECT * FROM assets WHERE parent = ? ORDER BY created_at", (self._key(path),))
+
+    def prune(self):
+        """
+        删除文件已经不存在的资产记录，返回删除的数量
+        """
+        with self._connect() as conn:
+            missing = [row[0] for row in conn.execute("SELECT path FROM assets") if not os.path.exists(row[0])]
+        if not missing:
+            return 0
+        with self._lock, self._connect() as conn:
+            conn.executemany("DELETE FROM assets WHERE path = ?", [(p,) for p in missing])
+        return len(missing)
+
+    def counts(self):
+        with self._connect() as conn:
+            return dict(conn.execute("SELECT kind, COUNT(*) FROM assets GROUP BY kind").fetchall())
+
+    @staticmethod
+    def _to_dict(row):
+        asset = dict(row)
+        asset["extra"] = json.loads(asset["extra"]) if asset["extra"] else {}
+        return asset
+
+    def report(self):
+        counts = self.counts()
+        parts = " / ".join(f"{kind} {counts.get(kind, 0)}" for kind in KINDS)
+        return f"🗂️ [Catalog] {parts} ({self.db_path})"
+
+
+_catalogs = {}
+_catalogs_lock = threading.Lock()
+_default_path = DEFAULT_PATH
+
+
+def get_catalog(db_path=None):
+    """
+    同一数据库在进程内共享一个 AssetCatalog；不指定路径时使用默认目录 (见 set_catalog_path)
+    """
+    key = os.path.abspath(db_path or _default_path)
+    with _catalogs_lock:
+        if key not in _catalogs:
+            _catalogs[key] = AssetCatalog(db_path or _default_path)
+        return _catalogs[key]
+
+
+def set_catalog_path(db_path):
+    """
+    替换默认的资产目录位置 (例如基准测试写到临时目录，不污染正式目录)，返回原来的路径
+    """
+    global _default_path
+    with _catalogs_lock:
+        previous, _default_path = _default_path, db_path or DEFAULT_PATH
+    return previous
@@ -0,0 +1,125 @@
+import os
+import threading
+from src.utils import load_settings
+from src.gateway import CallGateway
+
+
+class ClientRegistry:
+    """
+    进程级的客户端注册表：GenAI Client、HTTP Session 与调用网关各只创建一份。
+    - 所有连接走 keep-alive 连接池，批量运行时不再重复 TLS 握手
+    - 通过构造参数注入 client / session / gateway，可替换成本地假客户端
+    """
+    def __init__(self, api_key=None, client=None, session=None, gateway=None, settings=None):
+        from dotenv import load_dotenv
+        load_dotenv()
+        if settings is None:
+            settings = load_settings()
+        http = settings.get("http", {})
+        self.pool_size = http.get("pool_size", 16)
+        self.timeout = http.get("timeout", 300)
+        self.keepalive_expiry = http.get("keepalive_expiry", 60)
+
+        self.api_key = api_key or os.getenv("GOOGLE_API_KEY")
+        self._client = client
+        self._session = session
+        self._gateway = gateway
+        self._prompt_cache = None
+        self._gateway_settings = settings.get("gateway", {})
+        # 其余模块按需读取自己的配置段 (如 analysis_batch)
+        self.settings = settings
+        self._lock = threading.Lock()
+
+    @property
+    def available(self):
+        """
+        是否具备调用模型的条件 (有 API Key 或已注入客户端)
+        """
+        return self._client is not None or bool(self.api_key)
+
+    def _build_http_options(self):
+        from google.genai import types
+        options = {"timeout": int(self.timeout * 1000)}
+        try:
+            import httpx
+            options["client_args"] = {
+                "limits": httpx.Limits(
+                    max_connections=self.pool_size,
+                    max_keepalive_connections=self.pool_size,
+                    keepalive_expiry=self.keepalive_expiry,
+                )
+            }
+            return types.HttpOptions(**options)
+        except Exception:
+            # 老版本 SDK 不支持 client_args 时只设置超时
+            return types.HttpOptions(timeout=options["timeout"])
+
+    @property
+    def client(self):
+        with self._lock:
+            if self._client is None:
+                if not self.api_key:
+                    raise ValueError("❌ 未找到 GOOGLE_API_KEY")
+                # google.genai 导入耗时较长，只在第一次真正调用模型时加载
+                from google import genai
+                self._client = genai.Client(api_key=self.api_key, http_options=self._build_http_options())
+            return self._client
+
+    @property
+    def session(self):
+        with self._lock:
+            if self._session is None:
+                import requests
+                from requests.adapters import HTTPAdapter
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=self.pool_size, pool_maxsize=self.pool_size)
+                session.mount("https://", adapter)
+                session.mount("http://", adapter)
+                self._session = session
+            return self._session
+
+    @property
+    def gateway(self):
+        with self._lock:
+            if self._gateway is None:
+                self._gateway = CallGateway(self._gateway_settings)
+            return self._gateway
+
+    @property
+    def prompt_cache(self):
+        # 静态 Prompt 前缀的上下文缓存，所有模块共用一份句柄
+        with self._lock:
+            if self._prompt_cache is None:
+                from src.context_cache import PromptCache
+                self._prompt_cache = PromptCache(self, self.settings.get("context_cache", {}))
+            return self._prompt_cache
+
+    def close(self):
+        with self._lock:
+            if self._session is not None:
+                self._session.close()
+                self._session = None
+
+
+_default_registry = None
+_default_lock = threading.Lock()
+
+
+def get_registry():
+    """
+    默认的进程级注册表，未显式注入时各模块都从这里取客户端
+    """
+    global _default_registry
+    with _default_lock:
+        if _default_registry is None:
+            _default_registry = ClientRegistry()
+        return _default_registry
+
+
+def set_registry(registry):
+    """
+    替换默认注册表 (例如注入本地假客户端做离线测试)
+    """
+    global _default_registry
+    with _default_lock:
+        _default_registry = registry
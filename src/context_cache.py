@@ -0,0 +1,258 @@
+import time
+import hashlib
+import threading
+from src.tracing import span
+
+# 调用带缓存上下文的请求失败时，这些状态码说明缓存本身不可用 (过期/被删/不支持)，改走内联 Prompt
+CACHE_ERROR_CODES = (400, 403, 404)
+
+
+def open_stream(stream_fn, **kwargs):
+    """
+    打开一个流式响应并读出第一块：连接/限流错误在这里抛出，因此可以被网关重试
+    返回 (第一块或 None, 剩余的迭代器)
+    """
+    stream = iter(stream_fn(**kwargs))
+    return next(stream, None), stream
+
+
+class _CacheEntry:
+    __slots__ = ("name", "digest", "expires_at", "tokens")
+
+    def __init__(self, name, digest, expires_at, tokens):
+        self.name = name
+        self.digest = digest
+        self.expires_at = expires_at
+        self.tokens = tokens
+
+
+class PromptCache:
+    """
+    长 Prompt 静态前缀的上下文缓存 (client.caches)：
+        prompt_cache.generate_content(model, label, static_text, parts, dynamic_text, config)
+    - 同一 (模型, 前缀内容) 只创建一次缓存，之后的请求只带 cached_content 句柄 + 动态部分
+    - 距离过期不到 refresh_margin 秒时续期 (update ttl)，续期失败就重新创建
+    - 前缀内容变化 (例如 styles.yaml 热加载) 会生成新句柄，旧缓存尽量删除
+    - 前缀太短、接口不支持或句柄失效时回退为内联 Prompt，结果与不缓存时一致
+    - 统计 prompt / 缓存命中 token 数与两种请求的平均耗时
+    """
+    def __init__(self, registry, settings=None):
+        settings = settings or {}
+        self.registry = registry
+        self.enabled = settings.get("enabled", True)
+        self.ttl_seconds = settings.get("ttl_seconds", 3600)
+        self.refresh_margin = settings.get("refresh_margin", 300)
+        # 显式缓存有最小 token 数要求 (Gemini 2.5 Flash 为 1024)，按 4 字符/token 粗估
+        self.min_tokens = settings.get("min_tokens", 1024)
+
+        self._entries = {}          # (model, label) -> _CacheEntry
+        self._unsupported = set()   # (model, digest): 创建失败过的前缀，本进程内不再尝试
+        self._lock = threading.Lock()
+        self._create_lock = threading.Lock()
+        self.stats = {
+            "creates": 0, "refreshes": 0, "fallbacks": 0,
+            "cached_calls": 0, "inline_calls": 0,
+            "prompt_tokens": 0, "cached_tokens": 0,
+            "cached_seconds": 0.0, "inline_seconds": 0.0,
+        }
+
+    @staticmethod
+    def estimate_tokens(text):
+        return len(text) // 4
+
+    def _create(self, model, label, static_text, digest):
+        gateway = self.registry.gateway
+        cached = gateway.call(
+            model, self.registry.client.caches.create,
+            model=model,
+            config={
+                "contents": [static_text],
+                "ttl": f"{int(self.ttl_seconds)}s",
+                "display_name": f"{label}-{digest[:8]}",
+            },
+        )
+        usage = getattr(cached, "usage_metadata", None)
+        tokens = getattr(usage, "total_token_count", None) or self.estimate_tokens(static_text)
+        with self._lock:
+            self.stats["creates"] += 1
+        print(f"🧊 [PromptCache] 已缓存 {label} 前缀 (~{tokens} token, TTL {self.ttl_seconds}s)")
+        return _CacheEntry(cached.name, digest, time.monotonic() + self.ttl_seconds, tokens)
+
+    def _refresh(self, model, entry):
+        self.registry.gateway.call(
+            model, self.registry.client.caches.update,
+            name=entry.name, config={"ttl": f"{int(self.ttl_seconds)}s"},
+        )
+        entry.expires_at = time.monotonic() + self.ttl_seconds
+        with self._lock:
+            self.stats["refreshes"] += 1
+
+    def _delete(self, entry):
+        try:
+            self.registry.client.caches.delete(name=entry.name)
+        except Exception:
+            pass  # 删不掉也会在 TTL 到期后自动清理
+
+    def handle(self, model, label, static_text):
+        """
+        返回可用的缓存句柄 (cached_content 名称)，不可用时返回 None
+        """
+        if not self.enabled:
+            return None
+        digest = hashlib.sha256(static_text.encode("utf-8")).hexdigest()
+        if (model, digest) in self._unsupported:
+            return None
+        if self.estimate_tokens(static_text) < self.min_tokens:
+            self._unsupported.add((model, digest))
+            print(f"ℹ️ [PromptCache] {label} 前缀不足 {self.min_tokens} token，使用内联 Prompt")
+            return None
+
+        key = (model, label)
+        with self._lock:
+            entry = self._entries.get(key)
+        if self._is_fresh(entry, digest):
+            return entry.name
+
+        # 创建 / 续期走慢路径，同一时间只有一个线程在做，避免并发请求重复建缓存
+        with self._create_lock:
+            with self._lock:
+                entry = self._entries.get(key)
+            if self._is_fresh(entry, digest):
+                return entry.name
+            if entry is not None and entry.digest != digest:
+                # 前缀内容变了 (风格库热加载)，旧缓存作废
+                self._delete(entry)
+                entry = None
+            try:
+                if entry is not None:
+                    try:
+                        self._refresh(model, entry)
+                    except Exception as e:
+                        print(f"⚠️ [PromptCache] {label} 续期失败，重新创建: {e}")
+                        entry = None
+                if entry is None:
+                    entry = self._create(model, label, static_text, digest)
+            except Exception as e:
+                print(f"⚠️ [PromptCache] 无法创建 {label} 缓存，改用内联 Prompt: {e}")
+                self._unsupported.add((model, digest))
+                with self._lock:
+                    self._entries.pop(key, None)
+                return None
+
+            with self._lock:
+                self._entries[key] = entry
+            return entry.name
+
+    def _is_fresh(self, entry, digest):
+        return (entry is not None and entry.digest == digest
+                and entry.expires_at - self.refresh_margin > time.monotonic())
+
+    def invalidate(self, model, label):
+        with self._lock:
+            self._entries.pop((model, label), None)
+
+    def generate_content(self, model, label, static_text, parts, dynamic_text, config=None):
+        """
+        通过网关调用 generate_content；模型看到的内容顺序始终是 静态前缀 -> parts -> 动态部分
+        """
+        config = dict(config or {})
+        name = self.handle(model, label, static_text)
+        if name:
+            try:
+                return self._call(model, label, [*parts, dynamic_text], dict(config, cached_content=name), True)
+            except Exception as e:
+                code = self.registry.gateway.status_code(e)
+                if code not in CACHE_ERROR_CODES:
+                    raise
+                print(f"⚠️ [PromptCache] {label} 缓存句柄失效 ({code})，改用内联 Prompt")
+                self.invalidate(model, label)
+                with self._lock:
+                    self.stats["fallbacks"] += 1
+        return self._call(model, label, [static_text, *parts, dynamic_text], config, False)
+
+    def stream_content(self, model, label, static_text, parts, dynamic_text, config=None):
+        """
+        generate_content_stream 版本：逐块产出响应，缓存/回退规则与 generate_content 相同
+        """
+        config = dict(config or {})
+        name = self.handle(model, label, static_text)
+        if name:
+            try:
+                first, rest = self._open(model, [*parts, dynamic_text], dict(config, cached_content=name))
+            except Exception as e:
+                code = self.registry.gateway.status_code(e)
+                if code not in CACHE_ERROR_CODES:
+                    raise
+                print(f"⚠️ [PromptCache] {label} 缓存句柄失效 ({code})，改用内联 Prompt")
+                self.invalidate(model, label)
+                with self._lock:
+                    self.stats["fallbacks"] += 1
+            else:
+                yield from self._drain(label, first, rest, True)
+                return
+        first, rest = self._open(model, [static_text, *parts, dynamic_text], config)
+        yield from self._drain(label, first, rest, False)
+
+    def _open(self, model, contents, config):
+        client = self.registry.client
+        return self.registry.gateway.call(
+            model, open_stream, client.models.generate_content_stream,
+            model=model, contents=contents, config=config,
+        )
+
+    def _drain(self, label, first, rest, cached):
+        start = time.perf_counter()
+        prompt_tokens = cached_tokens = 0
+        with span("prompt_cache.stream", label=label, cached=cached) as attrs:
+            chunks = rest if first is None else _prepend(first, rest)
+            for chunk in chunks:
+                # 用量统计只在最后几块里出现
+                usage = getattr(chunk, "usage_metadata", None)
+                if usage is not None:
+                    prompt_tokens = getattr(usage, "prompt_token_count", None) or prompt_tokens
+                    cached_tokens = getattr(usage, "cached_content_token_count", None) or cached_tokens
+                yield chunk
+            if attrs is not None:
+                attrs.update(prompt_tokens=prompt_tokens, cached_tokens=cached_tokens)
+        self._record(cached, time.perf_counter() - start, prompt_tokens, cached_tokens)
+
+    def _record(self, cached, elapsed, prompt_tokens, cached_tokens):
+        kind = "cached" if cached else "inline"
+        with self._lock:
+            self.stats[f"{kind}_calls"] += 1
+            self.stats[f"{kind}_seconds"] += elapsed
+            self.stats["prompt_tokens"] += prompt_tokens
+            self.stats["cached_tokens"] += cached_tokens
+
+    def _call(self, model, label, contents, config, cached):
+        client = self.registry.client
+        start = time.perf_counter()
+        with span("prompt_cache.call", label=label, cached=cached) as attrs:
+            response = self.registry.gateway.call(
+                model, client.models.generate_content,
+                model=model, contents=contents, config=config,
+            )
+            usage = getattr(response, "usage_metadata", None)
+            prompt_tokens = getattr(usage, "prompt_token_count", None) or 0
+            cached_tokens = getattr(usage, "cached_content_token_count", None) or 0
+            if attrs is not None:
+                attrs.update(prompt_tokens=prompt_tokens, cached_tokens=cached_tokens)
+        self._record(cached, time.perf_counter() - start, prompt_tokens, cached_tokens)
+        return response
+
+    def report(self):
+        s = self.stats
+        if not s["cached_calls"] and not s["inline_calls"]:
+            return "🧊 [PromptCache] 本次没有模型调用"
+        avg_cached = s["cached_seconds"] / s["cached_calls"] if s["cached_calls"] else 0.0
+        avg_inline = s["inline_seconds"] / s["inline_calls"] if s["inline_calls"] else 0.0
+        ratio = s["cached_tokens"] / s["prompt_tokens"] * 100 if s["prompt_tokens"] else 0.0
+        return (f"🧊 [PromptCache] 缓存调用 {s['cached_calls']} (平均 {avg_cached:.2f}s) | "
+                f"内联调用 {s['inline_calls']} (平均 {avg_inline:.2f}s) | "
+                f"缓存命中 {s['cached_tokens']}/{s['prompt_tokens']} 输入 token ({ratio:.0f}%) | "
+                f"创建 {s['creates']} / 续期 {s['refreshes']} / 回退 {s['fallbacks']}")
+
+
+def _prepend(first, rest):
+    yield first
+    yield from rest
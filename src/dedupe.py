@@ -0,0 +1,124 @@
+import os
+import numpy as np
+from src.utils import load_image_safe, import_pil
+from src.tracing import span
+
+# 两种哈希都是 64 bit: dHash 看相邻像素的明暗梯度，pHash 看低频 DCT 系数
+HASH_SIZE = 8
+PHASH_SIDE = 32
+
+
+def _dct_matrix(n):
+    """
+    正交 DCT-II 变换矩阵 (n x n)，对一批图片做 C @ X @ C.T 即得二维 DCT
+    """
+    k = np.arange(n)[:, None]
+    i = np.arange(n)[None, :]
+    m = np.cos(np.pi * (2 * i + 1) * k / (2 * n)) * np.sqrt(2.0 / n)
+    m[0] /= np.sqrt(2.0)
+    return m
+
+
+_DCT = _dct_matrix(PHASH_SIDE)
+# 每个 uint8 中 1 的个数，用查表实现向量化 popcount
+_POPCOUNT = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8)
+
+
+def thumbnails(image_paths):
+    """
+    读取每张图片并生成灰度缩略图 (每张只解码一次)，返回
+    (可读图片的路径, dHash 用的 N x 8 x 9, pHash 用的 N x 32 x 32, 无法读取的路径)；
+    全部无法读取时两组缩略图为 None
+    """
+    Image = import_pil()
+    readable, unreadable, small, large = [], [], [], []
+    for path in image_paths:
+        try:
+            gray = load_image_safe(path).convert("L")
+        except Exception as e:
+            print(f"⚠️ [Dedupe] 无法读取 {os.path.basename(path)}，单独处理: {e}")
+            unreadable.append(path)
+            continue
+        readable.append(path)
+        small.append(np.asarray(gray.resize((HASH_SIZE + 1, HASH_SIZE), Image.BILINEAR), dtype=np.float32))
+        large.append(np.asarray(gray.resize((PHASH_SIDE, PHASH_SIDE), Image.BILINEAR), dtype=np.float32))
+    if not readable:
+        return readable, None, None, unreadable
+    return readable, np.stack(small), np.stack(large), unreadable
+
+
+def dhash(small):
+    """
+    批量 dHash: 每行左右相邻像素比较 -> N x 64 bool
+    """
+    return (small[:, :, 1:] > small[:, :, :-1]).reshape(len(small), -1)
+
+
+def phash(large):
+    """
+    批量 pHash: 二维 DCT 取左上 8x8 低频块，与中位数比较 -> N x 64 bool
+    """
+    coeffs = np.einsum("ij,njk,lk->nil", _DCT, large, _DCT)[:, :HASH_SIZE, :HASH_SIZE]
+    flat = coeffs.reshape(len(large), -1)
+    # 直流分量 (0, 0) 只反映整体亮度，不参与中位数
+    median = np.median(flat[:, 1:], axis=1, keepdims=True)
+    return flat > median
+
+
+def pack_bits(bits):
+    """
+    N x 64 bool -> N x 8 uint8，方便批量 XOR + 查表求汉明距离
+    """
+    return np.packbits(bits, axis=1)
+
+
+def hamming_matrix(packed):
+    """
+    两两汉明距离 (N x N)
+    """
+    xor = packed[:, None, :] ^ packed[None, :, :]
+    return _POPCOUNT[xor].sum(axis=2, dtype=np.int32)
+
+
+class PerceptualIndex:
+    """
+    一批输入图片的感知哈希索引：
+        index = PerceptualIndex(paths)
+        groups = index.groups(threshold=8)   # [[代表图下标, 近似图下标...], ...]
+    - dHash 与 pHash 都在缩略图上批量计算 (numpy 向量化)
+    - 两张图的距离取两种哈希汉明距离中较大者，两种都接近才算近似重复
+    - 分组按输入顺序贪心: 每张图加入第一个与其“代表图”足够接近的组，不会链式串成大组
+    - 无法读取的图片不进索引 (paths 只含可读图片)，记录在 unreadable
+    """
+    def __init__(self, image_paths):
+        image_paths = list(image_paths)
+        with span("dedupe.hash", images=len(image_paths)):
+            self.paths, small, large, self.unreadable = thumbnails(image_paths)
+            if not self.paths:
+                self.distances = np.zeros((0, 0), dtype=np.int32)
+                return
+            self.dhashes = pack_bits(dhash(small))
+            self.phashes = pack_bits(phash(large))
+            self.distances = np.maximum(hamming_matrix(self.dhashes), hamming_matrix(self.phashes))
+
+    def groups(self, threshold=8):
+        leaders = []
+        members = {}
+        for i in range(len(self.paths)):
+            for leader in leaders:
+                if self.distances[leader, i] <= threshold:
+                    members[leader].append(i)
+                    break
+            else:
+                leaders.append(i)
+                members[i] = [i]
+        return [members[leader] for leader in leaders]
+
+
+def group_near_duplicates(image_paths, threshold=8):
+    """
+    返回 [[代表图路径, 近似图路径...], ...]；无法读取的图片各自单独成组
+    """
+    index = PerceptualIndex(image_paths)
+    groups = [[index.paths[i] for i in group] for group in index.groups(threshold)]
+    return groups + [[p] for p in index.unreadable]
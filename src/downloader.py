@@ -0,0 +1,194 @@
+import os
+import json
+import time
+import base64
+import hashlib
+from collections import namedtuple
+
+# 下载结果: 目标路径、字节数、耗时、断点续传次数
+DownloadResult = namedtuple("DownloadResult", ["path", "bytes", "seconds", "resumes"])
+
+# 网络中断类异常 (requests / urllib3)，按类名判断
+RESUMABLE_ERROR_NAMES = {
+    "ConnectionError", "ChunkedEncodingError", "ReadTimeout", "Timeout",
+    "ProtocolError", "IncompleteRead", "ConnectTimeout",
+}
+
+
+class DownloadError(Exception):
+    pass
+
+
+class IncompleteDownload(DownloadError):
+    """
+    连接提前结束，可以从断点续传
+    """
+
+
+def _parse_content_range_total(value):
+    # 例如 "bytes 1048576-5242879/5242880"
+    if value and "/" in value:
+        total = value.rsplit("/", 1)[1]
+        if total.isdigit():
+            return int(total)
+    return None
+
+
+def _parse_goog_md5(value):
+    # x-goog-hash: crc32c=xxxx, md5=base64
+    for item in (value or "").split(","):
+        key, _, digest = item.strip().partition("=")
+        if key == "md5" and digest:
+            return base64.b64decode(digest).hex()
+    return None
+
+
+def _validators(headers):
+    """
+    响应里能标识“同一个对象的同一个版本”的字段: ETag 与 GCS 的 x-goog-generation
+    """
+    return {"etag": headers.get("ETag") or headers.get("etag"),
+            "generation": headers.get("x-goog-generation")}
+
+
+def _load_part_meta(meta_path):
+    try:
+        with open(meta_path, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def _save_part_meta(meta_path, url, validators):
+    with open(meta_path, "w", encoding="utf-8") as f:
+        json.dump(dict(validators, url=url), f)
+
+
+def _discard_part(part_path, meta_path):
+    for path in (part_path, meta_path):
+        if os.path.exists(path):
+            os.remove(path)
+
+
+def _file_digests(path):
+    sha256, md5 = hashlib.sha256(), hashlib.md5()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            sha256.update(chunk)
+            md5.update(chunk)
+    return sha256.hexdigest(), md5.hexdigest()
+
+
+def download_file(session, url, dest_path, headers=None, chunk_size=1024 * 1024, max_attempts=5,
+                  timeout=60, expected_sha256=None):
+    """
+    流式下载到临时文件 (.part)，内存占用只有一个 chunk：
+    - 连接中断后用 HTTP Range 从已下载的位置继续
+    - .part 旁边的 .part.json 记录来源 URL 与 ETag / generation，续传时带 If-Range；
+      来源不同、对象已变化或无法验证时删除旧的 .part 从头下载，避免把两个文件拼在一起
+    - 下载完成后校验长度、服务端 md5 (x-goog-hash) 和可选的 sha256
+    - 校验通过才原子改名为目标文件
+    """
+    dest_dir = os.path.dirname(dest_path)
+    if dest_dir:
+        os.makedirs(dest_dir, exist_ok=True)
+    part_path = dest_path + ".part"
+    meta_path = part_path + ".json"
+    start = time.perf_counter()
+    total = None
+    expected_md5 = None
+    resumes = 0
+    attempt = 0
+
+    # 上次运行留下的 .part: 必须来自同一个 URL，且有 ETag 或 generation 可以验证，否则不能续传
+    validators = None
+    if os.path.exists(part_path):
+        meta = _load_part_meta(meta_path)
+        if meta and meta.get("url") == url and (meta.get("etag") or meta.get("generation")):
+            validators = {"etag": meta.get("etag"), "generation": meta.get("generation")}
+        else:
+            print("⚠️ [Download] 旧的临时文件来源无法确认，从头下载")
+            _discard_part(part_path, meta_path)
+
+    while True:
+        offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+        request_headers = dict(headers or {})
+        if offset:
+            request_headers["Range"] = f"bytes={offset}-"
+            if validators and validators.get("etag"):
+                # 对象变化时服务端返回完整的 200，而不是拼接一段新版本
+                request_headers["If-Range"] = validators["etag"]
+
+        try:
+            with session.get(url, headers=request_headers, stream=True, timeout=timeout) as response:
+                if response.status_code == 416 and offset:
+                    # 上次其实已经下完 (例如进程在改名前被中断)
+                    total = total or offset
+                    break
+                if response.status_code == 206:
+                    current = _validators(response.headers)
+                    changed = validators and any(validators[k] and current[k] and validators[k] != current[k]
+                                                 for k in ("etag", "generation"))
+                    if changed:
+                        _discard_part(part_path, meta_path)
+                        validators = None
+                        raise IncompleteDownload("服务端对象已变化，删除旧的临时文件后从头下载")
+                    total = _parse_content_range_total(response.headers.get("Content-Range")) or total
+                    mode = "ab"
+                elif response.status_code == 200:
+                    # 服务端不支持 Range 时只能从头再来
+                    if offset and "If-Range" in request_headers:
+                        print("⚠️ [Download] 服务端对象已变化 (If-Range 不匹配)，从头下载")
+                    elif offset:
+                        print("⚠️ [Download] 服务端不支持断点续传，从头下载")
+                    length = response.headers.get("Content-Length")
+                    total = int(length) if length and length.isdigit() else None
+                    offset, mode = 0, "wb"
+                    validators = _validators(response.headers)
+                    _save_part_meta(meta_path, url, validators)
+                else:
+                    raise DownloadError(f"下载失败，状态码: {response.status_code} {response.text[:200]}")
+
+                expected_md5 = _parse_goog_md5(response.headers.get("x-goog-hash")) or expected_md5
+                with open(part_path, mode) as f:
+                    for chunk in response.iter_content(chunk_size=chunk_size):
+                        if chunk:
+                            f.write(chunk)
+            if total is None or os.path.getsize(part_path) >= total:
+                break
+            raise IncompleteDownload(f"连接提前结束 ({os.path.getsize(part_path)}/{total} bytes)")
+
+        except Exception as e:
+            retryable = isinstance(e, IncompleteDownload) or any(
+                cls.__name__ in RESUMABLE_ERROR_NAMES for cls in type(e).__mro__
+            )
+            attempt += 1
+            if not retryable or attempt >= max_attempts:
+                raise
+            resumes += 1
+            delay = min(30, 2 ** attempt)
+            print(f"⏳ [Download] 连接中断 ({type(e).__name__})，{delay}s 后从断点续传 ({attempt}/{max_attempts})")
+            time.sleep(delay)
+
+    size = os.path.getsize(part_path)
+    if total is not None and size != total:
+        raise DownloadError(f"文件长度不符: {size} != {total}")
+    sha256, md5 = _file_digests(part_path)
+    if expected_md5 and md5 != expected_md5:
+        _discard_part(part_path, meta_path)
+        raise DownloadError("md5 校验失败，已删除损坏的临时文件")
+    if expected_sha256 and sha256 != expected_sha256:
+        _discard_part(part_path, meta_path)
+        raise DownloadError("sha256 校验失败，已删除损坏的临时文件")
+
+    os.replace(part_path, dest_path)
+    if os.path.exists(meta_path):
+        os.remove(meta_path)
+    seconds = time.perf_counter() - start
+    return DownloadResult(dest_path, size, seconds, resumes)
+
+
+def format_download(result):
+    mb = result.bytes / 1024 / 1024
+    speed = mb / result.seconds if result.seconds > 0 else 0.0
+    return f"{mb:.1f} MB, {result.seconds:.1f}s, {speed:.2f} MB/s, 续传 {result.resumes} 次"
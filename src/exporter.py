@@ -0,0 +1,183 @@
+import os
+import time
+import hashlib
+import threading
+from collections import namedtuple
+from src.utils import file_sha256, atomic_write_bytes, import_pil, load_settings, process_pool
+from src.manifest import get_manifest
+from src.catalog import get_catalog
+
+# 设备规格: 目标像素尺寸 + 编码格式与质量
+ExportProfile = namedtuple("ExportProfile", ["name", "width", "height", "format", "quality"])
+
+DEFAULT_PROFILES = {
+    "phone": ExportProfile("phone", 1179, 2556, "WEBP", 90),
+    "tablet": ExportProfile("tablet", 2048, 2732, "WEBP", 90),
+    "desktop": ExportProfile("desktop", 2560, 1440, "JPEG", 92),
+    "4k": ExportProfile("4k", 3840, 2160, "PNG", 0),
+}
+
+FORMAT_EXT = {"PNG": "png", "WEBP": "webp", "JPEG": "jpg"}
+
+
+def load_export_profiles(settings=None):
+    """
+    读取 settings.yaml -> export.profiles，未配置时使用 DEFAULT_PROFILES
+    """
+    if settings is None:
+        settings = load_settings().get("export", {})
+    configured = settings.get("profiles")
+    if not configured:
+        return dict(DEFAULT_PROFILES)
+    profiles = {}
+    for name, spec in configured.items():
+        fmt = spec.get("format", "WEBP").upper()
+        if fmt not in FORMAT_EXT:
+            raise ValueError(f"❌ 不支持的导出格式: {fmt} ({name})")
+        profiles[name] = ExportProfile(name, int(spec["width"]), int(spec["height"]), fmt,
+                                       int(spec.get("quality", 90)))
+    return profiles
+
+
+def variant_path(source_path, profile):
+    """
+    变体与原图放在同一输出目录: xxx_gen_style_hash.png -> xxx_gen_style_hash@phone.webp
+    """
+    root = os.path.splitext(source_path)[0]
+    return f"{root}@{profile.name}.{FORMAT_EXT[profile.format]}"
+
+
+def variant_key(source_path, profile):
+    """
+    变体的清单 Key: 原图内容 + 规格参数，任何一项变化都会重新导出
+    """
+    raw = f"export|{file_sha256(source_path)}|{tuple(profile)}"
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+def render_variant(source_path, output_path, width, height, fmt, quality):
+    """
+    [子进程] 居中裁切到目标宽高比并缩放到目标尺寸，编码后原子写入
+    """
+    start = time.perf_counter()
+    Image = import_pil()
+    from PIL import ImageOps
+    from io import BytesIO
+
+    with Image.open(source_path) as img:
+        img.load()
+        if fmt == "JPEG" and img.mode not in ("RGB", "L"):
+            img = img.convert("RGB")
+        elif img.mode not in ("RGB", "RGBA", "L"):
+            img = img.convert("RGBA" if "A" in img.getbands() else "RGB")
+        # cover 模式: 先按比例裁掉多余部分，再一次 LANCZOS 缩放
+        fitted = ImageOps.fit(img, (width, height), method=Image.LANCZOS, centering=(0.5, 0.5))
+
+    buffered = BytesIO()
+    if fmt == "PNG":
+        fitted.save(buffered, format="PNG", compress_level=6)
+    elif fmt == "WEBP":
+        fitted.save(buffered, format="WEBP", quality=quality, method=4)
+    else:
+        fitted.save(buffered, format="JPEG", quality=quality, optimize=True, progressive=True)
+    data = buffered.getvalue()
+    atomic_write_bytes(output_path, data)
+    return {"output": output_path, "bytes": len(data), "seconds": time.perf_counter() - start}
+
+
+class VariantExporter:
+    """
+    多分辨率导出阶段：每生成一张壁纸就提交 (原图 x 设备规格) 个任务到进程池。
+    - 裁切/缩放/编码都是 CPU 密集型，放在子进程里不占用主进程的 GIL
+    - 已导出且原图与规格都没变的变体 (记录在输出目录的 manifest.json) 直接跳过
+    - submit() 立即返回，close() 等待所有任务完成并打印统计
+    """
+    def __init__(self, profiles=None, names=None, workers=None):
+        profiles = profiles or load_export_profiles()
+        if names:
+            unknown = [n for n in names if n not in profiles]
+            if unknown:
+                raise ValueError(f"❌ 未知的导出规格: {', '.join(unknown)} (可选: {', '.join(profiles)})")
+            profiles = {n: profiles[n] for n in names}
+        self.profiles = profiles
+        self.workers = workers or os.cpu_count()
+        # 进程池在构造时创建 (绘图线程启动之前)，子进程由 forkserver 派生，不继承线程持有的锁
+        self._pool = process_pool(self.workers)
+        self._pending = 0
+        self._lock = threading.Lock()
+        # 回调 (写清单、计数) 完成后才算任务结束，wait() 等的是这个条件
+        self._idle = threading.Condition(self._lock)
+        self.stats = {"exported": 0, "skipped": 0, "failed": 0, "bytes": 0, "cpu_seconds": 0.0}
+        self._start = None
+
+    def _ensure_pool(self):
+        with self._lock:
+            if self._pool is None:
+                raise RuntimeError("❌ 导出器已关闭")
+            if self._start is None:
+                self._start = time.perf_counter()
+            return self._pool
+
+    def submit(self, source_path):
+        """
+        为一张壁纸提交所有规格的导出任务 (不等待)
+        """
+        manifest = get_manifest(os.path.dirname(source_path))
+        for profile in self.profiles.values():
+            output_path = variant_path(source_path, profile)
+            key = variant_key(source_path, profile)
+            if manifest.lookup(key):
+                with self._lock:
+                    self.stats["skipped"] += 1
+                continue
+            pool = self._ensure_pool()
+            with self._lock:
+                self._pending += 1
+            future = pool.submit(
+                render_variant, source_path, output_path, profile.width, profile.height,
+                profile.format, profile.quality,
+            )
+            future.add_done_callback(lambda f, k=key, p=profile, s=source_path: self._on_done(f, k, p, s))
+
+    def _on_done(self, future, key, profile, source_path):
+        try:
+            info = future.result()
+            get_manifest(os.path.dirname(source_path)).record(
+                key, info["output"], kind="export", profile=profile.name, source=os.path.basename(source_path))
+            get_catalog().record(info["output"], "export", parent=source_path, width=profile.width,
+                                 height=profile.height, bytes=info["bytes"], profile=profile.name,
+                                 format=profile.format)
+            with self._lock:
+                self.stats["exported"] += 1
+                self.stats["bytes"] += info["bytes"]
+                self.stats["cpu_seconds"] += info["seconds"]
+        except Exception as e:
+            print(f"❌ [Export] {os.path.basename(source_path)} -> {profile.name} 失败: {e}")
+            with self._lock:
+                self.stats["failed"] += 1
+        finally:
+            with self._idle:
+                self._pending -= 1
+                self._idle.notify_all()
+
+    def wait(self):
+        with self._idle:
+            self._idle.wait_for(lambda: self._pending == 0)
+
+    def close(self):
+        """
+        等待所有导出任务完成、关闭进程池并打印统计
+        """
+        self.wait()
+        with self._lock:
+            pool, self._pool = self._pool, None
+        if pool is not None:
+            pool.shutdown()
+        print(self.report())
+
+    def report(self):
+        s = self.stats
+        wall = time.perf_counter() - self._start if self._start else 0.0
+        return (f"🖨️ [Export] 导出 {s['exported']} 个变体 ({s['bytes'] / 1024 / 1024:.1f} MB) | 跳过 {s['skipped']} | "
+                f"失败 {s['failed']} | CPU {s['cpu_seconds']:.2f}s / 墙钟 {wall:.2f}s "
+                f"({len(self.profiles)} 种规格, {self.workers} 进程)")
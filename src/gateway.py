@@ -0,0 +1,320 @@
+import re
+import time
+import random
+import threading
+from collections import deque
+from concurrent.futures import Future, TimeoutError as FutureTimeout, wait, FIRST_COMPLETED
+from src.utils import load_settings
+from src.tracing import span, percentile
+
+# 可重试的 HTTP 状态码: 限流 + 服务端临时错误
+RETRYABLE_CODES = {408, 429, 500, 502, 503, 504}
+# 网络层异常 (requests / httpx)，按类名判断，避免在这里引入具体库
+RETRYABLE_ERROR_NAMES = {
+    "ConnectionError", "ConnectTimeout", "ReadTimeout", "Timeout", "TimeoutError",
+    "ConnectError", "ReadError", "RemoteProtocolError", "PoolTimeout", "ChunkedEncodingError",
+}
+
+
+class TokenBucket:
+    """
+    令牌桶限流：每秒补充 rate 个令牌，最多积攒 capacity 个
+    """
+    def __init__(self, rate_per_minute, capacity=None):
+        self.rate = rate_per_minute / 60.0
+        self.capacity = capacity or max(1, rate_per_minute // 10)
+        self.tokens = float(self.capacity)
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """
+        取一个令牌，不够时阻塞等待；返回等待的秒数
+        """
+        waited = 0.0
+        while True:
+            with self._lock:
+                self._refill_locked()
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return waited
+                delay = (1 - self.tokens) / self.rate
+            time.sleep(delay)
+            waited += delay
+
+    def try_acquire(self):
+        """
+        有令牌时取一个并返回 True，没有时立即返回 False (不等待)
+        """
+        with self._lock:
+            self._refill_locked()
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return True
+            return False
+
+    def _refill_locked(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def penalize(self, seconds):
+        """
+        收到 429 时清空令牌，让同模型的其他线程也一起退避
+        """
+        with self._lock:
+            self.tokens = min(self.tokens, -seconds * self.rate)
+
+
+class CallGateway:
+    """
+    所有 client.models.* / client.operations.* 调用的统一出口：
+    - 按模型的令牌桶限流 (rpm) 与并发上限 (concurrency)
+    - 429 / 5xx / 网络错误自动重试：指数退避 + 随机抖动，优先遵守服务端给的重试提示
+    - 重试耗尽后抛出最后一次异常，由调用方决定是否走保底逻辑
+    - hedged_call(): 调用超过该模型近期耗时的分位数仍未返回时，再发一个相同请求，先成功的为准
+    """
+    def __init__(self, settings=None):
+        if settings is None:
+            settings = load_settings().get("gateway", {})
+        self.max_retries = settings.get("max_retries", 5)
+        self.base_delay = settings.get("base_delay", 2.0)
+        self.max_delay = settings.get("max_delay", 60.0)
+        self.default_limit = settings.get("default", {"rpm": 60, "concurrency": 4})
+        self.model_limits = settings.get("models", {})
+
+        # 对冲请求 (hedging): 默认关闭；额外请求数不超过可对冲调用的 max_extra_pct%
+        hedging = settings.get("hedging", {})
+        self.hedge_enabled = hedging.get("enabled", False)
+        self.hedge_percentile = hedging.get("percentile", 95)
+        self.hedge_min_samples = hedging.get("min_samples", 20)
+        self.hedge_min_delay = hedging.get("min_delay", 5.0)
+        self.hedge_max_extra_pct = hedging.get("max_extra_pct", 10)
+        self.hedge_window = hedging.get("window", 200)
+        self._latencies = {}   # model -> 最近成功调用的耗时 (秒)
+        self.hedge_stats = {"eligible": 0, "hedged": 0, "hedge_wins": 0, "primary_wins": 0,
+                            "budget_skipped": 0, "busy_skipped": 0, "both_failed": 0}
+
+        self._buckets = {}
+        self._semaphores = {}
+        self._lock = threading.Lock()
+        self.stats = {"calls": 0, "retries": 0, "failures": 0, "throttled_seconds": 0.0}
+
+    def _limits_for(self, model):
+        with self._lock:
+            if model not in self._buckets:
+                limit = dict(self.default_limit, **self.model_limits.get(model, {}))
+                self._buckets[model] = TokenBucket(limit["rpm"])
+                self._semaphores[model] = threading.BoundedSemaphore(limit["concurrency"])
+            return self._buckets[model], self._semaphores[model]
+
+    @staticmethod
+    def status_code(error):
+        for attr in ("code", "status_code"):
+            value = getattr(error, attr, None)
+            if isinstance(value, int):
+                return value
+        response = getattr(error, "response", None)
+        value = getattr(response, "status_code", None)
+        return value if isinstance(value, int) else None
+
+    def is_retryable(self, error):
+        code = self.status_code(error)
+        if code is not None:
+            return code in RETRYABLE_CODES
+        return any(cls.__name__ in RETRYABLE_ERROR_NAMES for cls in type(error).__mro__)
+
+    @staticmethod
+    def retry_hint(error):
+        """
+        读取服务端的重试提示 (Retry-After 头 或 google.rpc.RetryInfo.retryDelay)，单位秒
+        """
+        response = getattr(error, "response", None)
+        headers = getattr(response, "headers", None) or {}
+        try:
+            retry_after = headers.get("retry-after") or headers.get("Retry-After")
+            if retry_after:
+                return float(retry_after)
+        except (TypeError, ValueError, AttributeError):
+            pass
+
+        # APIError.details 里的 RetryInfo，例如 {"retryDelay": "12s"}
+        match = re.search(r"retryDelay['\"]?\s*[:=]\s*['\"]?(\d+(?:\.\d+)?)s",
+                          str(getattr(error, "details", "") or error))
+        return float(match.group(1)) if match else None
+
+    def _backoff(self, attempt, error):
+        hint = self.retry_hint(error)
+        if hint is not None:
+            return min(self.max_delay, hint) + random.uniform(0, 1)
+        # Full jitter: [0, base * 2^attempt]
+        return random.uniform(0, min(self.max_delay, self.base_delay * (2 ** attempt)))
+
+    def call(self, model, fn, /, *args, **kwargs):
+        """
+        通过网关执行一次模型调用: gateway.call("gemini-2.5-flash", client.models.generate_content, model=..., ...)
+        model / fn 只能按位置传入，调用方的 model=... 关键字会原样转发给 SDK：
+        >>> CallGateway({}).call("gemini-2.5-flash", lambda **kw: kw["model"], model="gemini-2.5-flash")
+        'gemini-2.5-flash'
+        """
+        return self._call(model, fn, args, kwargs)
+
+    def _call(self, model, fn, args, kwargs, started=None, reserved=False):
+        """
+        call() 的实现。
+        - started: 每次拿到令牌与并发名额、真正开始执行 fn 时 set 的 Event (对冲计时的起点)
+        - reserved: 第一次尝试的令牌与并发名额已由调用方取得 (对冲请求)
+        """
+        bucket, semaphore = self._limits_for(model)
+        attempt = 0
+        while True:
+            if reserved:
+                waited, reserved = 0.0, False
+            else:
+                waited = bucket.acquire()
+                semaphore.acquire()
+            with self._lock:
+                self.stats["calls"] += 1
+                self.stats["throttled_seconds"] += waited
+            try:
+                try:
+                    with span(f"model.{getattr(fn, '__name__', 'call')}", model=model, attempt=attempt):
+                        if started is not None:
+                            started.set()
+                        start = time.perf_counter()
+                        result = fn(*args, **kwargs)
+                finally:
+                    # 退避等待期间不占用并发名额
+                    semaphore.release()
+                self._record_latency(model, time.perf_counter() - start)
+                return result
+            except Exception as e:
+                if attempt >= self.max_retries or not self.is_retryable(e):
+                    with self._lock:
+                        self.stats["failures"] += 1
+                    raise
+                delay = self._backoff(attempt, e)
+                if self.status_code(e) == 429:
+                    bucket.penalize(delay)
+                attempt += 1
+                with self._lock:
+                    self.stats["retries"] += 1
+                print(f"⏳ [Gateway] {model} 调用失败 ({type(e).__name__}: {self.status_code(e) or '-'})，"
+                      f"{delay:.1f}s 后第 {attempt}/{self.max_retries} 次重试")
+                time.sleep(delay)
+
+    # ------------------------------------------------------------------
+    # 对冲请求
+    # ------------------------------------------------------------------
+    def _record_latency(self, model, seconds):
+        with self._lock:
+            window = self._latencies.get(model)
+            if window is None:
+                window = self._latencies[model] = deque(maxlen=self.hedge_window)
+            window.append(seconds)
+
+    def hedge_delay(self, model):
+        """
+        当前模型的对冲阈值: 近期成功调用耗时的 percentile 分位数 (不低于 min_delay)；
+        未开启或样本不足时返回 None
+        """
+        if not self.hedge_enabled:
+            return None
+        with self._lock:
+            samples = sorted(self._latencies.get(model, ()))
+        if len(samples) < self.hedge_min_samples:
+            return None
+        return max(self.hedge_min_delay, percentile(samples, self.hedge_percentile))
+
+    def _reserve_hedge(self, model):
+        """
+        发出对冲前的检查: 额外请求在预算内，且该模型此刻有空闲的并发名额与令牌。
+        对冲请求不排队 (排在同一个队列里不可能比原请求更快)；成功时名额与令牌已占用，交给对冲请求
+        """
+        bucket, semaphore = self._limits_for(model)
+        with self._lock:
+            if self.hedge_stats["hedged"] + 1 > self.hedge_stats["eligible"] * self.hedge_max_extra_pct / 100:
+                self.hedge_stats["budget_skipped"] += 1
+                return False
+        if not semaphore.acquire(blocking=False):
+            with self._lock:
+                self.hedge_stats["busy_skipped"] += 1
+            return False
+        if not bucket.try_acquire():
+            semaphore.release()
+            with self._lock:
+                self.hedge_stats["busy_skipped"] += 1
+            return False
+        with self._lock:
+            self.hedge_stats["hedged"] += 1
+        return True
+
+    @staticmethod
+    def _spawn(fn, *args, **kwargs):
+        # 独立的守护线程: 输掉的请求无法中断 HTTP 调用，只能让它跑完后丢弃结果
+        future = Future()
+
+        def runner():
+            try:
+                future.set_result(fn(*args, **kwargs))
+            except BaseException as e:
+                future.set_exception(e)
+
+        threading.Thread(target=runner, name="hedge", daemon=True).start()
+        return future
+
+    def hedged_call(self, model, fn, /, *args, **kwargs):
+        """
+        与 call() 相同，但超过 hedge_delay(model) 仍未返回时发出一个重复请求 (受预算限制)，
+        两个请求中先成功的结果被采用，另一个的结果被忽略；两个都失败时抛出原请求的异常
+        """
+        delay = self.hedge_delay(model)
+        if delay is None:
+            return self.call(model, fn, *args, **kwargs)
+        with self._lock:
+            self.hedge_stats["eligible"] += 1
+
+        started = threading.Event()
+        primary = self._spawn(self._call, model, fn, args, kwargs, started)
+        primary.add_done_callback(lambda _: started.set())
+        # 在令牌桶 / 并发队列里等待的时间不算慢: 计时从 fn 真正开始执行时算起 (与 hedge_delay 的样本口径一致)
+        started.wait()
+        try:
+            return primary.result(timeout=delay)
+        except FutureTimeout:
+            pass
+        if not self._reserve_hedge(model):
+            return primary.result()
+
+        print(f"🪁 [Gateway] {model} 调用超过 {delay:.1f}s (p{self.hedge_percentile})，发出对冲请求")
+        with span("gateway.hedge", model=model, delay=round(delay, 2)) as attrs:
+            hedge = self._spawn(self._call, model, fn, args, kwargs, None, True)
+            pending = {primary, hedge}
+            while pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    if future.exception() is None:
+                        winner = "hedge" if future is hedge else "primary"
+                        with self._lock:
+                            self.hedge_stats[f"{winner}_wins"] += 1
+                        if attrs is not None:
+                            attrs["winner"] = winner
+                        return future.result()
+            with self._lock:
+                self.hedge_stats["both_failed"] += 1
+            raise primary.exception()
+
+    def report(self):
+        s = self.stats
+        line = (f"🚦 [Gateway] 调用 {s['calls']} 次 | 重试 {s['retries']} | 最终失败 {s['failures']} | "
+                f"限流等待 {s['throttled_seconds']:.1f}s")
+        h = self.hedge_stats
+        if self.hedge_enabled and h["eligible"]:
+            win_rate = h["hedge_wins"] / h["hedged"] * 100 if h["hedged"] else 0.0
+            line += (f"\n🪁 [Gateway] 对冲 {h['hedged']}/{h['eligible']} 次调用 "
+                     f"(预算 {self.hedge_max_extra_pct}%，超预算跳过 {h['budget_skipped']}，"
+                     f"无空闲名额跳过 {h['busy_skipped']}) | "
+                     f"对冲胜出 {h['hedge_wins']} ({win_rate:.0f}%) / 原请求胜出 {h['primary_wins']} / "
+                     f"均失败 {h['both_failed']}")
+        return line
+
@@ -1,23 +1,29 @@
 import os
-import time
-import json
-import base64
-import requests
-from google import genai
-from google.genai import types
-from dotenv import load_dotenv
-from src.utils import load_image_safe
-load_dotenv()
+import hashlib
+from src.payload import payload_preparer
+from src.utils import file_sha256, atomic_write_bytes
+from src.manifest import get_manifest, make_job_key, hash_text
+from src.catalog import get_catalog
+from src.clients import get_registry
+from src.tracing import span
 
 class ImageGenerator:
-    def __init__(self):
-        self.google_api_key = os.getenv("GOOGLE_API_KEY")
+    def __init__(self, registry=None, exporter=None):
+        # 共享的客户端注册表 (连接池 + 调用网关)，可注入假客户端
+        self.registry = registry or get_registry()
+        self.google_api_key = self.registry.api_key
         self.sd_api_url = os.getenv("SD_API_URL") 
-        
-        if self.google_api_key:
-            self.client = genai.Client(api_key=self.google_api_key)
-            self.imagen_model = "imagen-4.0-generate-001" 
-            self.vision_model = "gemini-3-pro-image-preview"
+        # 统一调用网关 (限流 + 重试)
+        self.gateway = self.registry.gateway
+        self.imagen_model = "imagen-4.0-generate-001" 
+        self.vision_model = "gemini-3-pro-image-preview"
+        # 可选的多分辨率导出阶段 (VariantExporter)，每张壁纸保存后立即提交
+        self.exporter = exporter
+
+    @property
+    def client(self):
+        # 首次调用模型时才创建 (并导入) GenAI 客户端
+        return self.registry.client if self.registry.available else None
 
     def generate(self, image_path, prompt_data):
         """
@@ -29,11 +35,23 @@ class ImageGenerator:
         # 构造完整的 Prompt
         full_prompt = f"{prompt_data['prompt']} --no {prompt_data.get('negative_prompt', 'text, watermark')}"
         
+        job = self._prepare_job(image_path, style_key, prompt_data.get('creativity', 'Medium'),
+                                self.imagen_model, full_prompt)
+        done_path = job["manifest"].lookup(job["key"])
+        if done_path:
+            print(f"⏭️ [跳过] 已生成过: {done_path}")
+            self._catalog(done_path, "Imagen4", job, backfill=True)
+            self._export(done_path)
+            return done_path
+
         print(f"🎨 [Generator] 启动 Imagen 4 绘制: {style_name}")
         
         try:
+            from google.genai import types
+
             # 调用 Google Imagen 4
-            response = self.client.models.generate_images(
+            response = self.gateway.hedged_call(
+                self.imagen_model, self.client.models.generate_images,
                 model=self.imagen_model,
                 prompt=full_prompt,
                 config=types.GenerateImagesConfig(
@@ -44,38 +62,8 @@ class ImageGenerator:
                 )
             )
 
-            if response.generated_images:
-                image_bytes = response.generated_images[0].image.image_bytes
-                
-                # --- 核心修改：动态计算输出路径 ---
-                # 1. 获取原图所在的目录 (例如 assets/inputs/2Dog)
-                input_dir = os.path.dirname(image_path)
-                # 如果是直接传文件名，dirname可能是空的，设为当前目录
-                if not input_dir: 
-                    input_dir = "."
-                base_output_dir = input_dir.replace("inputs", "outputs")
-
-                # 2. 获取原文件名 (不带后缀，例如 2Dog_2)
-                base_name = os.path.splitext(os.path.basename(image_path))[0]
-                output_dir = os.path.join(base_output_dir, base_name)
-                os.makedirs(output_dir, exist_ok=True)
-                # 3. 拼接新文件名: 原名_gen_风格_时间戳.png
-                timestamp = int(time.time())
-
-                new_filename = f"{base_name}_gen_{style_key}_{timestamp}.png"
-                save_path = os.path.join(output_dir, new_filename)
-                
-                # -------------------------------
-                
-                # 保存文件
-                with open(save_path, "wb") as f:
-                    f.write(image_bytes)
-                
-                print(f"✅ [成功] 壁纸已保存: {save_path}")
-                return save_path
-            else:
-                print("❌ [失败] Imagen 模型未返回图片")
-                return None
+            with span("generator.save", style=style_key, engine="Imagen4"):
+                return self._save_response_image(response, image_path, style_key, engine_tag="Imagen4", job=job)
 
         except Exception as e:
             print(f"❌ [异常] Google 绘图失败: {e}")
@@ -89,13 +77,6 @@ class ImageGenerator:
         # 🔥 获取 Analyzer 决定的创造力等级 (默认为 Medium)
         creativity = prompt_data.get('creativity', 'Medium') 
         
-        print(f"📥 [Gemini Vision] 读取参考图: {os.path.basename(image_path)}")
-        try:
-            ref_image = load_image_safe(image_path)
-        except Exception as e:
-            print(f"❌ 图片加载失败: {e}")
-            return None
-
         # 🔥 核心：动态构建指令 (模拟 Denoising Strength)
         if creativity == "Low":
             instruction = "STRICTLY maintain the original image's structure, pose, and geometry. Only change the lighting and art style texture. Do not add or remove objects."
@@ -116,23 +97,73 @@ class ImageGenerator:
         Negative Prompt: {prompt_data.get('negative_prompt', 'low quality')}
         """
         
+        print(f"📥 [Gemini Vision] 读取参考图: {os.path.basename(image_path)}")
+        try:
+            job = self._prepare_job(image_path, style_key, creativity, self.vision_model, full_prompt)
+            done_path = job["manifest"].lookup(job["key"])
+            if done_path:
+                print(f"⏭️ [跳过] 已生成过: {done_path}")
+                self._catalog(done_path, "GeminiVision", job, backfill=True)
+                self._export(done_path)
+                return done_path
+
+            # 参考图按模型输入上限准备 (合规的 JPEG/PNG 原样透传)
+            ref_image = payload_preparer.to_part(image_path, "reference")
+        except Exception as e:
+            print(f"❌ 图片加载失败: {e}")
+            return None
+
         print(f"🎨 [Gemini] 绘制: {style_name} (重绘策略: {creativity})")
 
         try:
             # 去掉 mime_type 限制，让模型自由发挥
-            response = self.client.models.generate_content(
+            # 绘图耗时长尾明显: 开启 hedging 时慢请求会被对冲 (见 settings.yaml gateway.hedging)
+            response = self.gateway.hedged_call(
+                self.vision_model, self.client.models.generate_content,
                 model=self.vision_model,
                 contents=[ref_image, full_prompt]
             )
-            return self._save_response_image(response, image_path, style_key,engine_tag="GeminiVision")
+            with span("generator.save", style=style_key, engine="GeminiVision"):
+                return self._save_response_image(response, image_path, style_key, engine_tag="GeminiVision", job=job)
 
         except Exception as e:
             print(f"❌ [失败] {e}")
             return None
 
-    def _save_response_image(self, response, original_image_path, style_key, engine_tag):
+    @staticmethod
+    def _output_dir_for(original_image_path):
+        """
+        输出目录: 原图所在目录 (inputs -> outputs) / 原文件名
+        """
+        file_stem = os.path.splitext(os.path.basename(original_image_path))[0]
+        input_dir = os.path.dirname(original_image_path)
+        base_output_path = input_dir.replace("inputs", "outputs")
+        return os.path.join(base_output_path, file_stem)
+
+    def _prepare_job(self, image_path, style_key, creativity, model_name, full_prompt):
+        """
+        计算任务 Key 并取出对应输出目录的清单，用于跳过已完成的任务
+        """
+        # Imagen 纯文生图时原图可能不存在，退化为按路径区分
+        input_hash = file_sha256(image_path) if os.path.exists(image_path) else hash_text(image_path)
+        prompt_hash = hash_text(f"{model_name}\n{full_prompt}")
+        return {
+            "key": make_job_key(input_hash, style_key, creativity, prompt_hash),
+            "manifest": get_manifest(self._output_dir_for(image_path)),
+            "info": {
+                "input_hash": input_hash,
+                "input_path": image_path,
+                "style_key": style_key,
+                "creativity": creativity,
+                "prompt_hash": prompt_hash,
+            },
+        }
+
+    def _save_response_image(self, response, original_image_path, style_key, engine_tag, job=None):
         """
         统一的保存逻辑：Input目录 -> Output目录
+        文件名由内容派生 (任务 Key 或图片哈希)，重跑同一任务得到同一文件名，
+        并发任务之间也不会因为时间戳相同而互相覆盖。
         """
         image_bytes = None
 
@@ -152,19 +183,47 @@ class ImageGenerator:
 
         # --- 路径计算 (Inputs -> Outputs) ---
         file_stem = os.path.splitext(os.path.basename(original_image_path))[0]
-        input_dir = os.path.dirname(original_image_path)
-        base_output_path = input_dir.replace("inputs", "outputs")
-        final_output_dir = os.path.join(base_output_path, file_stem)
-        
-        os.makedirs(final_output_dir, exist_ok=True)
-        
-        timestamp = int(time.time())
-        new_filename = f"{file_stem}_gen_{style_key}_{timestamp}.png"
+        final_output_dir = self._output_dir_for(original_image_path)
+
+        digest = job["key"] if job else hashlib.sha256(image_bytes).hexdigest()
+        new_filename = f"{file_stem}_gen_{style_key}_{digest[:12]}.png"
         save_path = os.path.join(final_output_dir, new_filename)
         # -----------------------------------
 
-        with open(save_path, "wb") as f:
-            f.write(image_bytes)
+        # 先写临时文件再改名，避免中断后留下半张图
+        atomic_write_bytes(save_path, image_bytes)
+        if job:
+            job["manifest"].record(job["key"], save_path, engine=engine_tag, **job["info"])
+        self._catalog(save_path, engine_tag, job, style_key=style_key, source_path=original_image_path)
         
         print(f"✅ [成功] 已保存: {save_path}")
-        return save_path
\ No newline at end of file
+        self._export(save_path)
+        return save_path
+
+    @staticmethod
+    def _catalog(save_path, engine_tag, job, backfill=False, **fields):
+        """
+        把壁纸登记到资产目录 (src/catalog.py)；backfill=True 时只补登目录里还没有的旧产物
+        """
+        try:
+            catalog = get_catalog()
+            if backfill and catalog.lookup(save_path) is not None:
+                return
+            if job:
+                info = job["info"]
+                fields.update(source_path=info["input_path"], source_hash=info["input_hash"],
+                              style_key=info["style_key"], creativity=info["creativity"],
+                              prompt_hash=info["prompt_hash"], job_key=job["key"])
+            catalog.record(save_path, "wallpaper", engine=engine_tag, **fields)
+        except Exception as e:
+            # 目录只是索引，写入失败不影响出图
+            print(f"⚠️ [Catalog] 登记失败: {e}")
+
+    def _export(self, save_path):
+        if self.exporter is None:
+            return
+        try:
+            self.exporter.submit(save_path)
+        except Exception as e:
+            # 导出失败不影响主流程，原始 PNG 已经保存
+            print(f"⚠️ [Export] 提交导出任务失败: {e}")
\ No newline at end of file
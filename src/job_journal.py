@@ -0,0 +1,332 @@
+import os
+import time
+import socket
+import sqlite3
+import threading
+from collections import namedtuple
+
+# 任务状态
+PENDING, RUNNING, DONE, FAILED = "pending", "running", "done", "failed"
+
+# 一行绘制任务 (jobs 表)
+Job = namedtuple("Job", ["id", "input", "style_key", "creativity", "description", "state", "attempts",
+                         "output", "error"])
+
+_JOB_COLUMNS = ("jobs.id, jobs.input, jobs.style_key, jobs.creativity, inputs.description, jobs.state, "
+                "jobs.attempts, jobs.output, jobs.error")
+
+
+def worker_id():
+    """
+    当前进程的 worker 标识: 主机名:PID (同一主机上可据此判断进程是否还活着)
+    """
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+def _pid_alive(pid):
+    if os.name == "nt":
+        # Windows 上 os.kill(pid, 0) 会直接结束目标进程，这里改用 OpenProcess 查询
+        import ctypes
+        kernel32 = ctypes.windll.kernel32
+        handle = kernel32.OpenProcess(0x1000, False, pid)  # PROCESS_QUERY_LIMITED_INFORMATION
+        if not handle:
+            return kernel32.GetLastError() == 5  # ERROR_ACCESS_DENIED: 进程存在但无权查询
+        try:
+            code = ctypes.c_ulong()
+            if not kernel32.GetExitCodeProcess(handle, ctypes.byref(code)):
+                return True
+            return code.value == 259  # STILL_ACTIVE
+        finally:
+            kernel32.CloseHandle(handle)
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+class JobJournal:
+    """
+    批量任务的持久化日志 (本地 SQLite)，崩溃后可以从中断处继续：
+    - inputs 表: 每张输入照片一行，分析完成后写入 description (为空 = 还没分析)
+    - jobs 表: 每个 (照片, style_key, creativity) 一行，状态 pending -> running -> done / failed
+    - claim() 在 BEGIN IMMEDIATE 事务里“查一行 + 标记 running”，多个进程同时领取也不会拿到同一任务
+    - running 任务带租约 (lease_seconds)，领取它的进程崩溃后租约到期即可被其他 worker 重新领取；
+      进程存活期间后台线程每 lease_seconds / 3 续租一次，绘制耗时超过租约也不会被别人重复领取
+    - 不开启 WAL: 回滚日志模式只依赖文件锁，数据库放在共享文件系统上时多台机器也能一起消费
+    """
+    def __init__(self, db_path=".cache/jobs.sqlite3", lease_seconds=900, max_attempts=3):
+        self.db_path = db_path
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self.worker = worker_id()
+        self._held = set()     # 本进程持有、尚未完成的任务 id (续租对象)
+        self._held_lock = threading.Lock()
+        self._heartbeat = None
+
+        db_dir = os.path.dirname(db_path)
+        if db_dir:
+            os.makedirs(db_dir, exist_ok=True)
+        with self._transaction() as conn:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS inputs (
+                    input TEXT PRIMARY KEY,
+                    top_k INTEGER NOT NULL,
+                    description TEXT,
+                    reasoning TEXT,
+                    created_at REAL NOT NULL,
+                    analyzed_at REAL
+                )
+            """)
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS jobs (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    input TEXT NOT NULL REFERENCES inputs(input),
+                    style_key TEXT NOT NULL,
+                    creativity TEXT NOT NULL,
+                    state TEXT NOT NULL DEFAULT 'pending',
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    worker TEXT,
+                    lease_until REAL,
+                    output TEXT,
+                    error TEXT,
+                    updated_at REAL NOT NULL,
+                    UNIQUE (input, style_key, creativity)
+                )
+            """)
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_jobs_state ON jobs(state, id)")
+
+    def _connect(self):
+        # 每次操作新建连接：绘制线程并发访问；isolation_level=None 以便手动控制事务
+        return sqlite3.connect(self.db_path, timeout=60, isolation_level=None)
+
+    def _transaction(self):
+        return _Transaction(self._connect())
+
+    # ------------------------------------------------------------------
+    # 登记
+    # ------------------------------------------------------------------
+    def register_inputs(self, image_paths, top_k):
+        """
+        开始批量运行时登记所有输入 (已登记的保持不变)，这样中途崩溃后 resume 知道哪些照片还没分析
+        """
+        now = time.time()
+        with self._transaction() as conn:
+            conn.execute("BEGIN")
+            conn.executemany(
+                "INSERT OR IGNORE INTO inputs (input, top_k, created_at) VALUES (?, ?, ?)",
+                [(os.path.abspath(p), top_k, now) for p in image_paths],
+            )
+
+    def enqueue(self, image_path, analysis, top_k=3):
+        """
+        写入一张照片的分析结果与它的绘制任务，返回与 recommendations 顺序一致的任务 id。
+        同一 (照片, 风格, 策略) 已存在时沿用原任务 (已完成的不会重做)。
+        """
+        path = os.path.abspath(image_path)
+        now = time.time()
+        ids = []
+        with self._transaction() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            conn.execute("""
+                INSERT INTO inputs (input, top_k, description, reasoning, created_at, analyzed_at)
+                VALUES (?, ?, ?, ?, ?, ?)
+                ON CONFLICT (input) DO UPDATE SET
+                    description = excluded.description, reasoning = excluded.reasoning,
+                    analyzed_at = excluded.analyzed_at
+            """, (path, top_k, analysis.get("description", ""), analysis.get("reasoning", ""), now, now))
+            for item in analysis.get("recommendations", []):
+                style_key = item.get("style_key")
+                creativity = item.get("creativity", "Medium")
+                conn.execute(
+                    "INSERT OR IGNORE INTO jobs (input, style_key, creativity, updated_at) VALUES (?, ?, ?, ?)",
+                    (path, style_key, creativity, now),
+                )
+                row = conn.execute(
+                    "SELECT id FROM jobs WHERE input = ? AND style_key = ? AND creativity = ?",
+                    (path, style_key, creativity),
+                ).fetchone()
+                ids.append(row[0])
+        return ids
+
+    def unanalyzed(self):
+        """
+        已登记但还没有分析结果的照片: [(路径, top_k), ...]
+        """
+        with self._transaction() as conn:
+            return conn.execute(
+                "SELECT input, top_k FROM inputs WHERE analyzed_at IS NULL ORDER BY created_at, input"
+            ).fetchall()
+
+    # ------------------------------------------------------------------
+    # 领取与完成
+    # ------------------------------------------------------------------
+    def claim(self, job_ids=None):
+        """
+        原子地领取一个可执行的任务 (pending，或租约已过期的 running)；没有时返回 None。
+        job_ids 不为空时只在这些任务里领取。
+        """
+        claimed = self.claim_many(job_ids, limit=1)
+        return claimed[0] if claimed else None
+
+    def claim_many(self, job_ids=None, limit=None):
+        now = time.time()
+        where = f"(jobs.state = '{PENDING}' OR (jobs.state = '{RUNNING}' AND jobs.lease_until < ?))"
+        params = [now]
+        if job_ids is not None:
+            if not job_ids:
+                return []
+            where += f" AND jobs.id IN ({', '.join('?' * len(job_ids))})"
+            params.extend(job_ids)
+        sql = f"SELECT {_JOB_COLUMNS} FROM jobs JOIN inputs USING (input) WHERE {where} ORDER BY jobs.id"
+        if limit:
+            sql += f" LIMIT {int(limit)}"
+
+        with self._transaction() as conn:
+            # BEGIN IMMEDIATE 先拿写锁，其他进程的领取在此排队，不会读到同一批 pending
+            conn.execute("BEGIN IMMEDIATE")
+            rows = [Job(*row) for row in conn.execute(sql, params).fetchall()]
+            if rows:
+                conn.execute(
+                    f"UPDATE jobs SET state = '{RUNNING}', worker = ?, lease_until = ?, attempts = attempts + 1, "
+                    f"updated_at = ? WHERE id IN ({', '.join('?' * len(rows))})",
+                    [self.worker, now + self.lease_seconds, now, *[job.id for job in rows]],
+                )
+        if rows:
+            self._hold(job.id for job in rows)
+        return [job._replace(state=RUNNING, attempts=job.attempts + 1) for job in rows]
+
+    def _hold(self, job_ids):
+        with self._held_lock:
+            self._held.update(job_ids)
+            if self._heartbeat is None:
+                self._heartbeat = threading.Thread(target=self._renew_loop, name="journal-lease", daemon=True)
+                self._heartbeat.start()
+
+    def _renew_loop(self):
+        interval = max(1.0, self.lease_seconds / 3)
+        while True:
+            time.sleep(interval)
+            with self._held_lock:
+                held = list(self._held)
+                if not held:
+                    # 没有持有的任务时退出，下次领取再启动
+                    self._heartbeat = None
+                    return
+            try:
+                self.renew(held)
+            except sqlite3.Error as e:
+                print(f"⚠️ [Journal] 续租失败 (下一轮重试): {e}")
+
+    def renew(self, job_ids):
+        """
+        延长本进程持有的 running 任务的租约，返回续租的数量
+        """
+        job_ids = list(job_ids)
+        if not job_ids:
+            return 0
+        with self._transaction() as conn:
+            cursor = conn.execute(
+                f"UPDATE jobs SET lease_until = ? WHERE state = '{RUNNING}' AND worker = ? "
+                f"AND id IN ({', '.join('?' * len(job_ids))})",
+                [time.time() + self.lease_seconds, self.worker, *job_ids],
+            )
+            return cursor.rowcount
+
+    def complete(self, job_id, output_path):
+        self._finish(job_id, DONE, output=output_path)
+
+    def fail(self, job_id, error):
+        self._finish(job_id, FAILED, error=str(error))
+
+    def _finish(self, job_id, state, output=None, error=None):
+        with self._held_lock:
+            self._held.discard(job_id)
+        with self._transaction() as conn:
+            # 只更新自己持有的 (或还没人领取的) 任务: 租约过期后被别人接手的任务以对方的结果为准
+            conn.execute(
+                "UPDATE jobs SET state = ?, output = ?, error = ?, worker = ?, lease_until = NULL, updated_at = ? "
+                "WHERE id = ? AND (worker = ? OR state = ?)",
+                (state, output, error, self.worker, time.time(), job_id, self.worker, PENDING),
+            )
+
+    def jobs(self, job_ids):
+        if not job_ids:
+            return []
+        with self._transaction() as conn:
+            rows = conn.execute(
+                f"SELECT {_JOB_COLUMNS} FROM jobs JOIN inputs USING (input) "
+                f"WHERE jobs.id IN ({', '.join('?' * len(job_ids))})",
+                list(job_ids),
+            ).fetchall()
+        by_id = {row[0]: Job(*row) for row in rows}
+        return [by_id[i] for i in job_ids if i in by_id]
+
+    # ------------------------------------------------------------------
+    # 恢复
+    # ------------------------------------------------------------------
+    def release_dead(self):
+        """
+        本机上已经退出的进程留下的 running 任务立即放回 pending (不必等租约到期)，返回数量
+        """
+        host = socket.gethostname()
+        with self._transaction() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            rows = conn.execute(f"SELECT id, worker FROM jobs WHERE state = '{RUNNING}'").fetchall()
+            dead = []
+            for job_id, worker in rows:
+                worker_host, _, pid = (worker or "").rpartition(":")
+                if worker_host == host and pid.isdigit() and worker != self.worker and not _pid_alive(int(pid)):
+                    dead.append(job_id)
+            if dead:
+                conn.execute(
+                    f"UPDATE jobs SET state = '{PENDING}', worker = NULL, lease_until = NULL, updated_at = ? "
+                    f"WHERE id IN ({', '.join('?' * len(dead))})",
+                    [time.time(), *dead],
+                )
+        return len(dead)
+
+    def requeue_failed(self):
+        """
+        失败次数未达上限 (max_attempts) 的任务放回 pending，返回数量
+        """
+        with self._transaction() as conn:
+            cursor = conn.execute(
+                f"UPDATE jobs SET state = '{PENDING}', updated_at = ? WHERE state = '{FAILED}' AND attempts < ?",
+                (time.time(), self.max_attempts),
+            )
+            return cursor.rowcount
+
+    def counts(self):
+        with self._transaction() as conn:
+            counts = dict(conn.execute("SELECT state, COUNT(*) FROM jobs GROUP BY state").fetchall())
+            unanalyzed = conn.execute("SELECT COUNT(*) FROM inputs WHERE analyzed_at IS NULL").fetchone()[0]
+        counts = {state: counts.get(state, 0) for state in (PENDING, RUNNING, DONE, FAILED)}
+        counts["unanalyzed"] = unanalyzed
+        return counts
+
+    def report(self):
+        c = self.counts()
+        return (f"📒 [Journal] 完成 {c[DONE]} | 待处理 {c[PENDING]} | 进行中 {c[RUNNING]} | 失败 {c[FAILED]} | "
+                f"未分析照片 {c['unanalyzed']} ({self.db_path})")
+
+
+class _Transaction:
+    """
+    with journal._transaction() as conn: 正常退出时提交 (有未结束的事务时)，异常时回滚，最后关闭连接
+    """
+    def __init__(self, conn):
+        self.conn = conn
+
+    def __enter__(self):
+        return self.conn
+
+    def __exit__(self, exc_type, exc, tb):
+        try:
+            if self.conn.in_transaction:
+                self.conn.execute("ROLLBACK" if exc_type else "COMMIT")
+        finally:
+            self.conn.close()
+        return False
@@ -0,0 +1,89 @@
+import json
+
+
+class IncrementalJSONParser:
+    """
+    流式 JSON 的增量解析器 (只关心顶层对象)：
+        parser = IncrementalJSONParser(array_keys=("recommendations",), string_keys=("description",))
+        for chunk in stream:
+            for kind, key, value in parser.feed(chunk.text): ...
+    - 顶层字符串字段 (string_keys) 一读完整就产出 ("field", key, value)
+    - 顶层数组字段 (array_keys) 中的每个元素一闭合就产出 ("item", key, value)
+    - 只做一遍字符扫描，不会对已读过的文本重复解析；最终完整结果用 result() 获取
+    """
+    def __init__(self, array_keys=(), string_keys=()):
+        self.array_keys = set(array_keys)
+        self.string_keys = set(string_keys)
+        self.text = ""
+        self._pos = 0
+        self._stack = []          # 当前所在的容器: '{' / '['
+        self._in_string = False
+        self._escape = False
+        self._string_start = None
+        self._expect_key = False  # 顶层对象中下一个字符串是否为键
+        self._key = None          # 当前顶层键
+        self._item_start = None   # 正在读取的数组元素起点
+
+    def feed(self, chunk):
+        """
+        追加一段文本，返回这段文本中新完成的事件列表
+        """
+        if not chunk:
+            return []
+        self.text += chunk
+        events = []
+        text = self.text
+        while self._pos < len(text):
+            ch = text[self._pos]
+            if self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif ch == "\\":
+                    self._escape = True
+                elif ch == '"':
+                    self._in_string = False
+                    self._on_string(text[self._string_start:self._pos + 1], events)
+            elif ch == '"':
+                self._in_string = True
+                self._string_start = self._pos
+            elif ch in "{[":
+                self._on_open(ch)
+            elif ch in "}]":
+                self._on_close(events)
+            elif ch == "," and self._stack == ["{"]:
+                self._expect_key = True
+            self._pos += 1
+        return events
+
+    def _on_string(self, raw, events):
+        if self._stack != ["{"]:
+            return
+        if self._expect_key:
+            self._key = json.loads(raw)
+            self._expect_key = False
+        elif self._key in self.string_keys:
+            events.append(("field", self._key, json.loads(raw)))
+
+    def _on_open(self, ch):
+        if not self._stack:
+            self._expect_key = ch == "{"
+        elif self._stack == ["{", "["] and self._key in self.array_keys and self._item_start is None:
+            self._item_start = self._pos
+        self._stack.append(ch)
+
+    def _on_close(self, events):
+        if self._stack:
+            self._stack.pop()
+        if self._stack == ["{", "["] and self._item_start is not None:
+            raw = self.text[self._item_start:self._pos + 1]
+            self._item_start = None
+            try:
+                events.append(("item", self._key, json.loads(raw)))
+            except ValueError:
+                pass  # 元素本身不是合法 JSON，留给最终的整体解析报错
+
+    def result(self):
+        """
+        流结束后解析完整文本 (与非流式的 json.loads(response.text) 等价)
+        """
+        return json.loads(self.text)
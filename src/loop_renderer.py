@@ -0,0 +1,168 @@
+import os
+import json
+import time
+import shutil
+import tempfile
+import subprocess
+from collections import deque
+from concurrent.futures import as_completed
+import numpy as np
+from src.utils import process_pool
+
+
+def default_loop_path(video_path):
+    """
+    循环视频输出路径: xxx_raw.mp4 -> xxx_loop.mp4
+    """
+    stem = os.path.splitext(video_path)[0]
+    if stem.endswith("_raw"):
+        stem = stem[:-len("_raw")]
+    return stem + "_loop.mp4"
+
+
+def _require_ffmpeg():
+    for tool in ("ffmpeg", "ffprobe"):
+        if shutil.which(tool) is None:
+            raise RuntimeError(f"❌ 未找到 {tool}，请先安装 FFmpeg 并加入 PATH")
+
+
+def probe_video(video_path):
+    """
+    读取视频的宽、高、帧率
+    """
+    out = subprocess.run(
+        ["ffprobe", "-v", "error", "-select_streams", "v:0",
+         "-show_entries", "stream=width,height,r_frame_rate", "-of", "json", video_path],
+        check=True, capture_output=True, text=True
+    ).stdout
+    stream = json.loads(out)["streams"][0]
+    num, _, den = stream["r_frame_rate"].partition("/")
+    fps = float(num) / float(den or 1)
+    return int(stream["width"]), int(stream["height"]), fps
+
+
+def crossfade_frames(tail, head):
+    """
+    向量化的交叉淡化: tail 逐帧淡出、head 逐帧淡入
+    tail / head: (k, H, W, 3) uint8，返回同形状的 uint8
+    """
+    k = len(tail)
+    alpha = (np.arange(1, k + 1, dtype=np.float32) / (k + 1)).reshape(k, 1, 1, 1)
+    blended = tail.astype(np.float32) * (1.0 - alpha) + head.astype(np.float32) * alpha
+    return np.clip(blended + 0.5, 0, 255).astype(np.uint8)
+
+
+def render_loop(video_path, output_path=None, duration=3.0, crossfade=0.5, crf=18):
+    """
+    把一段视频裁成 duration 秒的无缝循环 (流式处理，不落中间文件)：
+
+        解码 ffmpeg --(rawvideo 管道)--> NumPy --(rawvideo 管道)--> 编码 ffmpeg
+
+    取原视频前 duration + crossfade 秒，输出第 F 帧之后的内容，
+    最后 F 帧与开头 F 帧做交叉淡化，播放到结尾时正好衔接回第一帧。
+    内存中只保留 2F 帧，与视频总长度无关。
+    """
+    _require_ffmpeg()
+    start = time.perf_counter()
+    output_path = output_path or default_loop_path(video_path)
+    width, height, fps = probe_video(video_path)
+    fade = max(1, round(crossfade * fps))
+    frame_bytes = width * height * 3
+
+    decoder = subprocess.Popen(
+        ["ffmpeg", "-v", "error", "-i", video_path, "-t", f"{duration + crossfade:.3f}",
+         "-f", "rawvideo", "-pix_fmt", "rgb24", "-"],
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE
+    )
+    out_dir = os.path.dirname(output_path) or "."
+    fd, tmp_path = tempfile.mkstemp(dir=out_dir, prefix=".tmp_", suffix=".mp4")
+    os.close(fd)
+    encoder = subprocess.Popen(
+        ["ffmpeg", "-v", "error", "-y", "-f", "rawvideo", "-pix_fmt", "rgb24",
+         "-s", f"{width}x{height}", "-r", f"{fps:.6f}", "-i", "-",
+         "-an", "-c:v", "libx264", "-pix_fmt", "yuv420p", "-crf", str(crf),
+         "-movflags", "+faststart", tmp_path],
+        stdin=subprocess.PIPE, stderr=subprocess.PIPE
+    )
+
+    def read_frame():
+        buf = decoder.stdout.read(frame_bytes)
+        if len(buf) < frame_bytes:
+            return None
+        return np.frombuffer(buf, dtype=np.uint8).reshape(height, width, 3)
+
+    written = 0
+    try:
+        # 1. 开头 F 帧只缓存，用于最后的淡入
+        head = []
+        while len(head) < fade:
+            frame = read_frame()
+            if frame is None:
+                raise RuntimeError(f"视频太短，不足 {fade} 帧交叉淡化")
+            head.append(frame)
+        head = np.stack(head)
+
+        # 2. 中间帧直接转发给编码器，始终压住最后 F 帧等待淡化
+        tail = deque()
+        while True:
+            frame = read_frame()
+            if frame is None:
+                break
+            tail.append(frame)
+            if len(tail) > fade:
+                encoder.stdin.write(tail.popleft().tobytes())
+                written += 1
+
+        # 3. 结尾 k 帧与开头最后 k 帧淡化，保证最后一帧衔接回输出的第一帧
+        if tail:
+            k = len(tail)
+            blended = crossfade_frames(np.stack(tail), head[fade - k:])
+            encoder.stdin.write(blended.tobytes())
+            written += k
+
+        encoder.stdin.close()
+        if encoder.wait() != 0:
+            raise RuntimeError(f"ffmpeg 编码失败: {encoder.stderr.read().decode(errors='ignore')[:300]}")
+        decoder.stdout.close()
+        if decoder.wait() != 0:
+            raise RuntimeError(f"ffmpeg 解码失败: {decoder.stderr.read().decode(errors='ignore')[:300]}")
+        os.replace(tmp_path, output_path)
+    except BaseException:
+        for proc in (decoder, encoder):
+            if proc.poll() is None:
+                proc.kill()
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+    return {
+        "source": video_path,
+        "output": output_path,
+        "frames": written,
+        "fps": fps,
+        "width": width,
+        "height": height,
+        "seconds": time.perf_counter() - start,
+    }
+
+
+def render_loops(video_paths, workers=None, **options):
+    """
+    多进程并行处理一批视频，返回 {视频路径: 结果字典 或 None} 与总耗时
+    """
+    _require_ffmpeg()
+    start = time.perf_counter()
+    results = {}
+    with process_pool(workers or os.cpu_count()) as pool:
+        futures = {pool.submit(render_loop, path, **options): path for path in video_paths}
+        for future in as_completed(futures):
+            path = futures[future]
+            try:
+                info = future.result()
+                results[path] = info
+                print(f"🔁 [Loop] {os.path.basename(path)} -> {os.path.basename(info['output'])} "
+                      f"({info['frames']} 帧, {info['seconds']:.2f}s)")
+            except Exception as e:
+                results[path] = None
+                print(f"❌ [Loop] {os.path.basename(path)} 处理失败: {e}")
+    return results, time.perf_counter() - start
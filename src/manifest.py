@@ -0,0 +1,95 @@
+import os
+import json
+import time
+import hashlib
+import threading
+from src.utils import atomic_write_bytes, file_lock
+
+MANIFEST_NAME = "manifest.json"
+
+
+def make_job_key(input_hash, style_key, creativity, prompt_hash):
+    """
+    一次绘制任务的唯一标识：同一张图 + 同一风格 + 同一策略 + 同一最终 Prompt
+    """
+    raw = f"{input_hash}|{style_key}|{creativity}|{prompt_hash}"
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+def hash_text(text):
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+class OutputManifest:
+    """
+    输出目录的任务清单 (manifest.json)：记录已完成的绘制任务。
+    生成前先查清单，已完成且文件仍存在的任务直接跳过。
+    多个进程可以同时写同一目录 (resume 多开)：写入时在文件锁内重新读盘合并，不会互相覆盖。
+    """
+    def __init__(self, output_dir):
+        self.output_dir = output_dir
+        self.path = os.path.join(output_dir, MANIFEST_NAME)
+        self.lock_path = self.path + ".lock"
+        self._lock = threading.Lock()
+        self._signature = None
+        self.entries = {}
+        self._reload_locked()
+
+    def _reload_locked(self):
+        """
+        清单文件自上次读取后有变化 (其他进程写过) 时重新读盘，合并到内存
+        """
+        try:
+            st = os.stat(self.path)
+        except OSError:
+            return
+        signature = (st.st_mtime_ns, st.st_size, st.st_ino)
+        if signature == self._signature:
+            return
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                self.entries.update(json.load(f).get("jobs", {}))
+            self._signature = signature
+        except (OSError, ValueError) as e:
+            print(f"⚠️ [Manifest] 清单损坏，将重新记录: {e}")
+
+    def lookup(self, job_key):
+        """
+        返回已完成任务的输出路径；未完成或文件已被删除时返回 None
+        """
+        with self._lock:
+            entry = self.entries.get(job_key)
+            if not entry:
+                # 可能是其他进程刚完成的任务
+                self._reload_locked()
+                entry = self.entries.get(job_key)
+        if not entry:
+            return None
+        output_path = os.path.join(self.output_dir, entry["output"])
+        return output_path if os.path.exists(output_path) else None
+
+    def record(self, job_key, output_path, **info):
+        entry = dict(info, output=os.path.basename(output_path), created_at=int(time.time()))
+        with self._lock, file_lock(self.lock_path):
+            # 文件锁内先读盘合并其他进程的记录，再原子写回
+            self._reload_locked()
+            self.entries[job_key] = entry
+            data = json.dumps({"jobs": self.entries}, ensure_ascii=False, indent=2)
+            atomic_write_bytes(self.path, data.encode("utf-8"))
+            st = os.stat(self.path)
+            self._signature = (st.st_mtime_ns, st.st_size, st.st_ino)
+
+
+_manifests = {}
+_manifests_lock = threading.Lock()
+
+
+def get_manifest(output_dir):
+    """
+    同一目录在进程内共享一个 OutputManifest，避免并发线程互相覆盖清单
+    """
+    key = os.path.abspath(output_dir)
+    with _manifests_lock:
+        if key not in _manifests:
+            _manifests[key] = OutputManifest(output_dir)
+        return _manifests[key]
@@ -1,47 +1,95 @@
 import os
 import re
-import yaml
-from google import genai
-from src.utils import load_image_safe
-from google.genai import types
-import time
-import requests
+from src.payload import payload_preparer
+from src.clients import get_registry
+from src.downloader import download_file, format_download
+from src.video_jobs import VideoJobScheduler
+from src.style_registry import get_style_registry
+from src.catalog import get_catalog
+
+# 导演指令的固定部分 (与风格无关)，通过 PromptCache 只上传一次
+DIRECTOR_PROMPT = """
+        # Role: Elite Multi-Style AI Motion Director
+        
+        # Your Core Mission:
+        Design a "Living Moment" for a wallpaper. It must have a subtle "Story" behind the motion.
+        
+        # Motion Strategy (The "10% Rule"):
+        1. **Stable World**: Start with "Cinemagraph, Static Camera." The environment is the stage, it must remain steady.
+        2. **Purposeful Subject Motion**: If there are characters or animals, they should NOT be frozen. 
+           - Allow "Micro-Interactions": Two subjects might glance at each other, a dog might tilt its head curiously, or a bird might preen its feathers.
+           - Their movement should be "Slightly Positional": They can move within a small 10% radius of their original spot to create a sense of life and story.
+           - Movements must be intentional (e.g., "looking at the horizon") rather than random jitters.
+        3. **Artistic Secondary Motion**: 
+           - In paintings (e.g. Ink/Van Gogh): Animate the *texture* or *brushstrokes* as if the paint is alive.
+           - In nature: Wind and light should complement the subjects' actions.
+        4. **Loopability**: All movements must resolve back to the starting pose smoothly for a perfect infinite loop.
+        
+        # Output Format:
+        Provide ONLY the final video prompt in a single English paragraph. Focus on the INTERACTION and the STORY of the micro-movements.
+        """
+
+
 class MotionDirector:
-    def __init__(self, styles_path="config/styles.yaml"):
+    def __init__(self, styles_path="config/styles.yaml", registry=None):
         """
         初始化动态导演，加载风格库并配置 Google GenAI 客户端
         """
         # 1. 加载重构后的学术化 styles.yaml
         try:
-            with open(styles_path, 'r', encoding='utf-8') as f:
-                config = yaml.safe_load(f)
-                self.styles = config.get('styles', {})
+            self.style_registry = get_style_registry(styles_path)
         except Exception as e:
             print(f"⚠️ [Director] 无法加载风格配置文件: {e}")
-            self.styles = {}
+            self.style_registry = None
 
-        # 2. 初始化客户端 (确保环境变量中已配置 GOOGLE_API_KEY)
-        api_key = os.getenv("GOOGLE_API_KEY")
-        self.api_key = api_key
-        if not api_key:
+        # 2. 初始化客户端 (确保环境变量中已配置 GOOGLE_API_KEY，或注入了客户端)
+        self.registry = registry or get_registry()
+        self.api_key = self.registry.api_key
+        if not self.registry.available:
             raise ValueError("❌ GOOGLE_API_KEY 未在环境变量中设置")
-        
-        self.client = genai.Client(api_key=api_key)
         # 使用最新的 Gemini 3 图像预览模型进行视觉分析
         self.vision_model = "gemini-2.5-flash" 
+        self.video_model = "veo-3.1-generate-preview"
+        # 统一调用网关 (限流 + 重试)
+        self.gateway = self.registry.gateway
+        # 静态导演指令的上下文缓存 (不可用时自动内联)
+        self.prompt_cache = self.registry.prompt_cache
+
+    @property
+    def client(self):
+        # 首次调用模型时才创建 (并导入) GenAI 客户端
+        return self.registry.client
+
+    @property
+    def styles(self):
+        if self.style_registry is None:
+            return {}
+        return self.style_registry.config.get('styles', {})
+
+    def resolve_style(self, image_path):
+        """
+        [函数 1'] 查询资产目录得到壁纸的 style_key；目录里没有 (旧产物/外部图片) 时退回文件名解析
+        """
+        try:
+            style_key = get_catalog().style_for(image_path)
+        except Exception as e:
+            print(f"⚠️ [Director] 资产目录查询失败: {e}")
+            style_key = None
+        return style_key or self.parse_style_from_filename(image_path)
 
     def parse_style_from_filename(self, image_path):
         """
         [函数 1] 逆向解析文件名以提取 style_key
         示例: cat_gen_makoto_shinkai_1737244800.png -> makoto_shinkai
+              cat_gen_makoto_shinkai_3fa2c91b0d4e.png -> makoto_shinkai (内容哈希命名)
         """
         filename = os.path.basename(image_path)
         try:
             if "_gen_" in filename:
                 # 提取 _gen_ 之后的部分
                 style_part = filename.split("_gen_")[1]
-                # 使用正则移除最后的时间戳和后缀 (例如 _1737244800.png)
-                style_key = re.sub(r'_\d+\.(png|jpg|heic|JPG|PNG)$', '', style_part)
+                # 使用正则移除最后的时间戳/12 位内容哈希和后缀 (例如 _1737244800.png)
+                style_key = re.sub(r'_(\d+|[0-9a-f]{12})\.(png|jpg|heic|JPG|PNG)$', '', style_part)
                 return style_key
         except Exception as e:
             print(f"⚠️ [Director] 文件名解析失败: {e}")
@@ -49,33 +97,31 @@ class MotionDirector:
         return "default"
 
     def _build_director_prompt(self, style_key):
+        """
+        完整的导演指令 (静态前缀 + 风格原则)，等价于未启用上下文缓存时发送的内容
+        """
+        return self._director_prompt() + "\n" + self._style_logic(style_key)
+
+    def _director_prompt(self):
+        """
+        静态前缀: 固定导演指令 + 所有风格的运动原则 (只随风格库变化，走上下文缓存)
+        """
+        library = self.style_registry.motion_library_text if self.style_registry else ""
+        if not library:
+            return DIRECTOR_PROMPT
+        return DIRECTOR_PROMPT + f"""
+        # Style Motion Library (reference only; apply ONLY the style named under "Style Logic"):
+{library}
+        """
+
+    def _style_logic(self, style_key):
+        # 随风格变化的部分单独放在最后，前面的静态指令可以作为缓存上下文复用
         style_info = self.styles.get(style_key, {})
         motion_guide = style_info.get('motion_guide', "Subtle and organic motion.")
-        
-        prompt = f"""
-        # Role: Elite Multi-Style AI Motion Director
-        
-        # Style Logic:
+        return f"""
+        # Style Logic ({style_key}):
         Respect the medium (Painting/Anime/3D/Photo). Style Principle: {motion_guide}
-        
-        # Your Core Mission:
-        Design a "Living Moment" for a wallpaper. It must have a subtle "Story" behind the motion.
-        
-        # Motion Strategy (The "10% Rule"):
-        1. **Stable World**: Start with "Cinemagraph, Static Camera." The environment is the stage, it must remain steady.
-        2. **Purposeful Subject Motion**: If there are characters or animals, they should NOT be frozen. 
-           - Allow "Micro-Interactions": Two subjects might glance at each other, a dog might tilt its head curiously, or a bird might preen its feathers.
-           - Their movement should be "Slightly Positional": They can move within a small 10% radius of their original spot to create a sense of life and story.
-           - Movements must be intentional (e.g., "looking at the horizon") rather than random jitters.
-        3. **Artistic Secondary Motion**: 
-           - In paintings (e.g. Ink/Van Gogh): Animate the *texture* or *brushstrokes* as if the paint is alive.
-           - In nature: Wind and light should complement the subjects' actions.
-        4. **Loopability**: All movements must resolve back to the starting pose smoothly for a perfect infinite loop.
-        
-        # Output Format:
-        Provide ONLY the final video prompt in a single English paragraph. Focus on the INTERACTION and the STORY of the micro-movements.
         """
-        return prompt
     
     def analyze_scene_for_motion(self, image_path, style_key):
         """
@@ -84,15 +130,11 @@ class MotionDirector:
         print(f"🧠 [Motion Director] 正在分析画面动态 (Style: {style_key})...")
         
         try:
-            # 加载本地静态图
-            img = load_image_safe(image_path)
-            # 生成针对该风格的导演指令
-            director_prompt = self._build_director_prompt(style_key)
-            
-            # 调用 Gemini 进行多模态推理
-            response = self.client.models.generate_content(
-                model=self.vision_model,
-                contents=[img, director_prompt]
+            # 加载本地静态图 (分析规格: 1024px 以内)
+            img = payload_preparer.to_part(image_path, "analysis")
+            # 调用 Gemini 进行多模态推理: 固定指令走缓存，只附带该风格的原则
+            response = self.prompt_cache.generate_content(
+                self.vision_model, "motion_director", self._director_prompt(), [img], self._style_logic(style_key)
             )
             
             video_prompt = response.text.strip()
@@ -107,8 +149,8 @@ class MotionDirector:
         """
         [工作流] 顶层入口：从图片到视频脚本的转换
         """
-        # 1. 识别图片风格
-        style_key = self.parse_style_from_filename(image_path)
+        # 1. 识别图片风格 (资产目录优先)
+        style_key = self.resolve_style(image_path)
         
         # 2. 生成专业的运动提示词
         video_prompt = self.analyze_scene_for_motion(image_path, style_key)
@@ -120,82 +162,128 @@ class MotionDirector:
         }
 
 
-    def generate_video(self, image_path, video_prompt):
+    def submit_video(self, image_path, video_prompt):
         """
-        [函数 4] 使用 Veo 3.1 最终修复版：构造符合规范的 Image 类型
+        [函数 4a] 提交 Veo 3.1 任务 (不等待)，返回 operation
         """
-        print(f"🎬 [Veo 3.1] 正在开机拍摄... 预计耗时 1-2 分钟")
-        
-        try:
-            # 1. 以二进制模式读取图片
-            with open(image_path, "rb") as f:
-                image_bytes = f.read()
-            # 2. 识别 MIME 类型
-            ext = image_path.split('.')[-1].lower()
-            mime_type = "image/png" if "png" in ext else "image/jpeg"
-
-            # 3. 构造符合 API 要求的 Image 实例
-            input_image = types.Image(
-                image_bytes=image_bytes,
-                mime_type=mime_type
-            )
+        from google.genai import types
 
-            # 4. 指定模型 ID
-            model_id = "veo-3.1-generate-preview" 
-
-            # 5. 提交任务
-            operation = self.client.models.generate_videos(
-                model=model_id,
-                prompt=video_prompt,
-                image=input_image,  # 传入构造好的 Image 对象
-                config=types.GenerateVideosConfig(
-                    aspect_ratio="16:9",
-                    duration_seconds=4
-                )
+        # 1~3. 读取图片并构造符合 API 要求的 Image 实例
+        # (合规的 PNG/JPEG 原样透传，其他格式或超大图先转换)
+        input_image = payload_preparer.to_image(image_path, "video")
+
+        # 4. 指定模型 ID
+        model_id = self.video_model
+
+        # 5. 提交任务
+        operation = self.gateway.call(
+            model_id, self.client.models.generate_videos,
+            model=model_id,
+            prompt=video_prompt,
+            image=input_image,  # 传入构造好的 Image 对象
+            config=types.GenerateVideosConfig(
+                aspect_ratio="16:9",
+                duration_seconds=4
             )
+        )
+        print(f"⏳ 任务已提交 (ID: {operation.name})，云端渲染中...")
+        return operation
 
-            print(f"⏳ 任务已提交 (ID: {operation.name})，云端渲染中...")
+    def poll_video(self, operation):
+        """
+        [函数 4b] 查询一次任务状态；operation 可以是对象或持久化下来的 operation 名称
+        """
+        if isinstance(operation, str):
+            from google.genai import types
+            operation = types.GenerateVideosOperation(name=operation)
+        return self.gateway.call("operations", self.client.operations.get, operation)
 
-            while not operation.done:
-                time.sleep(5)
-                operation = self.client.operations.get(operation)
-                print(".", end="", flush=True)
-            print() 
-            
-            output_path = image_path.replace(".png", "_raw.mp4")
-            if operation.result and operation.result.generated_videos:
-                video_result = operation.result.generated_videos[0]
-                video_uri = video_result.video.uri
-                print(f"🔗 [VideoAgent] 获取到下载链接: {video_uri}...")
-                
-                response = requests.get(
-                    video_uri, 
-                    headers={"x-goog-api-key": self.api_key}  # 👈 这就是 403 的解药
+    def download_video(self, operation, output_path):
+        """
+        [函数 4c] 下载已完成任务的视频，成功返回路径，失败返回 False
+        """
+        if operation.result and operation.result.generated_videos:
+            video_result = operation.result.generated_videos[0]
+            video_uri = video_result.video.uri
+            print(f"🔗 [VideoAgent] 获取到下载链接: {video_uri}...")
+
+            try:
+                # 流式写入临时文件，断线后按 Range 续传，校验通过后原子改名
+                result = download_file(
+                    self.registry.session, video_uri, output_path,
+                    headers={"x-goog-api-key": self.api_key},  # 👈 这就是 403 的解药
+                    timeout=self.registry.timeout
                 )
-                
-                if response.status_code == 200:
-                    os.makedirs(os.path.dirname(output_path), exist_ok=True)
-                    with open(output_path, "wb") as f:
-                        f.write(response.content)
-                    print(f"✅ [VideoAgent] 视频下载成功: {output_path}")
-                    return True
-                else:
-                    print(f"❌ [VideoAgent] 下载失败，状态码: {response.status_code}")
-                    # 打印更多错误信息
-                    print(f"   Response: {response.text[:200]}")
-                    return False
-            else:
-                print("❌ [VideoAgent] 生成失败: 未返回视频数据")
+            except Exception as e:
+                print(f"❌ [VideoAgent] 下载失败: {e}")
                 return False
+            print(f"✅ [VideoAgent] 视频下载成功: {output_path} ({format_download(result)})")
+            return output_path
+        else:
+            print("❌ [VideoAgent] 生成失败: 未返回视频数据")
+            return False
 
+    def generate_video(self, image_path, video_prompt):
+        """
+        [函数 4] 使用 Veo 3.1 生成单个视频 (阻塞直到下载完成)
+        """
+        print(f"🎬 [Veo 3.1] 正在开机拍摄... 预计耗时 1-2 分钟")
+        
+        try:
+            scheduler = VideoJobScheduler(self, state_path=None, max_in_flight=1)
+            job_id = scheduler.add(image_path, video_prompt)
+            return scheduler.run().get(job_id) or False
 
         except Exception as e:
             print(f"❌ [Video Gen] 拍摄失败: {e}")
             return None
+
+    def generate_videos(self, items, max_in_flight=4, state_path=".cache/video_jobs.json"):
+        """
+        [函数 4'] 批量生成: items = [(image_path, video_prompt), ...]
+        并发提交、统一轮询；进程重启后再次调用会接着等之前已提交的任务。
+        返回 {image_path: 视频路径或 None}
+        """
+        scheduler = VideoJobScheduler(self, state_path=state_path, max_in_flight=max_in_flight)
+        job_ids = {scheduler.add(image_path, video_prompt): image_path for image_path, video_prompt in items}
+        results = scheduler.run()
+        return {image_path: results.get(job_id) for job_id, image_path in job_ids.items()}
     
     
-    def post_process_loop(self, video_path):
+    def post_process_loop(self, video_path, duration=3.0, crossfade=0.5):
         """
-        [函数 5 - 待实现] 使用 FFmpeg 进行 3s 裁剪与 Crossfade 无缝循环处理
+        [函数 5] 使用 FFmpeg 进行 3s 裁剪与 Crossfade 无缝循环处理
+        成功返回循环视频路径 (xxx_loop.mp4)，失败返回 None
         """
-        pass
\ No newline at end of file
+        # numpy 只有循环渲染需要，按需导入
+        from src.loop_renderer import render_loop
+        try:
+            info = render_loop(video_path, duration=duration, crossfade=crossfade)
+            print(f"🔁 [Loop] 无缝循环已生成: {info['output']} ({info['frames']} 帧, {info['seconds']:.2f}s)")
+            self._catalog_loop(info)
+            return info['output']
+        except Exception as e:
+            print(f"❌ [Loop] 循环处理失败: {e}")
+            return None
+
+    def post_process_loops(self, video_paths, workers=None, duration=3.0, crossfade=0.5):
+        """
+        [函数 5'] 多进程批量处理，返回 {视频路径: 循环视频路径或 None}
+        """
+        from src.loop_renderer import render_loops
+        results, seconds = render_loops(video_paths, workers=workers, duration=duration, crossfade=crossfade)
+        done = sum(1 for info in results.values() if info)
+        for info in results.values():
+            if info:
+                self._catalog_loop(info)
+        print(f"✨ [Loop] 批量完成 {done}/{len(video_paths)} 个，总耗时 {seconds:.2f}s")
+        return {path: (info['output'] if info else None) for path, info in results.items()}
+
+    @staticmethod
+    def _catalog_loop(info):
+        try:
+            get_catalog().record(info['output'], "loop", parent=info['source'], engine="ffmpeg",
+                                 width=info['width'], height=info['height'], frames=info['frames'],
+                                 fps=info['fps'])
+        except Exception as e:
+            print(f"⚠️ [Catalog] 循环视频登记失败: {e}")
@@ -0,0 +1,168 @@
+import os
+import hashlib
+import threading
+from io import BytesIO
+from collections import OrderedDict, namedtuple
+from src.utils import load_image_safe, file_sha256, atomic_write_bytes, import_pil
+from src.tracing import span
+
+# 上传前的图片处理规格
+# - max_side: 长边像素上限
+# - format / quality: 需要重新编码时使用的格式与质量
+# - max_bytes: 原图直传时允许的最大文件体积
+PayloadProfile = namedtuple("PayloadProfile", ["max_side", "format", "quality", "max_bytes"])
+
+PROFILES = {
+    # 视觉分析只需要看清构图与内容，1024px 足够
+    "analysis": PayloadProfile(max_side=1024, format="JPEG", quality=85, max_bytes=2 * 1024 * 1024),
+    # 多图合并分析：一次请求塞多张图，768px 以内每张只占一个 tile
+    "analysis_batch": PayloadProfile(max_side=768, format="JPEG", quality=80, max_bytes=1024 * 1024),
+    # 图生图参考图：模型输入上限以内尽量保留细节
+    "reference": PayloadProfile(max_side=3072, format="JPEG", quality=92, max_bytes=7 * 1024 * 1024),
+    # Veo 首帧：1080p 级别即可
+    "video": PayloadProfile(max_side=1920, format="JPEG", quality=95, max_bytes=7 * 1024 * 1024),
+}
+
+# 可直接透传的格式 (Pillow format -> MIME)
+PASSTHROUGH_MIME = {"JPEG": "image/jpeg", "PNG": "image/png"}
+ENCODE_MIME = {"JPEG": "image/jpeg", "PNG": "image/png", "WEBP": "image/webp"}
+ENCODE_EXT = {"JPEG": "jpg", "PNG": "png", "WEBP": "webp"}
+
+# 准备好的上传数据; source 取值: passthrough / disk_cache / encoded
+Payload = namedtuple("Payload", ["data", "mime_type", "source"])
+
+
+class PayloadPreparer:
+    """
+    上传数据准备层：把本地图片转换成适合发给模型的字节流。
+    - 已经符合规格的 JPEG/PNG 原样透传，不做解码/重编码
+    - 其他情况 (HEIC、超大图) 缩放并重新编码，结果按内容哈希缓存在磁盘上
+    - 同一次运行内的结果再做一层内存缓存，5 个风格共用一份字节 (并发请求同一张图时只编码一次)
+    """
+    def __init__(self, cache_dir=".cache/payloads", profiles=None, memory_entries=32):
+        self.cache_dir = cache_dir
+        self.profiles = dict(PROFILES, **(profiles or {}))
+        self.memory_entries = memory_entries
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        self._key_locks = {}
+        self.counts = {"passthrough": 0, "disk_cache": 0, "encoded": 0, "memory": 0}
+
+    def prepare(self, image_path, purpose="reference"):
+        if purpose not in self.profiles:
+            raise ValueError(f"❌ 未知的 payload 规格: {purpose}")
+        if not os.path.exists(image_path):
+            raise FileNotFoundError(f"❌ 找不到图片: {image_path}")
+        profile = self.profiles[purpose]
+
+        st = os.stat(image_path)
+        memo_key = (os.path.abspath(image_path), st.st_mtime_ns, st.st_size, profile)
+        with self._lock:
+            if memo_key in self._memory:
+                self._memory.move_to_end(memo_key)
+                self.counts["memory"] += 1
+                return self._memory[memo_key]
+            key_lock = self._key_locks.setdefault(memo_key, threading.Lock())
+
+        # 同一张图 + 同一规格被多个线程同时请求时只准备一次，其他线程等它的结果
+        with key_lock:
+            with self._lock:
+                if memo_key in self._memory:
+                    self._memory.move_to_end(memo_key)
+                    self.counts["memory"] += 1
+                    return self._memory[memo_key]
+
+            try:
+                payload = self._prepare_uncached(image_path, profile, st.st_size)
+            except BaseException:
+                with self._lock:
+                    self._key_locks.pop(memo_key, None)
+                raise
+
+            with self._lock:
+                self.counts[payload.source] += 1
+                self._memory[memo_key] = payload
+                while len(self._memory) > self.memory_entries:
+                    self._memory.popitem(last=False)
+                self._key_locks.pop(memo_key, None)
+            return payload
+
+    def _can_passthrough(self, image_path, profile, file_size):
+        if file_size > profile.max_bytes:
+            return None
+        try:
+            # Image.open 只读文件头，不会解码像素
+            with import_pil().open(image_path) as probe:
+                mime = PASSTHROUGH_MIME.get(probe.format)
+                if not mime or max(probe.size) > profile.max_side:
+                    return None
+                if probe.mode not in ("RGB", "L"):
+                    return None
+                return mime
+        except Exception:
+            return None
+
+    def _prepare_uncached(self, image_path, profile, file_size):
+        mime = self._can_passthrough(image_path, profile, file_size)
+        if mime:
+            with open(image_path, "rb") as f:
+                return Payload(f.read(), mime, "passthrough")
+
+        # 缓存 Key = 原图内容哈希 + 规格，换了规格会自动生成新文件
+        signature = f"{file_sha256(image_path)}:{profile.max_side}:{profile.format}:{profile.quality}"
+        digest = hashlib.sha256(signature.encode("utf-8")).hexdigest()
+        cache_path = os.path.join(self.cache_dir, digest[:2], f"{digest}.{ENCODE_EXT[profile.format]}")
+        mime = ENCODE_MIME[profile.format]
+
+        if os.path.exists(cache_path):
+            with open(cache_path, "rb") as f:
+                return Payload(f.read(), mime, "disk_cache")
+
+        img = load_image_safe(image_path)
+        with span("payload.encode", format=profile.format, max_side=profile.max_side):
+            data = self._encode(img, profile)
+        try:
+            atomic_write_bytes(cache_path, data)
+        except OSError as e:
+            print(f"⚠️ [Payload] 磁盘缓存写入失败 (不影响本次上传): {e}")
+        return Payload(data, mime, "encoded")
+
+    @staticmethod
+    def _encode(img, profile):
+        # 注意: img 来自共享的解码缓存，这里只能生成新对象，不能原地 thumbnail
+        scale = profile.max_side / max(img.size)
+        if scale < 1:
+            new_size = (max(1, round(img.width * scale)), max(1, round(img.height * scale)))
+            img = img.resize(new_size, import_pil().LANCZOS)
+        if profile.format == "JPEG" and img.mode not in ("RGB", "L"):
+            img = img.convert("RGB")
+
+        buffered = BytesIO()
+        save_kwargs = {"quality": profile.quality} if profile.format in ("JPEG", "WEBP") else {}
+        img.save(buffered, format=profile.format, **save_kwargs)
+        return buffered.getvalue()
+
+    def to_part(self, image_path, purpose="reference"):
+        """
+        直接返回可放进 generate_content(contents=[...]) 的 Part
+        """
+        from google.genai import types
+        payload = self.prepare(image_path, purpose)
+        return types.Part.from_bytes(data=payload.data, mime_type=payload.mime_type)
+
+    def to_image(self, image_path, purpose="video"):
+        """
+        返回 generate_videos 需要的 types.Image
+        """
+        from google.genai import types
+        payload = self.prepare(image_path, purpose)
+        return types.Image(image_bytes=payload.data, mime_type=payload.mime_type)
+
+    def report(self):
+        c = self.counts
+        return (f"📦 [Payload] 直传 {c['passthrough']} | 磁盘缓存 {c['disk_cache']} | "
+                f"重新编码 {c['encoded']} | 内存复用 {c['memory']}")
+
+
+# 进程级共享实例
+payload_preparer = PayloadPreparer()
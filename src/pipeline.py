@@ -0,0 +1,354 @@
+import os
+import time
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+# 批处理模式下识别的输入格式
+IMAGE_EXTS = ('.heic', '.heif', '.jpg', '.jpeg', '.png', '.webp')
+
+# 队列结束标记
+_DONE = object()
+
+
+def list_input_images(input_dir):
+    """
+    列出目录下所有支持的图片 (不递归)，按文件名排序保证每次运行顺序一致。
+    """
+    names = sorted(os.listdir(input_dir))
+    return [os.path.join(input_dir, n) for n in names
+            if n.lower().endswith(IMAGE_EXTS) and not n.startswith('.')]
+
+
+def render_one(generator, mixer, image_path, description, item):
+    """
+    单个风格的绘制任务：组装 Prompt -> 调用 Gemini Vision
+    返回 (style_key, save_path, error)，出错时不抛异常，方便并发汇总。
+    """
+    # 从字典中提取 key 和 creativity
+    style_key = item.get('style_key')
+    creativity = item.get('creativity', 'Medium') # 默认中等
+
+    try:
+        # A. 组装 Prompt (混合风格模板 + 描述)
+        prompt_data = mixer.mix_prompt(style_key, description)
+
+        # ✅ 关键点: 将 analyzer 决定的 creativity 塞入 prompt_data
+        # 这样 generator 里的 generate_with_ref_image 就能读到了
+        prompt_data['creativity'] = creativity
+
+        # B. 调用 Gemini Vision 生成 (原图 + 文本 + 策略)
+        save_path = generator.generate_with_ref_image(image_path, prompt_data)
+        if not save_path:
+            return style_key, None, "模型未返回图片"
+        return style_key, save_path, None
+
+    except Exception as e:
+        print(f"   ⚠️ 风格 {style_key} 生成出错: {e}")
+        return style_key, None, str(e)
+
+
+def render_recommendations(generator, mixer, image_path, description, recommendations, concurrency=0):
+    """
+    并发绘制所有推荐风格 (各风格之间互不依赖)。
+    - concurrency: 线程数上限，0 表示全部同时发出，1 等价于原来的串行循环
+    - 返回值按推荐顺序排列: [(style_key, save_path, error), ...]
+    - 某个风格失败不会取消其他风格
+    """
+    total = len(recommendations)
+    if total == 0:
+        return []
+    workers = total if concurrency <= 0 else min(concurrency, total)
+
+    for i, item in enumerate(recommendations, 1):
+        print(f"[{i}/{total}] 提交任务: {item.get('style_key')} (策略: {item.get('creativity', 'Medium')}) ...")
+
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="render") as pool:
+        futures = [pool.submit(render_one, generator, mixer, image_path, description, item)
+                   for item in recommendations]
+        # 按提交顺序取结果，保证输出顺序与推荐顺序一致
+        return [f.result() for f in futures]
+
+
+def stream_and_render(analyzer, generator, mixer, image_path, top_k=3, concurrency=0):
+    """
+    流式分析 + 边解析边绘制：每收到一个推荐就提交绘制任务，不等整个 JSON 返回。
+    返回 (analysis, results, first_seconds)；results 按推荐顺序排列，
+    first_seconds 为从开始到第一张壁纸完成的耗时 (没有成功时为 None)。
+    """
+    start = time.perf_counter()
+    workers = max(1, top_k) if concurrency <= 0 else concurrency
+    first_done = []
+    lock = threading.Lock()
+
+    def on_done(future):
+        if future.result()[1]:
+            with lock:
+                if not first_done:
+                    first_done.append(time.perf_counter() - start)
+
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="render") as pool:
+        futures = []
+
+        def on_recommendation(description, item):
+            print(f"[{len(futures) + 1}] 提交任务: {item.get('style_key')} (策略: {item.get('creativity', 'Medium')}) ...")
+            future = pool.submit(render_one, generator, mixer, image_path, description, item)
+            future.add_done_callback(on_done)
+            futures.append(future)
+
+        analysis = analyzer.analyze_streaming(image_path, top_k=top_k, on_recommendation=on_recommendation)
+        results = [f.result() for f in futures]
+    return analysis, results, (first_done[0] if first_done else None)
+
+
+def render_journaled(journal, generator, mixer, image_path, analysis, top_k=3, concurrency=0):
+    """
+    批量模式 + 任务日志：把这张照片的推荐写入日志，只绘制本进程领取到的任务。
+    - 之前已完成的任务直接返回记录的输出
+    - 正被其他 worker 处理的任务不重复绘制，结果里标记为进行中
+    返回值与 render_recommendations 相同 (按推荐顺序)
+    """
+    recommendations = analysis.get('recommendations', [])
+    job_ids = journal.enqueue(image_path, analysis, top_k)
+    claimed = {job.id for job in journal.claim_many(job_ids)}
+    todo = [item for job_id, item in zip(job_ids, recommendations) if job_id in claimed]
+    if len(todo) < len(recommendations):
+        print(f"📒 [Journal] {len(recommendations) - len(todo)} 个任务已完成或由其他 worker 处理，跳过")
+
+    rendered = iter(render_recommendations(generator, mixer, image_path, analysis.get('description', ''),
+                                           todo, concurrency=concurrency))
+    results = []
+    for job_id, job in zip(job_ids, journal.jobs(job_ids)):
+        if job_id in claimed:
+            style_key, path, error = next(rendered)
+            if path:
+                journal.complete(job_id, path)
+            else:
+                journal.fail(job_id, error)
+            results.append((style_key, path, error))
+        elif job.state == "done":
+            results.append((job.style_key, job.output, None))
+        else:
+            results.append((job.style_key, None, f"任务{job.state} (其他 worker)"))
+    return results
+
+
+def drain_journal(journal, generator, mixer, workers=4):
+    """
+    resume 模式：多个线程不断从日志领取任务并绘制，直到没有可领取的任务。
+    多个进程 (或共享文件系统上的多台机器) 同时运行时各自领取，不会重复绘制。
+    返回 [(input, style_key, save_path, error), ...] (本进程完成的任务)
+    """
+    results = []
+    lock = threading.Lock()
+
+    def worker():
+        while True:
+            job = journal.claim()
+            if job is None:
+                return
+            print(f"📒 [Journal] 领取 #{job.id}: {os.path.basename(job.input)} / {job.style_key} "
+                  f"(策略: {job.creativity}, 第 {job.attempts} 次)")
+            if not os.path.exists(job.input):
+                style_key, path, error = job.style_key, None, "输入图片不存在"
+            else:
+                item = {"style_key": job.style_key, "creativity": job.creativity}
+                style_key, path, error = render_one(generator, mixer, job.input, job.description or "", item)
+            if path:
+                journal.complete(job.id, path)
+            else:
+                journal.fail(job.id, error)
+            with lock:
+                results.append((job.input, style_key, path, error))
+
+    with ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix="journal") as pool:
+        for future in [pool.submit(worker) for _ in range(max(1, workers))]:
+            future.result()
+    return results
+
+
+class StageStats:
+    """
+    单个流水线阶段的计数器 (线程安全)：处理数量、忙碌时间、失败数
+    """
+    def __init__(self, name):
+        self.name = name
+        self.items = 0
+        self.errors = 0
+        self.busy_seconds = 0.0
+        self._lock = threading.Lock()
+
+    def record(self, seconds, ok=True):
+        with self._lock:
+            self.items += 1
+            self.busy_seconds += seconds
+            if not ok:
+                self.errors += 1
+
+    def summary_line(self, wall_seconds):
+        per_item = self.busy_seconds / self.items if self.items else 0.0
+        throughput = self.items / wall_seconds * 60 if wall_seconds > 0 else 0.0
+        utilization = self.busy_seconds / wall_seconds * 100 if wall_seconds > 0 else 0.0
+        return (f"   - {self.name:<9} 处理 {self.items} 项 (失败 {self.errors}) | "
+                f"平均 {per_item:.2f}s/项 | 吞吐 {throughput:.2f} 项/分钟 | 占用 {utilization:.0f}%")
+
+
+class BatchPipeline:
+    """
+    批量目录模式的分阶段流水线：
+
+        [analyze 线程] --(有界队列)--> [generate 阶段]
+
+    分析第 N+1 张照片时，第 N 张照片仍在绘制；队列满时分析线程阻塞 (背压)，
+    避免分析结果无限堆积在内存里。
+    analysis_batch > 1 时每 analysis_batch 张照片合并成一次 analyze_many 调用。
+    dedupe_threshold 不为 None 时先按感知哈希把连拍/近似照片分组，每组只分析代表图；
+    render_once=True 时同组的其他照片直接复用代表图的壁纸，不再绘制。
+    journal 不为 None 时所有照片与绘制任务都记录在任务日志里，中断后可用 resume 继续。
+    """
+    def __init__(self, analyzer, mixer, generator, top_k=3, concurrency=0, queue_size=2, analysis_batch=1,
+                 dedupe_threshold=None, render_once=False, journal=None):
+        self.analyzer = analyzer
+        self.mixer = mixer
+        self.generator = generator
+        self.top_k = top_k
+        self.concurrency = concurrency
+        self.queue_size = max(1, queue_size)
+        self.analysis_batch = max(1, analysis_batch)
+        self.dedupe_threshold = dedupe_threshold
+        self.render_once = render_once
+        self.journal = journal
+        self.dedupe = {"groups": 0, "duplicates": 0, "analyses_saved": 0, "renders_saved": 0}
+        self.stats = {
+            "analyze": StageStats("analyze"),
+            "generate": StageStats("generate"),
+        }
+        self.wall_seconds = 0.0
+
+    def _analyze_stage(self, image_paths, out_queue):
+        if self.analysis_batch > 1:
+            return self._analyze_stage_batched(image_paths, out_queue)
+        try:
+            for path in image_paths:
+                t0 = time.perf_counter()
+                try:
+                    analysis = self.analyzer.analyze_and_recommend(path, top_k=self.top_k)
+                    ok = bool(analysis.get('recommendations'))
+                except Exception as e:
+                    print(f"❌ [Pipeline] 分析 {os.path.basename(path)} 出错: {e}")
+                    analysis, ok = {}, False
+                self.stats["analyze"].record(time.perf_counter() - t0, ok)
+                out_queue.put((path, analysis))
+        finally:
+            out_queue.put(_DONE)
+
+    def _analyze_stage_batched(self, image_paths, out_queue):
+        try:
+            for start in range(0, len(image_paths), self.analysis_batch):
+                chunk = image_paths[start:start + self.analysis_batch]
+                t0 = time.perf_counter()
+                try:
+                    analyses = self.analyzer.analyze_many(chunk, top_k=self.top_k)
+                except Exception as e:
+                    print(f"❌ [Pipeline] 合并分析 {len(chunk)} 张图片出错: {e}")
+                    analyses = [{} for _ in chunk]
+                # 一次请求的耗时平摊到每张照片上
+                per_item = (time.perf_counter() - t0) / len(chunk)
+                for path, analysis in zip(chunk, analyses):
+                    self.stats["analyze"].record(per_item, bool(analysis.get('recommendations')))
+                    out_queue.put((path, analysis))
+        finally:
+            out_queue.put(_DONE)
+
+    def run(self, image_paths):
+        """
+        执行流水线，返回每张照片的结果 (与输入顺序一致):
+        [{"input": path, "description": str, "results": [(style_key, save_path, error), ...]}, ...]
+        """
+        start = time.perf_counter()
+        if self.journal is not None:
+            self.journal.register_inputs(image_paths, self.top_k)
+        groups = self._group(image_paths)
+        handoff = queue.Queue(maxsize=self.queue_size)
+        analyzer_thread = threading.Thread(
+            target=self._analyze_stage, args=([g[0] for g in groups], handoff),
+            name="pipeline-analyze", daemon=True
+        )
+        analyzer_thread.start()
+
+        members = {g[0]: g for g in groups}
+        photos = []
+        total = len(image_paths)
+        while True:
+            item = handoff.get()
+            if item is _DONE:
+                break
+            leader, analysis = item
+            description = analysis.get('description', '')
+            recommendations = analysis.get('recommendations', [])
+            leader_results = None
+            for path in members[leader]:
+                reused = path != leader
+                tag = f" (复用 {os.path.basename(leader)} 的分析)" if reused else ""
+                print(f"\n🖼️ [{len(photos) + 1}/{total}] {os.path.basename(path)}: {len(recommendations)} 种风格{tag}")
+
+                if reused and self.render_once:
+                    # 同组照片直接指向代表图的壁纸
+                    results = list(leader_results)
+                    self.dedupe["renders_saved"] += len(recommendations)
+                    if self.journal is not None and recommendations:
+                        self._journal_reused(path, analysis, results)
+                elif self.journal is not None and recommendations:
+                    t0 = time.perf_counter()
+                    results = render_journaled(self.journal, self.generator, self.mixer, path, analysis,
+                                               self.top_k, concurrency=self.concurrency)
+                    ok = bool(results) and all(p for _, p, _ in results)
+                    self.stats["generate"].record(time.perf_counter() - t0, ok)
+                else:
+                    t0 = time.perf_counter()
+                    results = render_recommendations(self.generator, self.mixer, path, description,
+                                                     recommendations, concurrency=self.concurrency)
+                    ok = bool(results) and all(p for _, p, _ in results)
+                    self.stats["generate"].record(time.perf_counter() - t0, ok)
+                if not reused:
+                    leader_results = results
+                photos.append({"input": path, "description": description, "results": results,
+                               "group": leader})
+
+        analyzer_thread.join()
+        self.wall_seconds = time.perf_counter() - start
+        # 分组会打乱处理顺序，按输入顺序返回
+        order = {path: i for i, path in enumerate(image_paths)}
+        photos.sort(key=lambda photo: order[photo["input"]])
+        return photos
+
+    def _journal_reused(self, path, analysis, results):
+        # 复用代表图壁纸的照片: 任务直接记为完成 (代表图失败的风格记为失败，resume 时会单独重画)
+        for job_id, (_, output, error) in zip(self.journal.enqueue(path, analysis, self.top_k), results):
+            if output:
+                self.journal.complete(job_id, output)
+            else:
+                self.journal.fail(job_id, error)
+
+    def _group(self, image_paths):
+        if self.dedupe_threshold is None:
+            return [[path] for path in image_paths]
+        from src.dedupe import group_near_duplicates
+        groups = group_near_duplicates(image_paths, self.dedupe_threshold)
+        duplicates = len(image_paths) - len(groups)
+        self.dedupe.update(groups=len(groups), duplicates=duplicates, analyses_saved=duplicates)
+        print(f"🔍 [Dedupe] {len(image_paths)} 张照片分为 {len(groups)} 组 "
+              f"(汉明距离 <= {self.dedupe_threshold}, 近似重复 {duplicates} 张)")
+        for group in groups:
+            if len(group) > 1:
+                print(f"   - {os.path.basename(group[0])} <- {', '.join(os.path.basename(p) for p in group[1:])}")
+        return groups
+
+    def print_summary(self):
+        print(f"\n📊 [Pipeline] 阶段吞吐统计 (总耗时 {self.wall_seconds:.2f}s):")
+        for stage in self.stats.values():
+            print(stage.summary_line(self.wall_seconds))
+        if self.dedupe_threshold is not None:
+            d = self.dedupe
+            print(f"🔍 [Dedupe] {d['groups']} 组 / 近似重复 {d['duplicates']} 张 | "
+                  f"节省分析调用 {d['analyses_saved']} 次 | 节省绘图调用 {d['renders_saved']} 次")
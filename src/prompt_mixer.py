@@ -1,40 +1,45 @@
-import yaml
-import os
+from src.style_registry import get_style_registry
 
 class PromptMixer:
     def __init__(self, config_path="config/styles.yaml"):
-        if not os.path.exists(config_path):
-            raise FileNotFoundError(f"❌ 找不到配置文件: {config_path}")
-            
-        with open(config_path, 'r', encoding='utf-8') as f:
-            self.config = yaml.safe_load(f)
-            self.styles = self.config.get('styles', {})
+        # 共享的 StyleRegistry: 模板已预编译，文件修改后自动热加载
+        self.style_registry = get_style_registry(config_path)
+
+    @property
+    def config(self):
+        return self.style_registry.config
+
+    @property
+    def styles(self):
+        return self.style_registry.config.get('styles', {})
 
     def mix_prompt(self, style_key, image_description):
         """
         核心逻辑：将 'Gemini的描述' 注入 '风格模板'
         """
-        if style_key not in self.styles:
+        registry = self.style_registry
+        style = registry.get(style_key)
+        if style is None:
             print(f"⚠️ 警告: 风格 '{style_key}' 不存在，回退到默认风格。")
             # 如果找不到，就找一个存在的，或者直接返回描述
-            style_key = list(self.styles.keys())[0] if self.styles else None
-            
-        style_data = self.styles.get(style_key, {})
-        style_name = style_data.get('name', style_key)
-        template = style_data.get('prompt_template', '{description}')
+            style_key = registry.default_key
+            style = registry.get(style_key)
+
+        if style is None:
+            return {
+                "style_name": style_key,
+                "style_key": style_key,
+                "prompt": image_description,
+                "negative_prompt": ""
+            }
         
-        # 1. 填空：把 Gemini 的描述填入 {description}
-        if "{description}" in template:
-            final_prompt = template.format(description=image_description)
-        else:
-            final_prompt = f"{template}, {image_description}"
+        # 1. 填空：把 Gemini 的描述填入预编译模板的 {description}
+        final_prompt = registry.render_prompt(style, image_description)
             
         # 2. 获取负向提示词 (Imagen 会用到 --no 参数)
-        negative_prompt = style_data.get('negative_prompt', '')
-        
         return {
-            "style_name": style_name,
+            "style_name": style.name,
             "style_key": style_key,
             "prompt": final_prompt,
-            "negative_prompt": negative_prompt
+            "negative_prompt": style.negative_prompt
         }
\ No newline at end of file
@@ -0,0 +1,303 @@
+import os
+import json
+import time
+import base64
+import asyncio
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
+from src.utils import file_sha256, atomic_write_bytes
+from src.tracing import span
+
+# 上传图片的扩展名 (按文件头识别)
+_MAGIC = [(b"\x89PNG", ".png"), (b"\xff\xd8", ".jpg"), (b"RIFF", ".webp")]
+
+REASONS = {200: "OK", 400: "Bad Request", 403: "Forbidden", 404: "Not Found", 405: "Method Not Allowed",
+           413: "Payload Too Large", 429: "Too Many Requests", 500: "Internal Server Error",
+           502: "Bad Gateway"}
+
+# 单次请求允许的推荐风格数上限
+MAX_TOP_K = 10
+
+
+class HTTPError(Exception):
+    def __init__(self, status, message, headers=None):
+        super().__init__(message)
+        self.status = status
+        self.message = message
+        self.headers = headers or {}
+
+
+class WallpaperService:
+    """
+    常驻 HTTP 服务 (asyncio.start_server，无额外依赖)：
+        POST /analyze   {"image": 路径 | "image_b64": ..., "top_k": 3}
+        POST /generate  {"image": ..., "style_key": ..., "creativity": "Medium", "description": 可选}
+        POST /motion    {"image": 壁纸路径 | "image_b64": ..., "style_key": 可选, "render_video": false}
+        GET  /health
+    - 分析器 / 绘图器 / 运动导演、客户端连接池与风格库在进程内常驻，每个请求不再重新初始化
+    - 模型调用都是阻塞的，放进线程池执行；事件循环只负责收发
+    - 请求合并: 同一 (接口, 图片内容哈希, 风格, 参数) 正在执行时，后来的请求直接等同一个结果
+    - 准入控制: 正在执行 + 排队的上游任务达到 workers + queue_size 时直接返回 429 (合并的请求不占名额)
+    - "image" 路径只能落在 upload_dir 或 allowed_roots 配置的目录内 (按 realpath 判断，符号链接也跑不出去)，否则 403
+    """
+    def __init__(self, analyzer, generator, mixer, director=None, settings=None):
+        settings = settings or {}
+        self.analyzer = analyzer
+        self.generator = generator
+        self.mixer = mixer
+        self._director = director
+        self.workers = settings.get("workers", 8)
+        self.queue_size = settings.get("queue_size", 32)
+        self.max_body_bytes = int(settings.get("max_body_mb", 25) * 1024 * 1024)
+        self.upload_dir = settings.get("upload_dir", "assets/uploads")
+        # 上传目录总是允许 (/motion 要读 upload_dir/outputs/ 下生成的壁纸)
+        roots = [self.upload_dir, *settings.get("allowed_roots", [])]
+        self.allowed_roots = [os.path.realpath(root) for root in roots]
+        self.retry_after = settings.get("retry_after", 5)
+
+        self._pool = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="serve")
+        self._inflight = {}   # 合并 key -> asyncio.Future
+        self._admitted = 0    # 已接纳、尚未完成的上游任务数
+        self.stats = {"requests": 0, "upstream": 0, "coalesced": 0, "rejected": 0, "errors": 0}
+        self._routes = {
+            ("POST", "/analyze"): self.handle_analyze,
+            ("POST", "/generate"): self.handle_generate,
+            ("POST", "/motion"): self.handle_motion,
+            ("GET", "/health"): self.handle_health,
+        }
+
+    @property
+    def director(self):
+        # 运动导演首次调用 /motion 时才创建
+        if self._director is None:
+            from src.motion_director import MotionDirector
+            self._director = MotionDirector(registry=self.analyzer.registry)
+        return self._director
+
+    # ------------------------------------------------------------------
+    # 合并 + 准入
+    # ------------------------------------------------------------------
+    async def submit(self, key, fn, *args):
+        """
+        在线程池里执行 fn(*args)；相同 key 的任务正在执行时直接复用它的结果
+        """
+        future = self._inflight.get(key)
+        if future is not None:
+            self.stats["coalesced"] += 1
+            return await asyncio.shield(future)
+        if self._admitted >= self.workers + self.queue_size:
+            self.stats["rejected"] += 1
+            raise HTTPError(429, "服务繁忙，请稍后重试", {"Retry-After": str(self.retry_after)})
+
+        loop = asyncio.get_running_loop()
+        future = loop.run_in_executor(self._pool, fn, *args)
+        self._inflight[key] = future
+        self._admitted += 1
+        self.stats["upstream"] += 1
+        # 名额在上游任务结束时归还，发起请求的连接提前断开也不影响
+        future.add_done_callback(lambda f: self._release(key, f))
+        return await asyncio.shield(future)
+
+    def _release(self, key, future):
+        if self._inflight.get(key) is future:
+            del self._inflight[key]
+        self._admitted -= 1
+
+    # ------------------------------------------------------------------
+    # 接口
+    # ------------------------------------------------------------------
+    def _resolve_image(self, body):
+        """
+        请求里的图片: 本机路径 ("image") 或 base64 内容 ("image_b64")，返回 (路径, 内容哈希)
+        上传的内容按哈希存到 upload_dir/inputs/，同一张图只存一份 (输出会落在 upload_dir/outputs/)
+        """
+        if body.get("image_b64"):
+            try:
+                data = base64.b64decode(body["image_b64"], validate=True)
+            except ValueError:
+                raise HTTPError(400, "image_b64 不是合法的 base64")
+            digest = hashlib.sha256(data).hexdigest()
+            ext = next((e for magic, e in _MAGIC if data.startswith(magic)), ".heic")
+            path = os.path.join(self.upload_dir, "inputs", f"{digest[:16]}{ext}")
+            if not os.path.exists(path):
+                atomic_write_bytes(path, data)
+            return path, digest
+        path = body.get("image")
+        if not path:
+            raise HTTPError(400, "缺少 image 或 image_b64")
+        if not isinstance(path, str):
+            raise HTTPError(400, "image 必须是路径字符串")
+        if not self._allowed(path):
+            raise HTTPError(403, f"不允许读取该路径: {path}")
+        if not os.path.isfile(path):
+            raise HTTPError(400, f"找不到图片: {path}")
+        return path, file_sha256(path)
+
+    def _allowed(self, path):
+        real = os.path.realpath(path)
+        return any(os.path.commonpath([real, root]) == root for root in self.allowed_roots)
+
+    @staticmethod
+    def _top_k(body):
+        top_k = body.get("top_k", 3)
+        # bool 是 int 的子类，true/false 不算合法数量
+        if isinstance(top_k, bool) or not isinstance(top_k, int) or not 1 <= top_k <= MAX_TOP_K:
+            raise HTTPError(400, f"top_k 必须是 1-{MAX_TOP_K} 的整数")
+        return top_k
+
+    async def handle_analyze(self, body):
+        top_k = self._top_k(body)
+        path, digest = await asyncio.to_thread(self._resolve_image, body)
+        result = await self.submit(("analyze", digest, top_k), self.analyzer.analyze_and_recommend, path, top_k)
+        return 200, dict(result, image=path)
+
+    async def handle_generate(self, body):
+        from src.pipeline import render_one
+        path, digest = await asyncio.to_thread(self._resolve_image, body)
+        style_key = body.get("style_key")
+        if not style_key:
+            raise HTTPError(400, "缺少 style_key")
+        if self.analyzer.style_registry.get(style_key) is None:
+            raise HTTPError(400, f"未知风格: {style_key}")
+        creativity = body.get("creativity", "Medium")
+        description = body.get("description")
+        if not description:
+            # 没带描述时先分析 (与 /analyze 共享合并与缓存)
+            top_k = self._top_k(body)
+            analysis = await self.submit(("analyze", digest, top_k), self.analyzer.analyze_and_recommend,
+                                         path, top_k)
+            description = analysis.get("description", "")
+        item = {"style_key": style_key, "creativity": creativity}
+        key = ("generate", digest, style_key, creativity, hashlib.sha256(description.encode("utf-8")).hexdigest())
+        _, output, error = await self.submit(key, render_one, self.generator, self.mixer, path, description, item)
+        status = 200 if output else 502
+        return status, {"image": path, "style_key": style_key, "creativity": creativity, "output": output,
+                        "error": error}
+
+    async def handle_motion(self, body):
+        path, digest = await asyncio.to_thread(self._resolve_image, body)
+        director = self.director
+        # resolve_style 会查资产目录 (SQLite)，不能放在事件循环上
+        style_key = body.get("style_key") or await asyncio.to_thread(director.resolve_style, path)
+        video_prompt = await self.submit(("motion", digest, style_key), director.analyze_scene_for_motion,
+                                         path, style_key)
+        result = {"image": path, "style_detected": style_key, "video_prompt": video_prompt}
+        if body.get("render_video"):
+            # Veo 渲染要 1-2 分钟，同一张图 + 同一脚本只拍一次
+            key = ("video", digest, hashlib.sha256(video_prompt.encode("utf-8")).hexdigest())
+            video = await self.submit(key, director.generate_video, path, video_prompt)
+            result["video"] = video or None
+            return (200 if video else 502), result
+        return 200, result
+
+    async def handle_health(self, body):
+        return 200, {"status": "ok", "in_flight": self._admitted, "capacity": self.workers + self.queue_size,
+                     **self.stats}
+
+    # ------------------------------------------------------------------
+    # HTTP
+    # ------------------------------------------------------------------
+    async def handle_connection(self, reader, writer):
+        try:
+            while True:
+                request = await self._read_request(reader, writer)
+                if request is None:
+                    break
+                method, path, headers, body = request
+                status, payload, extra = await self._dispatch(method, path, body)
+                keep_alive = headers.get("connection", "").lower() != "close"
+                await self._write_response(writer, status, payload, extra, keep_alive)
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def _read_request(self, reader, writer):
+        try:
+            line = await reader.readline()
+            if not line.strip():
+                return None
+            try:
+                method, target, _ = line.decode("latin-1").split(" ", 2)
+            except ValueError:
+                await self._write_response(writer, 400, {"error": "请求行格式错误"}, {}, False)
+                return None
+            headers = {}
+            while True:
+                header = await reader.readline()
+                if header in (b"\r\n", b"\n", b""):
+                    break
+                name, _, value = header.decode("latin-1").partition(":")
+                headers[name.strip().lower()] = value.strip()
+        except (ValueError, asyncio.LimitOverrunError):
+            # 单行超过 StreamReader 的长度上限 (readline 抛 ValueError)
+            await self._write_response(writer, 400, {"error": "请求行或请求头过长"}, {}, False)
+            return None
+        raw_length = headers.get("content-length") or "0"
+        if not (raw_length.isascii() and raw_length.isdigit()):
+            # 只接受 ASCII 数字: 同时排除负数、空白与其他字符
+            await self._write_response(writer, 400, {"error": f"Content-Length 不合法: {raw_length}"}, {}, False)
+            return None
+        length = int(raw_length)
+        if length > self.max_body_bytes:
+            await self._write_response(writer, 413, {"error": "请求体过大"}, {}, False)
+            return None
+        body = await reader.readexactly(length) if length else b""
+        return method.upper(), target.split("?", 1)[0], headers, body
+
+    async def _dispatch(self, method, path, raw_body):
+        self.stats["requests"] += 1
+        start = time.perf_counter()
+        handler = self._routes.get((method, path))
+        try:
+            if handler is None:
+                known = any(p == path for _, p in self._routes)
+                raise HTTPError(405 if known else 404, f"不支持的请求: {method} {path}")
+            try:
+                body = json.loads(raw_body) if raw_body else {}
+            except ValueError:
+                raise HTTPError(400, "请求体不是合法的 JSON")
+            if not isinstance(body, dict):
+                raise HTTPError(400, "请求体必须是 JSON 对象")
+            with span("server.request", path=path):
+                status, payload = await handler(body)
+            extra = {}
+        except HTTPError as e:
+            status, payload, extra = e.status, {"error": e.message}, e.headers
+        except Exception as e:
+            self.stats["errors"] += 1
+            print(f"❌ [Server] {method} {path} 出错: {e}")
+            status, payload, extra = 500, {"error": str(e)}, {}
+        print(f"🌐 [Server] {method} {path} -> {status} ({time.perf_counter() - start:.2f}s)")
+        return status, payload, extra
+
+    @staticmethod
+    async def _write_response(writer, status, payload, extra, keep_alive):
+        data = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+        headers = {
+            "Content-Type": "application/json; charset=utf-8",
+            "Content-Length": str(len(data)),
+            "Connection": "keep-alive" if keep_alive else "close",
+            **extra,
+        }
+        head = f"HTTP/1.1 {status} {REASONS.get(status, 'OK')}\r\n"
+        head += "".join(f"{k}: {v}\r\n" for k, v in headers.items()) + "\r\n"
+        writer.write(head.encode("latin-1") + data)
+        await writer.drain()
+
+    async def serve(self, host="127.0.0.1", port=8765):
+        server = await asyncio.start_server(self.handle_connection, host, port)
+        addresses = ", ".join(f"{s.getsockname()[0]}:{s.getsockname()[1]}" for s in server.sockets)
+        print(f"🌐 [Server] 已启动: http://{addresses} ({self.workers} 个工作线程, 队列 {self.queue_size})")
+        async with server:
+            await server.serve_forever()
+
+    def close(self):
+        self._pool.shutdown(wait=False, cancel_futures=True)
+
+    def report(self):
+        s = self.stats
+        return (f"🌐 [Server] 请求 {s['requests']} | 上游任务 {s['upstream']} | 合并 {s['coalesced']} | "
+                f"拒绝 (429) {s['rejected']} | 异常 {s['errors']}")
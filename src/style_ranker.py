@@ -0,0 +1,280 @@
+import os
+import json
+import hashlib
+import threading
+from io import BytesIO
+import numpy as np
+from src.utils import load_image_safe, import_pil, atomic_write_bytes
+from src.style_registry import get_style_registry
+from src.tracing import span
+
+# 特征向量布局 (float32, 共 18 维):
+#   0-11  色相直方图 (12 档 x 30°，按 饱和度 x 明度 加权，归一化)
+#   12/13 饱和度 均值/标准差   14/15 明度 均值/标准差
+#   16    边缘密度 (梯度幅值超过阈值的像素比例)   17 色彩丰富度 (Hasler-Süsstrunk, /150)
+HUE_BINS = 12
+SAT_MEAN, SAT_STD, VAL_MEAN, VAL_STD, EDGE, COLORFUL = range(HUE_BINS, HUE_BINS + 6)
+FEATURE_DIM = HUE_BINS + 6
+THUMB_SIDE = 128
+EDGE_THRESHOLD = 0.12
+
+# 距离权重: 色相分布只是参考，亮度/饱和度/纹理更能区分风格
+WEIGHTS = np.array([0.6] * HUE_BINS + [1.5, 0.8, 1.5, 1.0, 1.5, 1.2], dtype=np.float32)
+
+# 没有任何提示时的“中性”画面
+NEUTRAL = np.array([1.0 / HUE_BINS] * HUE_BINS + [0.35, 0.2, 0.5, 0.22, 0.12, 0.3], dtype=np.float32)
+
+# styles.yaml 文本里的关键词 -> 特征调整 (出现在 negative_prompt 里时按相反方向、一半力度)
+KEYWORD_RULES = [
+    (("saturated", "vibrant", "vivid", "neon", "bold color", "pop art"), {SAT_MEAN: 0.25, COLORFUL: 0.3}),
+    (("monochrom", "black and white", "grayscale", "ink wash", "sumi-e"), {SAT_MEAN: -0.3, COLORFUL: -0.3}),
+    (("pastel", "muted", "matte", "earthy", "faded", "desaturated"), {SAT_MEAN: -0.12, COLORFUL: -0.1}),
+    (("dark", "noir", "night", "shadow", "low-key", "moody"), {VAL_MEAN: -0.18, VAL_STD: 0.05}),
+    (("bright", "airy", "sunlit", "sunbeam", "high-key", "clean white"), {VAL_MEAN: 0.15}),
+    (("high contrast", "dramatic", "chiaroscuro", "hard light"), {VAL_STD: 0.1}),
+    (("detailed", "sharp", "intricate", "pixel", "line art", "comic", "halftone"), {EDGE: 0.1}),
+    (("minimal", "smooth", "soft focus", "blur", "frosted", "negative space"), {EDGE: -0.07}),
+]
+HUE_KEYWORDS = [
+    (("amber", "warm", "golden", "orange", "sunset"), (0, 1)),
+    (("green", "forest", "foliage"), (3, 4)),
+    (("azure", "blue", "teal", "cyan"), (6, 7)),
+    (("magenta", "pink", "purple", "violet"), (9, 10)),
+]
+
+
+def image_features(images):
+    """
+    批量提取特征: images 为 N 张 RGB 缩略图的 uint8 数组 (N x H x W x 3) -> N x FEATURE_DIM
+    """
+    rgb = images.astype(np.float32) / 255.0
+    r, g, b = rgb[..., 0], rgb[..., 1], rgb[..., 2]
+    cmax = rgb.max(axis=-1)
+    cmin = rgb.min(axis=-1)
+    delta = cmax - cmin
+    val = cmax
+    sat = np.where(cmax > 0, delta / np.maximum(cmax, 1e-6), 0.0)
+
+    # 向量化 RGB -> Hue (0~1)
+    safe = np.maximum(delta, 1e-6)
+    hue = np.where(cmax == r, ((g - b) / safe) % 6,
+                   np.where(cmax == g, (b - r) / safe + 2, (r - g) / safe + 4)) / 6.0
+    n = len(images)
+    bins = np.minimum((hue * HUE_BINS).astype(np.int64), HUE_BINS - 1).reshape(n, -1)
+    weights = (sat * val).reshape(n, -1)
+    hist = np.zeros((n, HUE_BINS), dtype=np.float32)
+    np.add.at(hist, (np.repeat(np.arange(n), bins.shape[1]), bins.ravel()), weights.ravel())
+    total = hist.sum(axis=1, keepdims=True)
+    hist = np.where(total > 0, hist / np.maximum(total, 1e-6), 1.0 / HUE_BINS)
+
+    gray = 0.299 * r + 0.587 * g + 0.114 * b
+    gx = np.abs(np.diff(gray, axis=2))[:, :-1, :]
+    gy = np.abs(np.diff(gray, axis=1))[:, :, :-1]
+    edge = ((gx + gy) > EDGE_THRESHOLD).reshape(n, -1).mean(axis=1)
+
+    rg = r - g
+    yb = 0.5 * (r + g) - b
+    colorful = (np.sqrt(rg.reshape(n, -1).std(axis=1) ** 2 + yb.reshape(n, -1).std(axis=1) ** 2)
+                + 0.3 * np.sqrt(rg.reshape(n, -1).mean(axis=1) ** 2 + yb.reshape(n, -1).mean(axis=1) ** 2))
+
+    stats = np.stack([
+        sat.reshape(n, -1).mean(axis=1), sat.reshape(n, -1).std(axis=1),
+        val.reshape(n, -1).mean(axis=1), val.reshape(n, -1).std(axis=1),
+        edge, np.minimum(colorful * 255 / 150, 1.5),
+    ], axis=1)
+    return np.concatenate([hist, stats], axis=1).astype(np.float32)
+
+
+def load_thumbnails(image_paths, side=THUMB_SIDE):
+    """
+    通过共享解码缓存读取图片并缩放成 side x side 的 RGB 数组
+    """
+    Image = import_pil()
+    thumbs = []
+    for path in image_paths:
+        img = load_image_safe(path).convert("RGB").resize((side, side), Image.BILINEAR)
+        thumbs.append(np.asarray(img, dtype=np.uint8))
+    return np.stack(thumbs)
+
+
+def text_prior(style):
+    """
+    从 styles.yaml 的模板与负面词推导一个“先验”样例向量
+    """
+    vector = NEUTRAL.copy()
+    positive = style.template.lower()
+    negative = (style.negative_prompt or "").lower()
+    for words, deltas in KEYWORD_RULES:
+        sign = (1.0 if any(w in positive for w in words) else 0.0) - \
+               (0.5 if any(w in negative for w in words) else 0.0)
+        for dim, delta in deltas.items():
+            vector[dim] += sign * delta
+    hue = np.zeros(HUE_BINS, dtype=np.float32)
+    for words, dims in HUE_KEYWORDS:
+        if any(w in positive for w in words):
+            hue[list(dims)] += 1.0
+    if hue.sum() > 0:
+        vector[:HUE_BINS] = 0.5 * NEUTRAL[:HUE_BINS] + 0.5 * hue / hue.sum()
+    return np.clip(vector, 0.0, 1.5)
+
+
+def creativity_for(style):
+    """
+    本地模式下的重绘策略: 按 recommended_denoising 映射到 High / Medium / Low
+    """
+    denoising = float(style.data.get("recommended_denoising", 0.6))
+    if denoising >= 0.7:
+        return "High"
+    if denoising >= 0.5:
+        return "Medium"
+    return "Low"
+
+
+def describe(features):
+    """
+    根据特征拼一句简单的英文画面描述 (本地模式没有模型描述时使用)
+    """
+    brightness = features[VAL_MEAN]
+    saturation = features[SAT_MEAN]
+    tone = "bright" if brightness > 0.6 else "dark, moody" if brightness < 0.35 else "balanced"
+    color = "vivid, colorful" if saturation > 0.45 else "muted, soft-toned" if saturation < 0.2 else "naturally colored"
+    texture = "richly detailed" if features[EDGE] > 0.18 else "calm, uncluttered" if features[EDGE] < 0.06 else ""
+    return ", ".join(p for p in (f"A {tone}", color, texture) if p) + " scene from the reference photo"
+
+
+class StyleRanker:
+    """
+    本地风格预排序：图片特征 -> 最近邻风格样例
+    - 每个风格的样例 = styles.yaml 文本先验 + exemplar_dirs/<style_key>/ 下的样例图片
+    - 样例矩阵预先计算并缓存到 .cache/style_index.npz (风格配置或样例图片变化时重建)
+    - rank() 对一批图片一次矩阵运算得到所有风格的距离，每个风格取最近样例
+    """
+    def __init__(self, styles_path="config/styles.yaml", settings=None):
+        settings = settings or {}
+        self.style_registry = get_style_registry(styles_path)
+        self.exemplar_dirs = [d for d in settings.get("exemplar_dirs", ["config/style_exemplars"]) if d]
+        self.index_path = settings.get("index_path", ".cache/style_index.npz")
+        self._lock = threading.Lock()
+        self._index = None
+
+    def _exemplar_files(self):
+        files = []
+        for base in self.exemplar_dirs:
+            if not os.path.isdir(base):
+                continue
+            for style_key in sorted(os.listdir(base)):
+                style_dir = os.path.join(base, style_key)
+                if not os.path.isdir(style_dir):
+                    continue
+                for name in sorted(os.listdir(style_dir)):
+                    if not name.startswith("."):
+                        files.append((style_key, os.path.join(style_dir, name)))
+        return files
+
+    def _signature(self, files):
+        styles = self.style_registry.styles
+        parts = [(k, s.template, s.negative_prompt) for k, s in styles.items()]
+        for _, path in files:
+            st = os.stat(path)
+            parts.append((path, st.st_mtime_ns, st.st_size))
+        return hashlib.sha256(json.dumps(parts, ensure_ascii=False).encode("utf-8")).hexdigest()
+
+    def _build(self, files, signature):
+        styles = self.style_registry.styles
+        keys = list(styles)
+        vectors = [text_prior(styles[k]) for k in keys]
+        owners = list(range(len(keys)))
+        sample_files = [(k, p) for k, p in files if k in styles]
+        usable = []
+        for style_key, path in sample_files:
+            try:
+                load_image_safe(path)
+                usable.append((style_key, path))
+            except Exception as e:
+                print(f"⚠️ [Ranker] 跳过无法读取的样例 {path}: {e}")
+        if usable:
+            features = image_features(load_thumbnails([p for _, p in usable]))
+            vectors.extend(features)
+            owners.extend(keys.index(k) for k, _ in usable)
+        index = {
+            "keys": np.array(keys),
+            "vectors": np.stack(vectors).astype(np.float32),
+            "owners": np.array(owners, dtype=np.int32),
+            "signature": np.array(signature),
+        }
+        if self.index_path:
+            buffered = BytesIO()
+            np.savez(buffered, **index)
+            try:
+                atomic_write_bytes(self.index_path, buffered.getvalue())
+            except OSError as e:
+                print(f"⚠️ [Ranker] 索引写入失败 (不影响运行): {e}")
+        print(f"🧭 [Ranker] 已建立风格索引: {len(keys)} 种风格, {len(usable)} 张样例图")
+        return index
+
+    @property
+    def index(self):
+        with self._lock:
+            files = self._exemplar_files()
+            signature = self._signature(files)
+            if self._index is not None and str(self._index["signature"]) == signature:
+                return self._index
+            if self.index_path and os.path.exists(self.index_path):
+                try:
+                    with np.load(self.index_path) as cached:
+                        if str(cached["signature"]) == signature:
+                            self._index = {k: cached[k] for k in cached.files}
+                            return self._index
+                except Exception:
+                    pass  # 索引损坏，重建
+            self._index = self._build(files, signature)
+            return self._index
+
+    def rank(self, image_paths):
+        """
+        返回每张图片的 (特征向量, [(style_key, 距离), ...] 按距离升序)
+        """
+        index = self.index
+        with span("ranker.rank", images=len(image_paths)):
+            features = image_features(load_thumbnails(image_paths))
+            diff = (features[:, None, :] - index["vectors"][None, :, :]) * WEIGHTS
+            distances = np.sqrt((diff ** 2).sum(axis=2))          # N x 样例数
+            per_style = np.full((len(image_paths), len(index["keys"])), np.inf, dtype=np.float32)
+            np.minimum.at(per_style.T, index["owners"], distances.T)
+            order = np.argsort(per_style, axis=1)
+        keys = index["keys"]
+        return [
+            (features[i], [(str(keys[j]), float(per_style[i, j])) for j in order[i]])
+            for i in range(len(image_paths))
+        ]
+
+    def shortlist(self, image_path, size=8):
+        return [key for key, _ in self.rank([image_path])[0][1][:size]]
+
+    def analyze_local(self, image_path, top_k=3):
+        """
+        纯本地分析 (不调用模型)，返回结构与 ImageAnalyzer.analyze_and_recommend 相同
+        """
+        features, ranked = self.rank([image_path])[0]
+        styles = self.style_registry.styles
+        return {
+            "description": describe(features),
+            "recommendations": [{"style_key": key, "creativity": creativity_for(styles[key])}
+                                for key, _ in ranked[:top_k]],
+            "reasoning": "local pre-ranker (nearest style exemplars)",
+        }
+
+
+_rankers = {}
+_rankers_lock = threading.Lock()
+
+
+def get_style_ranker(styles_path="config/styles.yaml", settings=None):
+    """
+    同一份风格库共用一个排序器 (索引只建一次)；settings 对应 settings.yaml -> style_ranker
+    """
+    key = os.path.abspath(styles_path)
+    with _rankers_lock:
+        if key not in _rankers:
+            _rankers[key] = StyleRanker(styles_path, settings)
+        return _rankers[key]
@@ -0,0 +1,238 @@
+import os
+import json
+import time
+import pickle
+import hashlib
+import threading
+from string import Formatter
+from collections import namedtuple
+from src.utils import atomic_write_bytes
+
+# 编译后的单个风格:
+# - segments: 模板拆成的 (文本, 是否插入描述) 片段，渲染时只做字符串拼接
+# - needs_format: 模板里有 {description} 以外的占位符时退回 str.format
+CompiledStyle = namedtuple("CompiledStyle", [
+    "key", "name", "category", "template", "segments", "has_placeholder", "needs_format",
+    "negative_prompt", "motion_guide", "data",
+])
+
+SNAPSHOT_VERSION = 2
+
+
+def compile_template(template):
+    segments = []
+    has_placeholder = False
+    needs_format = False
+    for literal, field, _, _ in Formatter().parse(template):
+        if literal:
+            segments.append((literal, False))
+        if field is None:
+            continue
+        if field == "description":
+            segments.append(("", True))
+            has_placeholder = True
+        else:
+            needs_format = True
+    return tuple(segments), has_placeholder, needs_format
+
+
+def _one_line(text):
+    return " ".join(str(text or "").split())
+
+
+def library_text(styles):
+    """
+    风格详情 (key / 名称 / 类别 / 画面特征 / 需要避免的元素)，作为分析 Prompt 静态前缀的一部分
+    """
+    lines = []
+    for key, style in styles.items():
+        look = _one_line(style.template.replace("{description}", ""))
+        denoise = style.data.get("recommended_denoising")
+        header = f"- {key} | {style.name} | {style.category or '-'}"
+        if denoise is not None:
+            header += f" | denoising {denoise}"
+        lines.append(header)
+        lines.append(f"  Look: {look}")
+        if style.negative_prompt:
+            lines.append(f"  Avoid: {_one_line(style.negative_prompt)}")
+    return "\n".join(lines)
+
+
+def motion_library_text(styles):
+    """
+    各风格的运动原则汇总，作为运动导演 Prompt 静态前缀的一部分
+    """
+    return "\n".join(f"- {key}: {_one_line(style.motion_guide)}"
+                     for key, style in styles.items() if style.motion_guide)
+
+
+def compile_styles(config):
+    """
+    把 styles.yaml 的原始字典编译成运行时快照
+    """
+    styles = {}
+    for key, data in (config.get('styles') or {}).items():
+        template = data.get('prompt_template', '{description}')
+        try:
+            segments, has_placeholder, needs_format = compile_template(template)
+        except ValueError:
+            # 模板里有不成对的花括号，交给 str.format 在渲染时报错，与原行为一致
+            segments, has_placeholder, needs_format = (), "{description}" in template, True
+        styles[key] = CompiledStyle(
+            key=key,
+            name=data.get('name', key),
+            category=data.get('category', ''),
+            template=template,
+            segments=segments,
+            has_placeholder=has_placeholder,
+            needs_format=needs_format,
+            negative_prompt=data.get('negative_prompt', ''),
+            motion_guide=data.get('motion_guide'),
+            data=data,
+        )
+
+    style_menu = {k: s.name for k, s in styles.items()}
+    menu_json = json.dumps(style_menu, ensure_ascii=False)
+    return {
+        "version": SNAPSHOT_VERSION,
+        "config": config,
+        "styles": styles,
+        "style_menu": style_menu,
+        "style_menu_json": menu_json,
+        "library_text": library_text(styles),
+        "motion_library_text": motion_library_text(styles),
+        "menu_hash": hashlib.sha256(
+            json.dumps(style_menu, ensure_ascii=False, sort_keys=True).encode("utf-8")
+        ).hexdigest(),
+        "default_key": next(iter(styles), None),
+    }
+
+
+class StyleRegistry:
+    """
+    styles.yaml 的唯一加载入口，所有模块共享同一份编译结果：
+    - 解析结果以二进制快照 (pickle) 缓存在磁盘上，按文件 mtime + 大小失效
+    - prompt 模板预先拆分，渲染只做拼接
+    - 风格菜单 JSON 与风格详情 / 运动原则汇总预先生成，供 Analyzer / 运动导演直接拼进 prompt
+    - 文件被修改后自动热加载 (最多每 check_interval 秒 stat 一次)
+    """
+    def __init__(self, path="config/styles.yaml", snapshot_dir=".cache/styles", check_interval=1.0):
+        if not os.path.exists(path):
+            raise FileNotFoundError(f"❌ 找不到配置: {path}")
+        self.path = path
+        self.snapshot_dir = snapshot_dir
+        self.check_interval = check_interval
+        self._lock = threading.Lock()
+        self._signature = None
+        self._checked_at = 0.0
+        self._snapshot = None
+        self._reload_if_changed(force=True)
+
+    def _snapshot_path(self):
+        name = hashlib.sha1(os.path.abspath(self.path).encode("utf-8")).hexdigest()
+        return os.path.join(self.snapshot_dir, f"{name}.pickle")
+
+    def _load_snapshot(self, signature):
+        snapshot_path = self._snapshot_path() if self.snapshot_dir else None
+        if snapshot_path and os.path.exists(snapshot_path):
+            try:
+                with open(snapshot_path, "rb") as f:
+                    cached = pickle.load(f)
+                if cached.get("signature") == signature and cached.get("version") == SNAPSHOT_VERSION:
+                    return cached
+            except Exception:
+                pass  # 快照损坏或版本不兼容，重新解析
+
+        # 快照命中时完全不需要 yaml
+        import yaml
+        with open(self.path, 'r', encoding='utf-8') as f:
+            snapshot = compile_styles(yaml.safe_load(f) or {})
+        snapshot["signature"] = signature
+        if snapshot_path:
+            try:
+                atomic_write_bytes(snapshot_path, pickle.dumps(snapshot, protocol=pickle.HIGHEST_PROTOCOL))
+            except OSError as e:
+                print(f"⚠️ [Styles] 快照写入失败 (不影响运行): {e}")
+        return snapshot
+
+    def _reload_if_changed(self, force=False):
+        now = time.monotonic()
+        if not force and now - self._checked_at < self.check_interval:
+            return
+        with self._lock:
+            self._checked_at = now
+            st = os.stat(self.path)
+            signature = (st.st_mtime_ns, st.st_size)
+            if signature == self._signature:
+                return
+            reloaded = self._snapshot is not None
+            self._snapshot = self._load_snapshot(signature)
+            self._signature = signature
+        if reloaded:
+            print(f"♻️ [Styles] 检测到 {self.path} 变化，已重新加载 ({len(self._snapshot['styles'])} 种风格)")
+
+    @property
+    def snapshot(self):
+        self._reload_if_changed()
+        return self._snapshot
+
+    @property
+    def config(self):
+        return self.snapshot["config"]
+
+    @property
+    def styles(self):
+        return self.snapshot["styles"]
+
+    @property
+    def style_menu(self):
+        return self.snapshot["style_menu"]
+
+    @property
+    def style_menu_json(self):
+        return self.snapshot["style_menu_json"]
+
+    @property
+    def library_text(self):
+        return self.snapshot["library_text"]
+
+    @property
+    def motion_library_text(self):
+        return self.snapshot["motion_library_text"]
+
+    @property
+    def menu_hash(self):
+        return self.snapshot["menu_hash"]
+
+    @property
+    def default_key(self):
+        return self.snapshot["default_key"]
+
+    def get(self, style_key):
+        return self.styles.get(style_key)
+
+    @staticmethod
+    def render_prompt(style, description):
+        """
+        把描述填入预编译的模板 (等价于原来的 template.format(description=...))
+        """
+        if not style.has_placeholder:
+            return f"{style.template}, {description}"
+        if style.needs_format:
+            return style.template.format(description=description)
+        return "".join(description if is_field else text for text, is_field in style.segments)
+
+
+_registries = {}
+_registries_lock = threading.Lock()
+
+
+def get_style_registry(path="config/styles.yaml"):
+    """
+    同一份 styles.yaml 在进程内只加载一次
+    """
+    key = os.path.abspath(path)
+    with _registries_lock:
+        if key not in _registries:
+            _registries[key] = StyleRegistry(path)
+        return _registries[key]
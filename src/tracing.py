@@ -0,0 +1,134 @@
+import os
+import json
+import math
+import time
+import threading
+from contextlib import contextmanager, nullcontext
+
+_NOOP = nullcontext()
+
+
+def percentile(values, pct):
+    """
+    最近秩法求分位数 (values 需已排序)
+    """
+    if not values:
+        return 0.0
+    index = max(0, min(len(values) - 1, math.ceil(pct / 100 * len(values)) - 1))
+    return values[index]
+
+
+class Tracer:
+    """
+    轻量级的阶段耗时追踪：
+        with tracer.span("image.decode", path=p): ...
+    - 默认关闭，关闭时 span() 返回同一个空上下文，几乎没有开销
+    - 可导出 JSON Lines 或 Chrome Trace (chrome://tracing / Perfetto 打开)
+    - summary() 按阶段统计次数、p50、p95
+    """
+    def __init__(self):
+        self.enabled = False
+        self.events = []
+        self._lock = threading.Lock()
+        self._origin = time.perf_counter()
+        self._epoch_us = time.time() * 1e6
+
+    def enable(self):
+        self.enabled = True
+
+    def span(self, name, **attrs):
+        if not self.enabled:
+            return _NOOP
+        return self._span(name, attrs)
+
+    @contextmanager
+    def _span(self, name, attrs):
+        start = time.perf_counter()
+        error = None
+        try:
+            yield attrs
+        except BaseException as e:
+            error = type(e).__name__
+            raise
+        finally:
+            end = time.perf_counter()
+            event = {
+                "name": name,
+                "ts_us": (start - self._origin) * 1e6,
+                "dur_us": (end - start) * 1e6,
+                "tid": threading.get_ident(),
+                "thread": threading.current_thread().name,
+                "attrs": attrs,
+            }
+            if error:
+                event["error"] = error
+            with self._lock:
+                self.events.append(event)
+
+    def summary(self):
+        """
+        {阶段名: {"count", "total_ms", "p50_ms", "p95_ms", "max_ms", "errors"}}
+        """
+        with self._lock:
+            events = list(self.events)
+        grouped = {}
+        for event in events:
+            grouped.setdefault(event["name"], []).append(event)
+        result = {}
+        for name, items in grouped.items():
+            durations = sorted(e["dur_us"] / 1000 for e in items)
+            result[name] = {
+                "count": len(items),
+                "total_ms": sum(durations),
+                "p50_ms": percentile(durations, 50),
+                "p95_ms": percentile(durations, 95),
+                "max_ms": durations[-1],
+                "errors": sum(1 for e in items if "error" in e),
+            }
+        return result
+
+    def print_summary(self):
+        summary = self.summary()
+        if not summary:
+            print("📈 [Profile] 没有采集到任何阶段数据")
+            return
+        print("\n📈 [Profile] 各阶段耗时:")
+        print(f"   {'阶段':<28}{'次数':>6}{'p50 (ms)':>12}{'p95 (ms)':>12}{'最大 (ms)':>12}{'合计 (s)':>10}")
+        for name, s in sorted(summary.items(), key=lambda kv: -kv[1]["total_ms"]):
+            errors = f"  ⚠️ 失败 {s['errors']}" if s["errors"] else ""
+            print(f"   {name:<28}{s['count']:>6}{s['p50_ms']:>12.1f}{s['p95_ms']:>12.1f}"
+                  f"{s['max_ms']:>12.1f}{s['total_ms'] / 1000:>10.2f}{errors}")
+
+    def export(self, path):
+        """
+        .json -> Chrome Trace 格式，其他后缀 -> JSON Lines
+        """
+        with self._lock:
+            events = list(self.events)
+        out_dir = os.path.dirname(path)
+        if out_dir:
+            os.makedirs(out_dir, exist_ok=True)
+
+        if path.endswith(".json"):
+            pid = os.getpid()
+            trace_events = [{
+                "name": e["name"], "ph": "X", "pid": pid, "tid": e["tid"],
+                "ts": e["ts_us"], "dur": e["dur_us"],
+                "args": dict(e["attrs"], **({"error": e["error"]} if "error" in e else {})),
+            } for e in events]
+            with open(path, "w", encoding="utf-8") as f:
+                json.dump({"traceEvents": trace_events, "displayTimeUnit": "ms"}, f, ensure_ascii=False, default=str)
+        else:
+            with open(path, "w", encoding="utf-8") as f:
+                for e in events:
+                    record = dict(e, ts_us=self._epoch_us + e["ts_us"])
+                    f.write(json.dumps(record, ensure_ascii=False, default=str) + "\n")
+        print(f"🧵 [Trace] 已写入 {len(events)} 条记录: {path}")
+
+
+# 进程级共享实例
+tracer = Tracer()
+
+
+def span(name, **attrs):
+    return tracer.span(name, **attrs)
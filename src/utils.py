@@ -1,29 +1,40 @@
 import os
 import base64
-from PIL import Image
+import hashlib
+import tempfile
+import threading
 from io import BytesIO
-# 关键：注册 HEIC 打开器
-from pillow_heif import register_heif_opener
+from collections import OrderedDict
+from contextlib import contextmanager
+from src.tracing import span
 
-# 只要导入这个模块，就会自动注册
-register_heif_opener()
+# PIL / pillow_heif / yaml 都是重量级依赖，首次真正用到时才导入，
+# 这样 `main.py --help`、参数错误、全缓存命中的运行都不必付出导入代价。
+_heif_lock = threading.Lock()
+_heif_registered = False
+
+def import_pil():
+    """
+    返回 PIL.Image 模块，第一次调用时注册 HEIC 打开器
+    """
+    global _heif_registered
+    from PIL import Image
+    if not _heif_registered:
+        with _heif_lock:
+            if not _heif_registered:
+                # 关键：注册 HEIC 打开器
+                from pillow_heif import register_heif_opener
+                register_heif_opener()
+                _heif_registered = True
+    return Image
 
 def load_image_converted(image_path):
     """
     读取图片（支持 HEIC/JPG/PNG），并统一转换为 RGB 模式的 PIL Image 对象。
     解决 HEIC 兼容性问题。
     """
-    if not os.path.exists(image_path):
-        raise FileNotFoundError(f"❌ 找不到图片: {image_path}")
-
-    # Pillow 现在可以打开 HEIC 了
-    img = Image.open(image_path)
-    
-    # 如果是 RGBA (透明底) 或 HEIC 的特殊模式，转为 RGB 标准模式
-    if img.mode not in ('RGB', 'L'):
-        img = img.convert('RGB')
-        
-    return img
+    # 解码结果走进程内缓存，灰度图保持 L 模式
+    return image_cache.get(image_path, keep_modes=('RGB', 'L'))
 
 def image_to_base64_str(image_path):
     """
@@ -40,27 +51,219 @@ def image_to_base64_str(image_path):
     # 3. 转 Base64
     return base64.b64encode(buffered.getvalue()).decode('utf-8')
 
-import os
-from PIL import Image
-# 引入 HEIC 支持库
-from pillow_heif import register_heif_opener
+class DecodedImageCache:
+    """
+    进程内的已解码图片缓存 (LRU)。
+    - Key: (绝对路径, mtime, 文件大小, 目标模式)，文件被修改后自动失效
+    - 按解码后的像素字节数计算预算，超出预算时淘汰最久未使用的图片
+    - 同一张图片被多个线程同时请求时只解码一次
 
-# ✅ 关键：一被导入就自动注册 HEIC 打开器
-register_heif_opener()
+    ⚠️ 返回的 Image 对象会被多个调用方共享，调用方不要原地修改它。
+    """
+    def __init__(self, max_bytes=512 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._key_locks = {}
 
-def load_image_safe(image_path):
+    @staticmethod
+    def _estimate_bytes(img):
+        return img.width * img.height * len(img.getbands())
+
+    def _make_key(self, image_path, keep_modes):
+        st = os.stat(image_path)
+        return (os.path.abspath(image_path), st.st_mtime_ns, st.st_size, keep_modes)
+
+    def get(self, image_path, keep_modes=('RGB',)):
+        if not os.path.exists(image_path):
+            raise FileNotFoundError(f"❌ 找不到图片: {image_path}")
+        key = self._make_key(image_path, keep_modes)
+
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return self._entries[key][0]
+            key_lock = self._key_locks.setdefault(key, threading.Lock())
+
+        with key_lock:
+            # 等锁期间可能已被其他线程解码完成
+            with self._lock:
+                if key in self._entries:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return self._entries[key][0]
+                self.misses += 1
+
+            try:
+                with span("image.decode", file=os.path.basename(image_path)):
+                    img = _decode_image(image_path, keep_modes)
+            except BaseException:
+                with self._lock:
+                    self._key_locks.pop(key, None)
+                raise
+            size = self._estimate_bytes(img)
+
+            # 写入缓存与移除 key 锁在同一个临界区里，避免后来的线程在两者之间错过缓存、重新解码
+            with self._lock:
+                if size <= self.max_bytes:
+                    self._entries[key] = (img, size)
+                    self.current_bytes += size
+                    self._evict_locked()
+                self._key_locks.pop(key, None)
+            return img
+
+    def _evict_locked(self):
+        while self.current_bytes > self.max_bytes and self._entries:
+            _, (_, size) = self._entries.popitem(last=False)
+            self.current_bytes -= size
+            self.evictions += 1
+
+    def set_budget(self, max_bytes):
+        with self._lock:
+            self.max_bytes = max_bytes
+            self._evict_locked()
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.current_bytes = 0
+
+    def stats(self):
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "entries": len(self._entries),
+                "bytes": self.current_bytes,
+            }
+
+    def report(self):
+        s = self.stats()
+        return (f"🗂️ [ImageCache] 命中 {s['hits']} / 未命中 {s['misses']} | "
+                f"淘汰 {s['evictions']} | 占用 {s['bytes'] / 1024 / 1024:.1f} MB ({s['entries']} 张)")
+
+def _decode_image(image_path, keep_modes=('RGB',)):
     """
-    安全读取图片，支持 JPG/PNG/HEIC 等格式。
-    返回标准的 PIL Image 对象。
+    真正的解码逻辑 (不经过缓存)
     """
-    if not os.path.exists(image_path):
-        raise FileNotFoundError(f"❌ 找不到图片: {image_path}")
-    
-    # 因为上面注册了 opener，这里直接 open 就能读 HEIC 了
-    img = Image.open(image_path)
+    # import_pil() 保证已注册 opener，这里直接 open 就能读 HEIC 了
+    img = import_pil().open(image_path)
     
     # 确保图片模式兼容 (避免某些 PNG/HEIC 的特殊模式导致 AI 报错)
-    if img.mode != 'RGB':
+    if img.mode not in keep_modes:
         img = img.convert('RGB')
+    else:
+        # 强制完成解码，避免缓存里放的是惰性加载的文件句柄
+        img.load()
         
-    return img
\ No newline at end of file
+    return img
+
+# 进程级共享缓存：analyzer / generator / motion director 都通过 load_image_safe 命中它
+image_cache = DecodedImageCache()
+
+def load_image_safe(image_path):
+    """
+    安全读取图片，支持 JPG/PNG/HEIC 等格式。
+    返回标准的 PIL Image 对象 (同一次运行内同一文件只解码一次)。
+    """
+    return image_cache.get(image_path)
+
+_hash_memo = {}
+_hash_lock = threading.Lock()
+
+def file_sha256(file_path):
+    """
+    计算文件内容的 SHA-256 (十六进制)。
+    结果按 (路径, mtime, 大小) 记忆，同一次运行里重复调用不会重复读盘。
+    """
+    st = os.stat(file_path)
+    key = (os.path.abspath(file_path), st.st_mtime_ns, st.st_size)
+    with _hash_lock:
+        if key in _hash_memo:
+            return _hash_memo[key]
+
+    digest = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(chunk)
+    value = digest.hexdigest()
+
+    with _hash_lock:
+        _hash_memo[key] = value
+    return value
+
+def atomic_write_bytes(target_path, data):
+    """
+    原子写文件：先写同目录下的临时文件，再 os.replace 覆盖目标。
+    读者要么看到旧文件，要么看到完整的新文件，不会读到写了一半的内容。
+    """
+    target_dir = os.path.dirname(target_path) or "."
+    os.makedirs(target_dir, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=target_dir, prefix=".tmp_", suffix=os.path.basename(target_path))
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, target_path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+@contextmanager
+def file_lock(lock_path):
+    """
+    跨进程的排他文件锁 (POSIX flock / Windows msvcrt)，with 块结束时释放。
+    用于多个进程读-改-写同一个文件 (如输出目录的 manifest.json)。
+    """
+    lock_dir = os.path.dirname(lock_path) or "."
+    os.makedirs(lock_dir, exist_ok=True)
+    with open(lock_path, "a+b") as f:
+        if os.name == "nt":
+            import msvcrt
+            f.seek(0)
+            while True:
+                try:
+                    msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+                    break
+                except OSError:
+                    # LK_LOCK 最多重试 10 秒后报错，继续等
+                    continue
+            try:
+                yield
+            finally:
+                f.seek(0)
+                msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+        else:
+            import fcntl
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+def process_pool(max_workers=None):
+    """
+    新建进程池，子进程用 forkserver 启动 (没有 forkserver 的平台用 spawn)。
+    调用方往往已经开了绘图/下载线程，默认的 fork 会把其他线程持有的锁
+    (解码缓存、tracer、哈希记忆等) 原样复制进子进程，可能导致子进程死锁。
+    """
+    import multiprocessing
+    from concurrent.futures import ProcessPoolExecutor
+    method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+    return ProcessPoolExecutor(max_workers=max_workers, mp_context=multiprocessing.get_context(method))
+
+def load_settings(settings_path="config/settings.yaml"):
+    """
+    读取全局运行参数 (限流、连接池等)，文件不存在或为空时返回空字典
+    """
+    if not os.path.exists(settings_path):
+        return {}
+    import yaml
+    with open(settings_path, 'r', encoding='utf-8') as f:
+        return yaml.safe_load(f) or {}
@@ -0,0 +1,205 @@
+import os
+import json
+import time
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from src.utils import atomic_write_bytes
+from src.tracing import span
+from src.gateway import CallGateway
+
+# 任务状态: pending -> submitted -> downloading -> done / failed
+FINISHED = ("done", "failed")
+
+
+def default_video_path(image_path):
+    """
+    视频输出路径: 与图片同目录，xxx.png -> xxx_raw.mp4
+    """
+    return os.path.splitext(image_path)[0] + "_raw.mp4"
+
+
+class VideoJobScheduler:
+    """
+    Veo 视频任务调度器：
+    - 最多同时提交 max_in_flight 个 generate_videos 任务
+    - 单个循环轮询所有进行中的任务，没有进展时逐步拉长轮询间隔
+    - 任务一完成就在后台线程下载，不阻塞其他任务的轮询
+    - operation ID 持久化到 state_path，进程重启后接着等之前提交的任务
+    - 查询出现不可重试的错误 (如 operation 已不存在)，或连续 max_poll_errors 轮查询失败时，任务记为 failed
+    """
+    def __init__(self, director, state_path=".cache/video_jobs.json", max_in_flight=4,
+                 min_poll=5.0, max_poll=60.0, download_workers=2, max_poll_errors=5):
+        self.director = director
+        self.state_path = state_path
+        self.max_in_flight = max_in_flight
+        self.min_poll = min_poll
+        self.max_poll = max_poll
+        self.download_workers = download_workers
+        self.max_poll_errors = max_poll_errors
+        self.jobs = {}
+        self._lock = threading.Lock()
+        self._load_state()
+
+    @staticmethod
+    def make_job_id(image_path, video_prompt):
+        raw = f"{os.path.abspath(image_path)}|{video_prompt}"
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()[:16]
+
+    def _load_state(self):
+        if not self.state_path or not os.path.exists(self.state_path):
+            return
+        try:
+            with open(self.state_path, "r", encoding="utf-8") as f:
+                self.jobs = json.load(f).get("jobs", {})
+        except (OSError, ValueError) as e:
+            print(f"⚠️ [VideoJobs] 任务状态文件损坏，忽略: {e}")
+            return
+        # 下载中被打断的任务回到 submitted，重新查询一次即可继续下载
+        for job in self.jobs.values():
+            if job["status"] == "downloading":
+                job["status"] = "submitted"
+        resumed = sum(1 for job in self.jobs.values() if job["status"] == "submitted")
+        if resumed:
+            print(f"♻️ [VideoJobs] 恢复 {resumed} 个进行中的 Veo 任务")
+
+    def _save_state(self):
+        if not self.state_path:
+            return
+        # 快照与写盘在同一把锁里，避免较旧的快照最后落盘
+        with self._lock:
+            data = json.dumps({"jobs": self.jobs}, ensure_ascii=False, indent=2)
+            atomic_write_bytes(self.state_path, data.encode("utf-8"))
+
+    def add(self, image_path, video_prompt, output_path=None):
+        """
+        登记一个任务；已完成的同名任务不会重复提交。返回 job_id
+        """
+        job_id = self.make_job_id(image_path, video_prompt)
+        with self._lock:
+            job = self.jobs.get(job_id)
+            if job and (job["status"] != "failed"):
+                return job_id
+            self.jobs[job_id] = {
+                "image_path": image_path,
+                "video_prompt": video_prompt,
+                "output_path": output_path or default_video_path(image_path),
+                "operation": None,
+                "status": "pending",
+                "error": None,
+                "submitted_at": None,
+            }
+        self._save_state()
+        return job_id
+
+    def _jobs_with(self, status):
+        with self._lock:
+            return [(job_id, job) for job_id, job in self.jobs.items() if job["status"] == status]
+
+    def _set(self, job_id, **fields):
+        with self._lock:
+            self.jobs[job_id].update(fields)
+        self._save_state()
+
+    def _submit_pending(self):
+        in_flight = len(self._jobs_with("submitted")) + len(self._jobs_with("downloading"))
+        submitted = 0
+        for job_id, job in self._jobs_with("pending"):
+            if in_flight >= self.max_in_flight:
+                break
+            try:
+                operation = self.director.submit_video(job["image_path"], job["video_prompt"])
+                self._set(job_id, status="submitted", operation=operation.name, submitted_at=time.time())
+                in_flight += 1
+                submitted += 1
+            except Exception as e:
+                print(f"❌ [VideoJobs] 提交失败 {os.path.basename(job['image_path'])}: {e}")
+                self._set(job_id, status="failed", error=str(e))
+        return submitted
+
+    def _download(self, job_id, operation):
+        job = self.jobs[job_id]
+        try:
+            with span("veo.download", image=os.path.basename(job["image_path"])):
+                path = self.director.download_video(operation, job["output_path"])
+            if path:
+                self._set(job_id, status="done", error=None)
+                self._catalog(job, path)
+            else:
+                self._set(job_id, status="failed", error="下载失败或未返回视频")
+        except Exception as e:
+            # 任何异常都要让任务离开 downloading，否则 run() 会一直等下去
+            print(f"❌ [VideoJobs] 下载 {os.path.basename(job['image_path'])} 出错: {e}")
+            with self._lock:
+                job.update(status="failed", error=str(e))
+            try:
+                self._save_state()
+            except OSError as save_error:
+                print(f"⚠️ [VideoJobs] 任务状态保存失败: {save_error}")
+
+    def _catalog(self, job, path):
+        from src.catalog import get_catalog
+        from src.manifest import hash_text
+        try:
+            get_catalog().record(path, "video", parent=job["image_path"], engine=self.director.video_model,
+                                 prompt_hash=hash_text(job["video_prompt"]), operation=job["operation"])
+        except Exception as e:
+            print(f"⚠️ [Catalog] 视频登记失败: {e}")
+
+    def _poll_in_flight(self, pool):
+        progressed = 0
+        for job_id, job in self._jobs_with("submitted"):
+            try:
+                operation = self.director.poll_video(job["operation"])
+            except Exception as e:
+                # 网关已经重试过可重试的错误；404 (operation 不存在/过期) 等不可重试错误直接判失败
+                errors = job.get("poll_errors", 0) + 1
+                code = CallGateway.status_code(e)
+                if not self.director.gateway.is_retryable(e) or errors >= self.max_poll_errors:
+                    print(f"❌ [VideoJobs] 查询任务 {job['operation']} 失败 ({code or type(e).__name__})，放弃: {e}")
+                    self._set(job_id, status="failed", error=str(e), poll_errors=errors)
+                    progressed += 1
+                else:
+                    print(f"⚠️ [VideoJobs] 查询任务 {job['operation']} 失败 ({errors}/{self.max_poll_errors})，"
+                          f"下轮重试: {e}")
+                    self._set(job_id, poll_errors=errors)
+                continue
+            if job.get("poll_errors"):
+                self._set(job_id, poll_errors=0)
+            if not operation.done:
+                continue
+            progressed += 1
+            if getattr(operation, "error", None):
+                print(f"❌ [VideoJobs] 渲染失败 {os.path.basename(job['image_path'])}: {operation.error}")
+                self._set(job_id, status="failed", error=str(operation.error))
+                continue
+            self._set(job_id, status="downloading")
+            pool.submit(self._download, job_id, operation)
+        return progressed
+
+    def run(self):
+        """
+        跑完所有未完成的任务，返回 {job_id: 输出路径或 None}
+        """
+        interval = self.min_poll
+        with ThreadPoolExecutor(max_workers=self.download_workers, thread_name_prefix="veo-download") as pool:
+            while True:
+                with span("veo.poll_round"):
+                    progressed = self._submit_pending()
+                    progressed += self._poll_in_flight(pool)
+
+                waiting = [job for _, job in self.jobs.items() if job["status"] not in FINISHED]
+                if not waiting:
+                    break
+                if all(job["status"] == "downloading" for job in waiting):
+                    # 只剩下载中的任务，不需要再轮询 Veo
+                    time.sleep(0.5)
+                    continue
+
+                # 自适应轮询: 有任务状态变化就回到最短间隔，否则逐步放慢
+                interval = self.min_poll if progressed else min(self.max_poll, interval * 1.5)
+                print(f"⏳ [VideoJobs] 进行中 {len(waiting)} 个，{interval:.0f}s 后再次查询")
+                time.sleep(interval)
+
+        return {job_id: (job["output_path"] if job["status"] == "done" else None)
+                for job_id, job in self.jobs.items()}
@@ -0,0 +1,188 @@
+"""
+离线吞吐基准：用本地假 GenAI 客户端跑完整的 main.py 流程 (不需要 API Key)
+
+对每个 (批量大小, 并发数) 组合:
+  1. 在临时目录生成 N 张合成照片 (inputs/)
+  2. 通过 main.run() 执行 分析 -> 组装 Prompt -> 绘图 -> 保存 全流程
+  3. 统计总耗时、壁纸吞吐 (张/分钟)、模型调用的 p50/p95/p99 与失败数
+
+用法:
+    python test/bench_pipeline.py
+    python test/bench_pipeline.py --batch-sizes 1,8 --concurrency 1,3,0 --top-k 3 \\
+        --image-latency 0.5 --sigma 0.8 --error-rate 0.05 --json bench_pipeline.json
+"""
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import tempfile
+import contextlib
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+os.chdir(ROOT)  # styles.yaml / settings.yaml 使用相对路径
+
+from fake_genai import FakeGenAIClient, ModelProfile  # noqa: E402
+
+
+def make_inputs(root, count, size, rng):
+    from PIL import Image
+    input_dir = os.path.join(root, "inputs")
+    os.makedirs(input_dir, exist_ok=True)
+    for i in range(count):
+        color = tuple(rng.randrange(256) for _ in range(3))
+        img = Image.new("RGB", size, color)
+        # 加一点噪声，避免所有图片字节相同
+        img.putpixel((rng.randrange(size[0]), rng.randrange(size[1])), (255, 255, 255))
+        img.save(os.path.join(input_dir, f"photo_{i:03d}.jpg"), quality=90)
+    return input_dir
+
+
+def parse_list(value):
+    return [int(v) for v in value.split(",") if v.strip()]
+
+
+def run_case(args, batch_size, concurrency, rng):
+    import main as cli
+    from src.clients import ClientRegistry, set_registry
+    from src.payload import payload_preparer
+    from src.catalog import set_catalog_path
+    from src.utils import image_cache
+    from src.tracing import tracer, percentile
+    from src.style_registry import get_style_registry
+
+    client = FakeGenAIClient(
+        profiles={
+            "gemini-2.5-flash": ModelProfile(args.analysis_latency, args.sigma, args.error_rate, 0),
+            "gemini-3-pro-image-preview": ModelProfile(args.image_latency, args.sigma, args.error_rate,
+                                                       args.payload_kb * 1024),
+        },
+        style_keys=list(get_style_registry().style_menu),
+        seed=args.seed,
+    )
+    settings = {
+        "gateway": {
+            "max_retries": 5, "base_delay": 0.05, "max_delay": 1.0,
+            "default": {"rpm": 100000, "concurrency": 64},
+            "hedging": {"enabled": args.hedge is not None, "percentile": args.hedge or 95, "min_delay": 0.0,
+                        "min_samples": 10, "max_extra_pct": args.hedge_budget},
+        },
+        "http": {"pool_size": 16, "timeout": 60},
+        # 与线上配置相同的最小 token 数: 缓存命中率反映真实运行
+        "context_cache": {"enabled": not args.no_context_cache, "min_tokens": 1024},
+    }
+    registry = ClientRegistry(client=client, api_key="fake", settings=settings)
+    set_registry(registry)
+    tracer.events.clear()
+    tracer.enable()
+    image_cache.clear()
+
+    with tempfile.TemporaryDirectory(prefix="bench_") as tmp:
+        payload_preparer.cache_dir = os.path.join(tmp, "payloads")
+        # 临时输出登记到临时目录里的资产目录，不写进正式的 .cache/catalog.sqlite3
+        previous_catalog = set_catalog_path(os.path.join(tmp, "catalog.sqlite3"))
+        input_dir = make_inputs(tmp, batch_size, (args.width, args.height), rng)
+        argv = ["--input-dir", input_dir] if batch_size > 1 else ["--input", os.path.join(input_dir, "photo_000.jpg")]
+        argv += ["--top_k", str(args.top_k), "--concurrency", str(concurrency), "--no-cache", "--no-journal",
+                 "--analysis-batch", str(args.analysis_batch)]
+        if args.stream:
+            argv.append("--stream")
+        if args.export:
+            argv += ["--export", args.export]
+        if args.shortlist:
+            argv += ["--shortlist", str(args.shortlist)]
+        if args.local_only:
+            argv.append("--local-only")
+        cli_args = cli.build_parser().parse_args(argv)
+
+        start = time.perf_counter()
+        try:
+            with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+                photos = cli.run(cli_args)
+        finally:
+            set_catalog_path(previous_catalog)
+        wall = time.perf_counter() - start
+
+    results = [r for photo in photos for r in photo["results"]]
+    cache_stats = registry.prompt_cache.stats
+    ok = sum(1 for _, path, _ in results if path)
+    summary = tracer.summary()
+    calls = summary.get("model.generate_content", {})
+    durations = sorted(e["dur_us"] / 1000 for e in tracer.events if e["name"] == "model.generate_content")
+    return {
+        "batch_size": batch_size,
+        "concurrency": concurrency,
+        "wall_s": wall,
+        "wallpapers": ok,
+        "failed": len(results) - ok,
+        "wallpapers_per_min": ok / wall * 60 if wall > 0 else 0.0,
+        "photos_per_min": len(photos) / wall * 60 if wall > 0 else 0.0,
+        "model_calls": calls.get("count", 0),
+        "model_errors": calls.get("errors", 0),
+        "p50_ms": calls.get("p50_ms", 0.0),
+        "p95_ms": calls.get("p95_ms", 0.0),
+        "p99_ms": percentile(durations, 99),
+        "prompt_tokens": cache_stats["prompt_tokens"],
+        "cached_tokens": cache_stats["cached_tokens"],
+        "hedged": registry.gateway.hedge_stats["hedged"],
+        "hedge_wins": registry.gateway.hedge_stats["hedge_wins"],
+    }
+
+
+def cached_pct(row):
+    return row["cached_tokens"] / row["prompt_tokens"] if row["prompt_tokens"] else 0.0
+
+
+def main():
+    parser = argparse.ArgumentParser(description="离线流水线吞吐基准 (假 GenAI 后端)")
+    parser.add_argument("--batch-sizes", type=parse_list, default=[1, 6], help="照片数量列表 (默认: 1,6)")
+    parser.add_argument("--concurrency", type=parse_list, default=[1, 0], help="并发数列表，0 = 全部并发 (默认: 1,0)")
+    parser.add_argument("--top-k", type=int, default=3)
+    parser.add_argument("--analysis-batch", type=int, default=8, help="每次分析请求合并的照片数 (1 = 逐张)")
+    parser.add_argument("--export", help="同时导出多分辨率变体 (规格名列表或 all)")
+    parser.add_argument("--stream", action="store_true", help="单图用例使用流式分析 (--stream)")
+    parser.add_argument("--no-context-cache", action="store_true", help="关闭上下文缓存 (对比用)")
+    parser.add_argument("--shortlist", type=int, default=0, help="分析 Prompt 带 N 个本地候选风格")
+    parser.add_argument("--local-only", action="store_true", help="只用本地预排序，不发分析请求")
+    parser.add_argument("--hedge", type=float, nargs="?", const=95, default=None, metavar="PCT",
+                        help="开启对冲请求，阈值为近期耗时的 PCT 分位数 (默认 95)")
+    parser.add_argument("--hedge-budget", type=float, default=10, help="对冲额外请求上限 (百分比, 默认 10)")
+    parser.add_argument("--analysis-latency", type=float, default=0.05, help="分析调用延迟中位数 (秒)")
+    parser.add_argument("--image-latency", type=float, default=0.2, help="绘图调用延迟中位数 (秒)")
+    parser.add_argument("--sigma", type=float, default=0.5, help="对数正态延迟的长尾程度")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="429/503 注入概率")
+    parser.add_argument("--payload-kb", type=int, default=512, help="假图片响应大小 (KB)")
+    parser.add_argument("--width", type=int, default=1024)
+    parser.add_argument("--height", type=int, default=768)
+    parser.add_argument("--seed", type=int, default=7)
+    parser.add_argument("--json", help="把结果写入 JSON 文件")
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    rows = []
+    print(f"🏁 [Bench] top_k={args.top_k}, 分析 {args.analysis_latency}s / 绘图 {args.image_latency}s "
+          f"(sigma={args.sigma}, 错误率={args.error_rate:.0%})\n")
+    print(f"   {'照片':>4} {'并发':>4} {'耗时(s)':>8} {'壁纸':>5} {'失败':>4} {'壁纸/分':>8} "
+          f"{'调用':>5} {'p50(ms)':>8} {'p95(ms)':>8} {'p99(ms)':>8} {'输入token':>9} {'缓存':>5}")
+    for batch_size in args.batch_sizes:
+        for concurrency in args.concurrency:
+            row = run_case(args, batch_size, concurrency, rng)
+            rows.append(row)
+            print(f"   {row['batch_size']:>4} {row['concurrency'] or 'all':>4} {row['wall_s']:>8.2f} "
+                  f"{row['wallpapers']:>5} {row['failed']:>4} {row['wallpapers_per_min']:>8.1f} "
+                  f"{row['model_calls']:>5} {row['p50_ms']:>8.1f} {row['p95_ms']:>8.1f} {row['p99_ms']:>8.1f} "
+                  f"{row['prompt_tokens']:>9} {cached_pct(row):>5.0%}")
+            if args.hedge is not None:
+                print(f"        🪁 对冲 {row['hedged']} 次, 对冲胜出 {row['hedge_wins']} 次")
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(rows, f, ensure_ascii=False, indent=2)
+        print(f"\n💾 结果已写入 {args.json}")
+
+
+if __name__ == "__main__":
+    main()
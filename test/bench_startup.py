@@ -0,0 +1,133 @@
+"""
+CLI 启动性能基准 (不需要 API Key)
+
+测量三种场景:
+  1. `main.py --help`              参数解析即退出
+  2. `main.py --input 不存在的文件`  参数校验失败即退出
+  3. 导入业务模块并构造 Analyzer/Generator/Mixer (到"开始干活"之前的耗时)
+
+并用 `python -X importtime` 统计导入耗时，检查 --help 路径上没有加载重量级依赖。
+超过预算或出现禁止的模块时以非零状态码退出，可直接放进 CI。
+
+用法:
+    python test/bench_startup.py
+    python test/bench_startup.py --runs 10 --help-budget-ms 150 --json bench_startup.json
+"""
+import os
+import re
+import sys
+import json
+import time
+import argparse
+import statistics
+import subprocess
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# --help / 参数错误路径上不允许出现的重量级模块
+HEAVY_MODULES = ("google.genai", "PIL", "pillow_heif", "requests", "yaml", "dotenv", "numpy")
+
+FIRST_WORK_SNIPPET = """
+import time
+t0 = time.perf_counter()
+from src.analyzer import ImageAnalyzer
+from src.prompt_mixer import PromptMixer
+from src.generator import ImageGenerator
+ImageAnalyzer(); PromptMixer(); ImageGenerator()
+print(f"READY {(time.perf_counter() - t0) * 1000:.1f}")
+"""
+
+
+def run_wall(cmd, runs, env):
+    samples = []
+    for _ in range(runs):
+        t0 = time.perf_counter()
+        subprocess.run(cmd, cwd=ROOT, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        samples.append((time.perf_counter() - t0) * 1000)
+    return samples
+
+
+def import_profile(cmd, env):
+    """
+    解析 -X importtime 输出，返回 {模块名: 累计微秒} (只统计顶层导入)
+    """
+    proc = subprocess.run([sys.executable, "-X", "importtime"] + cmd, cwd=ROOT, env=env,
+                          stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+    modules = {}
+    for line in proc.stderr.splitlines():
+        match = re.match(r"import time:\s+(\d+)\s+\|\s+(\d+)\s+\|(\s*)(\S+)", line)
+        if match:
+            modules[match.group(4)] = (int(match.group(2)), len(match.group(3)))
+    return modules
+
+
+def summarize(name, samples):
+    p50 = statistics.median(samples)
+    p95 = sorted(samples)[max(0, int(len(samples) * 0.95) - 1)]
+    print(f"   - {name:<16} p50 {p50:7.1f} ms | p95 {p95:7.1f} ms | min {min(samples):7.1f} ms")
+    return {"p50_ms": p50, "p95_ms": p95, "min_ms": min(samples)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="CLI 启动性能基准")
+    parser.add_argument("--runs", type=int, default=5, help="每个场景重复次数 (默认: 5)")
+    parser.add_argument("--help-budget-ms", type=float, default=300, help="--help 的 p50 预算 (毫秒)")
+    parser.add_argument("--ready-budget-ms", type=float, default=3000, help="到开始干活前的预算 (毫秒)")
+    parser.add_argument("--json", help="把结果写入 JSON 文件，便于对比历史")
+    args = parser.parse_args()
+
+    env = dict(os.environ, GOOGLE_API_KEY=os.environ.get("GOOGLE_API_KEY", "bench-dummy-key"))
+    main_py = os.path.join(ROOT, "main.py")
+    missing = os.path.join(ROOT, "does-not-exist.heic")
+    report = {}
+    failures = []
+
+    print("⏱️ [Startup] 墙钟时间:")
+    report["help"] = summarize("--help", run_wall([sys.executable, main_py, "--help"], args.runs, env))
+    report["arg_error"] = summarize("参数错误", run_wall([sys.executable, main_py, "--input", missing], args.runs, env))
+
+    ready = []
+    for _ in range(args.runs):
+        out = subprocess.run([sys.executable, "-c", FIRST_WORK_SNIPPET], cwd=ROOT, env=env,
+                             capture_output=True, text=True).stdout
+        match = re.search(r"READY ([\d.]+)", out)
+        if match:
+            ready.append(float(match.group(1)))
+    if ready:
+        report["first_work"] = summarize("开始干活前", ready)
+    else:
+        failures.append("无法构造业务模块 (依赖缺失?)")
+
+    print("\n📦 [Startup] --help 路径的导入统计 (-X importtime):")
+    modules = import_profile([main_py, "--help"], env)
+    top_level = sorted(((us, name) for name, (us, depth) in modules.items() if depth == 1), reverse=True)
+    total_ms = sum(us for us, _ in top_level) / 1000
+    for us, name in top_level[:8]:
+        print(f"   - {name:<28} {us / 1000:7.1f} ms")
+    print(f"   = 顶层导入合计 {total_ms:.1f} ms")
+    report["help_import_ms"] = total_ms
+
+    loaded_heavy = sorted({m for m in modules for heavy in HEAVY_MODULES
+                           if m == heavy or m.startswith(heavy + ".")})
+    report["help_heavy_modules"] = loaded_heavy
+    if loaded_heavy:
+        failures.append(f"--help 加载了重量级模块: {', '.join(loaded_heavy[:5])}")
+    if report["help"]["p50_ms"] > args.help_budget_ms:
+        failures.append(f"--help p50 {report['help']['p50_ms']:.0f}ms 超出预算 {args.help_budget_ms:.0f}ms")
+    if ready and report["first_work"]["p50_ms"] > args.ready_budget_ms:
+        failures.append(f"开始干活前 p50 {report['first_work']['p50_ms']:.0f}ms 超出预算 {args.ready_budget_ms:.0f}ms")
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+
+    if failures:
+        print("\n❌ [Startup] 回归:")
+        for msg in failures:
+            print(f"   ✖ {msg}")
+        sys.exit(1)
+    print("\n✅ [Startup] 全部在预算内")
+
+
+if __name__ == "__main__":
+    main()
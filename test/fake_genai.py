@@ -0,0 +1,314 @@
+"""
+本地假 GenAI 客户端 (不联网、不需要 API Key)
+
+模拟 google.genai.Client 中本项目用到的接口:
+    client.models.generate_content / generate_content_stream / generate_images / generate_videos
+    client.operations.get
+    client.caches.create / update / delete (上下文缓存: 缓存部分的 token 几乎不占预填充时间)
+
+每个模型可以单独配置延迟分布、错误率和返回数据大小，用于离线压测与 CI。
+用法:
+    from src.clients import ClientRegistry
+    registry = ClientRegistry(client=FakeGenAIClient(), api_key="fake")
+"""
+import re
+import json
+import time
+import random
+import threading
+import itertools
+from types import SimpleNamespace
+
+
+class FakeAPIError(Exception):
+    """
+    模拟 google.genai.errors.APIError: 带 code 与 details，网关据此判断是否重试
+    """
+    def __init__(self, code, message, retry_delay=None):
+        super().__init__(f"{code} {message}")
+        self.code = code
+        self.message = message
+        self.details = {"error": {"code": code, "message": message, "details": []}}
+        if retry_delay is not None:
+            self.details["error"]["details"].append({
+                "@type": "type.googleapis.com/google.rpc.RetryInfo",
+                "retryDelay": f"{retry_delay}s",
+            })
+
+
+class ModelProfile:
+    """
+    单个模型的模拟参数
+    - latency: 延迟中位数 (秒)
+    - sigma: 对数正态分布的形状参数，越大长尾越明显 (0 = 固定延迟)
+    - error_rate: 返回 429/503 的概率
+    - payload_bytes: 图片/视频类响应的数据大小
+    - prefill_per_1k: 每 1000 个未缓存输入 token 额外增加的延迟 (秒)
+    """
+    def __init__(self, latency=0.05, sigma=0.5, error_rate=0.0, payload_bytes=512 * 1024, prefill_per_1k=0.02):
+        self.latency = latency
+        self.sigma = sigma
+        self.error_rate = error_rate
+        self.payload_bytes = payload_bytes
+        self.prefill_per_1k = prefill_per_1k
+
+    def sample_latency(self, rng):
+        if self.sigma <= 0:
+            return self.latency
+        return rng.lognormvariate(0, self.sigma) * self.latency
+
+
+DEFAULT_PROFILES = {
+    "gemini-2.5-flash": ModelProfile(latency=0.05, sigma=0.4, payload_bytes=0),
+    "gemini-3-pro-image-preview": ModelProfile(latency=0.2, sigma=0.6),
+    "imagen-4.0-generate-001": ModelProfile(latency=0.2, sigma=0.6),
+    "veo-3.1-generate-preview": ModelProfile(latency=1.0, sigma=0.3, payload_bytes=4 * 1024 * 1024),
+}
+
+# 按体积缓存的假图片 (可解码的随机噪声 PNG，噪声几乎不可压缩，体积约等于 宽x高x3)
+_png_cache = {}
+_png_lock = threading.Lock()
+
+
+def noise_png(size):
+    with _png_lock:
+        if size not in _png_cache:
+            from io import BytesIO
+            from PIL import Image
+            side = max(8, int((size / 3) ** 0.5))
+            img = Image.frombytes("RGB", (side, side), random.Random(size).randbytes(side * side * 3))
+            buffered = BytesIO()
+            img.save(buffered, format="PNG", compress_level=1)
+            _png_cache[size] = buffered.getvalue()
+        return _png_cache[size]
+
+# 与 Gemini 的计费口径一致: 每张图约 258 token，文本约 4 字符 / token
+IMAGE_TOKENS = 258
+
+
+def estimate_tokens(contents):
+    return sum(len(c) // 4 if isinstance(c, str) else IMAGE_TOKENS for c in (contents or []))
+
+
+def _config_get(config, name):
+    if config is None:
+        return None
+    if isinstance(config, dict):
+        return config.get(name)
+    return getattr(config, name, None)
+
+
+class FakeModels:
+    def __init__(self, client):
+        self._client = client
+
+    def _simulate(self, model, uncached_tokens=0, first_fraction=1.0):
+        """
+        等待 first_fraction 比例的延迟后返回 (profile, 剩余延迟)；流式响应把剩余延迟摊到后续块上
+        """
+        profile = self._client.profile(model)
+        rng = self._client.rng()
+        delay = profile.sample_latency(rng) + uncached_tokens / 1000 * profile.prefill_per_1k
+        self._client.record(model, delay)
+        time.sleep(delay * first_fraction)
+        if rng.random() < profile.error_rate:
+            if rng.random() < 0.5:
+                raise FakeAPIError(429, "RESOURCE_EXHAUSTED", retry_delay=0)
+            raise FakeAPIError(503, "UNAVAILABLE")
+        return profile, delay * (1 - first_fraction)
+
+    @staticmethod
+    def _prompt_text(contents):
+        return "\n".join(c for c in (contents or []) if isinstance(c, str))
+
+    def _analysis_json(self, prompt):
+        match = re.search(r"TOP (\d+)", prompt)
+        top_k = int(match.group(1)) if match else 3
+        keys = self._client.style_keys[:] or ["makoto_shinkai"]
+        self._client.rng().shuffle(keys)
+        levels = ["High", "Medium", "Low"]
+        return json.dumps({
+            "description": "A calm scene with a subject in soft natural light.",
+            "recommendations": [
+                {"style_key": key, "creativity": levels[i % 3]} for i, key in enumerate(keys[:top_k])
+            ],
+            "reasoning": "fake backend",
+        })
+
+    def _batch_json(self, prompt, count):
+        entries = []
+        for index in range(1, count + 1):
+            entry = json.loads(self._analysis_json(prompt))
+            entry["index"] = index
+            entries.append(entry)
+        return json.dumps({"images": entries})
+
+    @staticmethod
+    def _image_bytes(size):
+        return noise_png(size)
+
+    def generate_content(self, model, contents=None, config=None):
+        return self._respond(model, contents, config)[0]
+
+    def generate_content_stream(self, model, contents=None, config=None, chunk_chars=24):
+        """
+        流式版本: 首块在约 30% 延迟时到达，其余文本按固定大小切块，剩余延迟平均分摊
+        """
+        response, remaining = self._respond(model, contents, config, first_fraction=0.3)
+        text = response.text or ""
+        chunks = [text[i:i + chunk_chars] for i in range(0, len(text), chunk_chars)] or [""]
+        for n, piece in enumerate(chunks):
+            if n:
+                time.sleep(remaining / max(1, len(chunks) - 1))
+            last = n == len(chunks) - 1
+            yield SimpleNamespace(text=piece, candidates=[],
+                                  usage_metadata=response.usage_metadata if last else None)
+
+    def _respond(self, model, contents, config, first_fraction=1.0):
+        cached_text = ""
+        cache_name = _config_get(config, "cached_content")
+        if cache_name:
+            cached_text = self._client.caches.lookup(cache_name, model)
+        cached_tokens = len(cached_text) // 4
+        prompt_tokens = estimate_tokens(contents) + cached_tokens
+        profile, remaining = self._simulate(model, prompt_tokens - cached_tokens, first_fraction)
+        prompt = cached_text + "\n" + self._prompt_text(contents)
+        usage = SimpleNamespace(prompt_token_count=prompt_tokens, cached_content_token_count=cached_tokens or None)
+        if "image" in model:
+            part = SimpleNamespace(inline_data=SimpleNamespace(
+                data=self._image_bytes(profile.payload_bytes), mime_type="image/png"), text=None)
+            return SimpleNamespace(
+                text=None,
+                candidates=[SimpleNamespace(content=SimpleNamespace(parts=[part]))],
+                usage_metadata=usage,
+            ), remaining
+        batch = re.search(r"EACH of the (\d+) images", prompt)
+        if batch:
+            text = self._batch_json(prompt, int(batch.group(1)))
+        elif "Art Director" in prompt:
+            text = self._analysis_json(prompt)
+        else:
+            text = "Cinemagraph, Static Camera, gentle breeze moves the leaves, loopable."
+        return SimpleNamespace(text=text, candidates=[], usage_metadata=usage), remaining
+
+    def generate_images(self, model, prompt=None, config=None):
+        profile, _ = self._simulate(model)
+        image = SimpleNamespace(image_bytes=self._image_bytes(profile.payload_bytes), mime_type="image/png")
+        return SimpleNamespace(generated_images=[SimpleNamespace(image=image)])
+
+    def generate_videos(self, model, prompt=None, image=None, config=None):
+        profile, _ = self._simulate(model)
+        # 视频任务是异步的: 提交后一段时间才 done
+        render_seconds = profile.sample_latency(self._client.rng()) * 5
+        return self._client.new_operation(render_seconds)
+
+
+class FakeOperations:
+    def __init__(self, client):
+        self._client = client
+
+    def get(self, operation):
+        return self._client.refresh_operation(getattr(operation, "name", operation))
+
+
+class FakeCaches:
+    """
+    client.caches 的本地替身：记住缓存文本与过期时间，过期或不存在时返回 404；
+    与线上接口一样，内容少于 min_tokens 时拒绝创建 (400)
+    """
+    def __init__(self, client, min_tokens=1024):
+        self._client = client
+        self.min_tokens = min_tokens
+        self._items = {}
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+        self.counts = {"create": 0, "update": 0, "delete": 0}
+
+    @staticmethod
+    def _ttl_seconds(config):
+        ttl = _config_get(config, "ttl") or "3600s"
+        return float(str(ttl).rstrip("s"))
+
+    def create(self, model, config=None):
+        text = "\n".join(c for c in (_config_get(config, "contents") or []) if isinstance(c, str))
+        tokens = len(text) // 4
+        if tokens < self.min_tokens:
+            raise FakeAPIError(400, f"Cached content is too small. total_token_count={tokens}, min={self.min_tokens}")
+        with self._lock:
+            name = f"cachedContents/fake-{next(self._ids)}"
+            self._items[name] = {"model": model, "text": text,
+                                 "expires": time.monotonic() + self._ttl_seconds(config)}
+            self.counts["create"] += 1
+        return SimpleNamespace(name=name, model=model, usage_metadata=SimpleNamespace(total_token_count=tokens))
+
+    def update(self, name, config=None):
+        with self._lock:
+            item = self._items.get(name)
+            if item is None or item["expires"] < time.monotonic():
+                raise FakeAPIError(404, f"CachedContent not found: {name}")
+            item["expires"] = time.monotonic() + self._ttl_seconds(config)
+            self.counts["update"] += 1
+        return SimpleNamespace(name=name)
+
+    def delete(self, name):
+        with self._lock:
+            self._items.pop(name, None)
+            self.counts["delete"] += 1
+
+    def lookup(self, name, model):
+        with self._lock:
+            item = self._items.get(name)
+        if item is None or item["expires"] < time.monotonic() or item["model"] != model:
+            raise FakeAPIError(404, f"CachedContent not found: {name}")
+        return item["text"]
+
+
+class FakeGenAIClient:
+    """
+    假的 genai.Client；profiles 覆盖默认的模型参数，未配置的模型使用 default_profile
+    """
+    def __init__(self, profiles=None, default_profile=None, style_keys=None, seed=None):
+        self.profiles = dict(DEFAULT_PROFILES, **(profiles or {}))
+        self.default_profile = default_profile or ModelProfile()
+        self.style_keys = list(style_keys or [])
+        self.models = FakeModels(self)
+        self.operations = FakeOperations(self)
+        self.caches = FakeCaches(self)
+        self.calls = []
+        self._seed = seed
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._ops = {}
+        self._op_ids = itertools.count(1)
+
+    def profile(self, model):
+        return self.profiles.get(model, self.default_profile)
+
+    def rng(self):
+        # 每个线程独立的随机数发生器，避免锁竞争
+        if not hasattr(self._local, "rng"):
+            seed = None if self._seed is None else hash((self._seed, threading.get_ident()))
+            self._local.rng = random.Random(seed)
+        return self._local.rng
+
+    def record(self, model, delay):
+        with self._lock:
+            self.calls.append((model, delay))
+
+    def new_operation(self, render_seconds):
+        with self._lock:
+            name = f"operations/fake-{next(self._op_ids)}"
+            self._ops[name] = time.monotonic() + render_seconds
+        return SimpleNamespace(name=name, done=False, error=None, result=None)
+
+    def refresh_operation(self, name):
+        with self._lock:
+            ready_at = self._ops.get(name)
+        if ready_at is None:
+            return SimpleNamespace(name=name, done=True, error={"code": 404, "message": "unknown operation"},
+                                   result=None)
+        if time.monotonic() < ready_at:
+            return SimpleNamespace(name=name, done=False, error=None, result=None)
+        video = SimpleNamespace(uri=f"fake://{name}.mp4")
+        result = SimpleNamespace(generated_videos=[SimpleNamespace(video=video)])
+        return SimpleNamespace(name=name, done=True, error=None, result=result)
@@ -0,0 +1,446 @@
+"""
+关键行为的回归测试 (假 GenAI 后端，不联网、不需要 API Key)
+
+    python -m pytest -q test/test_behavior.py
+
+覆盖:
+    - IncrementalJSONParser: 任意切分位置下产出的事件与一次性解析一致
+    - ImageAnalyzer.analyze_many: 批次缺条目时拆分 / 单张重试，单张仍失败才用保底方案
+    - JobJournal: 两个连接之间的领取互斥、租约到期接管、续租、死进程任务回收
+    - download_file: 断点续传 (Range + If-Range)、对象变化后从头下载、md5 不符时删除临时文件
+    - OutputManifest: 多进程同时写同一目录的清单，记录不丢失
+"""
+import os
+import sys
+import json
+import time
+import base64
+import socket
+import random
+import hashlib
+import subprocess
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from fake_genai import FakeGenAIClient, ModelProfile, noise_png  # noqa: E402
+
+
+# ----------------------------------------------------------------------
+# IncrementalJSONParser
+# ----------------------------------------------------------------------
+STREAM_DOC = json.dumps({
+    "description": "雨夜的街角，霓虹 {倒影} 与 \"水洼\" [反光]\\",
+    "recommendations": [
+        {"style_key": "makoto_shinkai", "creativity": "High", "reason": "光影 } 很强 ]"},
+        {"style_key": "ghibli", "creativity": "Medium", "tags": ["暖色", {"k": [1, 2]}]},
+        {"style_key": "cyberpunk", "creativity": "Low", "reason": "逗号, 冒号: 引号 \\\" 结尾"},
+    ],
+    "reasoning": "第二个顶层字符串",
+}, ensure_ascii=False, indent=1)
+
+
+def _parse_in_chunks(chunks):
+    from src.json_stream import IncrementalJSONParser
+    parser = IncrementalJSONParser(array_keys=("recommendations",), string_keys=("description", "reasoning"))
+    events = []
+    for chunk in chunks:
+        events.extend(parser.feed(chunk))
+    return events, parser.result()
+
+
+def _expected_events():
+    doc = json.loads(STREAM_DOC)
+    return ([("field", "description", doc["description"])]
+            + [("item", "recommendations", item) for item in doc["recommendations"]]
+            + [("field", "reasoning", doc["reasoning"])])
+
+
+def test_json_parser_every_single_split():
+    expected = _expected_events()
+    for cut in range(len(STREAM_DOC) + 1):
+        events, result = _parse_in_chunks([STREAM_DOC[:cut], STREAM_DOC[cut:]])
+        assert events == expected, f"切分位置 {cut}"
+        assert result == json.loads(STREAM_DOC)
+
+
+def test_json_parser_random_chunking():
+    rng = random.Random(7)
+    expected = _expected_events()
+    for _ in range(200):
+        cuts = sorted(rng.sample(range(1, len(STREAM_DOC)), rng.randint(1, 40)))
+        chunks = [STREAM_DOC[a:b] for a, b in zip([0, *cuts], [*cuts, len(STREAM_DOC)])]
+        events, _ = _parse_in_chunks(chunks)
+        assert events == expected
+
+
+def test_json_parser_char_by_char_emits_items_as_soon_as_closed():
+    from src.json_stream import IncrementalJSONParser
+    parser = IncrementalJSONParser(array_keys=("recommendations",))
+    first_item_end = STREAM_DOC.index("}", STREAM_DOC.index("makoto_shinkai"))
+    # 字符串里的 "}" 不能让元素提前闭合
+    first_item_end = STREAM_DOC.index("}", first_item_end + 1)
+    for pos, ch in enumerate(STREAM_DOC):
+        events = parser.feed(ch)
+        if events:
+            assert pos == first_item_end
+            assert events[0][2]["style_key"] == "makoto_shinkai"
+            break
+
+
+# ----------------------------------------------------------------------
+# ImageAnalyzer.analyze_many
+# ----------------------------------------------------------------------
+@pytest.fixture
+def fake_registry(monkeypatch, tmp_path):
+    from src.clients import ClientRegistry, set_registry, get_registry
+    from src.payload import payload_preparer
+    from src.style_registry import get_style_registry
+
+    monkeypatch.chdir(ROOT)  # styles.yaml 使用相对路径
+    monkeypatch.setattr(payload_preparer, "cache_dir", str(tmp_path / "payloads"))
+    client = FakeGenAIClient(
+        profiles={"gemini-2.5-flash": ModelProfile(latency=0.0, sigma=0, payload_bytes=0)},
+        style_keys=list(get_style_registry().style_menu),
+        seed=1,
+    )
+    settings = {
+        "gateway": {"max_retries": 1, "base_delay": 0.0, "default": {"rpm": 100000, "concurrency": 8}},
+        "context_cache": {"enabled": False},
+        "analysis_batch": {"max_images": 4},
+    }
+    previous = get_registry()
+    registry = ClientRegistry(client=client, api_key="fake", settings=settings)
+    set_registry(registry)
+    yield registry
+    set_registry(previous)
+
+
+def _photos(tmp_path, count):
+    paths = []
+    for i in range(count):
+        path = tmp_path / f"photo_{i}.png"
+        path.write_bytes(noise_png(64 + i))
+        paths.append(str(path))
+    return paths
+
+
+def test_analyze_many_retries_single_missing_image_before_fallback(fake_registry, tmp_path):
+    from src.analyzer import ImageAnalyzer
+    analyzer = ImageAnalyzer(registry=fake_registry)
+    real_batch = analyzer._analyze_batch
+    sizes = []
+
+    def drop_last_of_multi(paths, payloads, top_k, shortlists=None):
+        # 多图批次里模型漏掉最后一张，单独请求时正常返回
+        sizes.append(len(paths))
+        parsed = real_batch(paths, payloads, top_k, shortlists)
+        if len(paths) > 1:
+            parsed[-1] = None
+        return parsed
+
+    analyzer._analyze_batch = drop_last_of_multi
+    results = analyzer.analyze_many(_photos(tmp_path, 4), top_k=2)
+
+    assert sizes == [4, 1]
+    assert analyzer.batch_stats["fallbacks"] == 0
+    assert analyzer.batch_stats["splits"] == 1
+    assert all(r and r.get("recommendations") for r in results)
+
+
+def test_analyze_many_splits_then_falls_back_only_for_bad_image(fake_registry, tmp_path):
+    from src.analyzer import ImageAnalyzer
+    analyzer = ImageAnalyzer(registry=fake_registry)
+    real_batch = analyzer._analyze_batch
+    photos = _photos(tmp_path, 4)
+    bad = photos[1]
+    sizes = []
+
+    def fail_batches_with_bad(paths, payloads, top_k, shortlists=None):
+        # 含坏图的批次整批失败 (例如 JSON 被截断)
+        sizes.append(len(paths))
+        if bad in paths:
+            return [None] * len(paths)
+        return real_batch(paths, payloads, top_k, shortlists)
+
+    analyzer._analyze_batch = fail_batches_with_bad
+    results = analyzer.analyze_many(photos, top_k=2)
+
+    # 4 -> 2 + 2 -> 坏图所在的一半再拆成 1 + 1，坏图单张失败后才保底
+    assert sizes == [4, 2, 1, 1, 2]
+    assert analyzer.batch_stats["fallbacks"] == 1
+    assert results[1] == analyzer._fallback(2)
+    assert all(r.get("recommendations") for i, r in enumerate(results) if i != 1)
+
+
+# ----------------------------------------------------------------------
+# JobJournal
+# ----------------------------------------------------------------------
+ANALYSIS = {
+    "description": "desc",
+    "reasoning": "why",
+    "recommendations": [{"style_key": "ghibli", "creativity": "Medium"},
+                        {"style_key": "makoto_shinkai", "creativity": "High"}],
+}
+
+
+def _dead_pid():
+    proc = subprocess.Popen([sys.executable, "-c", "pass"])
+    proc.wait()
+    return proc.pid
+
+
+def test_journal_claim_is_exclusive_across_connections(tmp_path):
+    from src.job_journal import JobJournal
+    db = str(tmp_path / "jobs.sqlite3")
+    a, b = JobJournal(db), JobJournal(db)
+    b.worker = "other-host:1"
+    ids = a.enqueue("photo.jpg", ANALYSIS)
+
+    first = a.claim()
+    second = b.claim()
+    assert {first.id, second.id} == set(ids)
+    assert a.claim() is None and b.claim() is None
+
+    # 只有持有者能续租
+    assert a.renew([first.id]) == 1
+    assert b.renew([first.id]) == 0
+
+    a.complete(first.id, "out_a.png")
+    b.fail(second.id, "boom")
+    assert [job.state for job in a.jobs(ids)] == ["done", "failed"]
+    assert b.requeue_failed() == 1
+    assert a.claim().id == second.id
+
+
+def test_journal_expired_lease_is_taken_over(tmp_path):
+    from src.job_journal import JobJournal
+    db = str(tmp_path / "jobs.sqlite3")
+    a = JobJournal(db, lease_seconds=0.05)
+    b = JobJournal(db)
+    b.worker = "other-host:1"
+    (job_id,) = a.enqueue("photo.jpg", {"recommendations": [{"style_key": "ghibli"}]})
+
+    assert a.claim().id == job_id
+    assert b.claim() is None
+    time.sleep(0.1)  # 租约到期 (心跳间隔至少 1 秒，还来不及续租)
+    taken = b.claim()
+    assert taken.id == job_id and taken.attempts == 2
+
+    # 原持有者迟到的结果不能覆盖接手者
+    a.complete(job_id, "late.png")
+    assert a.jobs([job_id])[0].state == "running"
+    b.complete(job_id, "b.png")
+    done = a.jobs([job_id])[0]
+    assert done.state == "done" and done.output == "b.png"
+
+
+def test_journal_resume_releases_dead_worker_and_unanalyzed_inputs(tmp_path):
+    from src.job_journal import JobJournal
+    db = str(tmp_path / "jobs.sqlite3")
+    crashed = JobJournal(db)
+    crashed.worker = f"{socket.gethostname()}:{_dead_pid()}"
+    crashed.register_inputs(["a.jpg", "b.jpg"], top_k=2)
+    ids = crashed.enqueue("a.jpg", ANALYSIS, top_k=2)
+    assert len(crashed.claim_many()) == 2
+
+    resumed = JobJournal(db)
+    assert [os.path.basename(p) for p, _ in resumed.unanalyzed()] == ["b.jpg"]
+    assert resumed.claim() is None
+    assert resumed.release_dead() == 2
+    assert [job.id for job in resumed.claim_many()] == ids
+    # 重新登记不会重复建任务
+    assert resumed.enqueue("a.jpg", ANALYSIS, top_k=2) == ids
+
+
+# ----------------------------------------------------------------------
+# download_file
+# ----------------------------------------------------------------------
+class ConnectionError(Exception):  # noqa: A001  与 requests 的异常同名，按类名判断可续传
+    pass
+
+
+class FakeResponse:
+    def __init__(self, status_code, headers, body, cut_after=None):
+        self.status_code = status_code
+        self.headers = headers
+        self.body = body
+        self.cut_after = cut_after
+        self.text = ""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def iter_content(self, chunk_size):
+        sent = 0
+        for pos in range(0, len(self.body), 7):
+            if self.cut_after is not None and sent >= self.cut_after:
+                raise ConnectionError("connection reset")
+            chunk = self.body[pos:pos + 7]
+            sent += len(chunk)
+            yield chunk
+
+
+class FakeObjectStore:
+    """
+    支持 Range / If-Range 的对象存储；cuts 中的数字表示第 n 次请求传多少字节后断开
+    """
+    def __init__(self, data, etag='"v1"', md5_of=None, cuts=(), honor_if_range=True):
+        self.data = data
+        self.etag = etag
+        self.md5 = base64.b64encode(hashlib.md5(md5_of if md5_of is not None else data).digest()).decode()
+        self.cuts = list(cuts)
+        self.honor_if_range = honor_if_range
+        self.requests = []
+
+    def get(self, url, headers=None, stream=True, timeout=None):
+        headers = dict(headers or {})
+        self.requests.append(headers)
+        cut = self.cuts.pop(0) if self.cuts else None
+        common = {"ETag": self.etag, "x-goog-hash": f"crc32c=AAAA, md5={self.md5}"}
+        range_header = headers.get("Range")
+        stale = self.honor_if_range and headers.get("If-Range") not in (None, self.etag)
+        if range_header and not stale:
+            start = int(range_header.split("=")[1].rstrip("-"))
+            body = self.data[start:]
+            common["Content-Range"] = f"bytes {start}-{len(self.data) - 1}/{len(self.data)}"
+            return FakeResponse(206, common, body, cut)
+        common["Content-Length"] = str(len(self.data))
+        return FakeResponse(200, common, self.data, cut)
+
+
+@pytest.fixture
+def no_backoff(monkeypatch):
+    from src import downloader
+    monkeypatch.setattr(downloader.time, "sleep", lambda seconds: None)
+
+
+def test_download_resumes_with_range_and_if_range(tmp_path, no_backoff):
+    from src.downloader import download_file
+    data = os.urandom(1000)
+    store = FakeObjectStore(data, cuts=[300, 400])
+    dest = str(tmp_path / "video.mp4")
+
+    result = download_file(store, "https://example/video.mp4", dest)
+
+    assert open(dest, "rb").read() == data
+    assert result.resumes == 2
+    assert "Range" not in store.requests[0]
+    assert store.requests[1]["Range"].startswith("bytes=3")
+    assert store.requests[1]["If-Range"] == '"v1"'
+    assert not os.path.exists(dest + ".part") and not os.path.exists(dest + ".part.json")
+
+
+def test_download_resumes_part_left_by_previous_run(tmp_path, no_backoff):
+    from src.downloader import download_file
+    data = os.urandom(1000)
+    dest = str(tmp_path / "video.mp4")
+    url = "https://example/video.mp4"
+    with pytest.raises(ConnectionError):
+        download_file(FakeObjectStore(data, cuts=[500]), url, dest, max_attempts=1)
+    partial = os.path.getsize(dest + ".part")
+    assert partial >= 500
+
+    store = FakeObjectStore(data)
+    download_file(store, url, dest)
+    assert open(dest, "rb").read() == data
+    assert store.requests[0]["Range"] == f"bytes={partial}-"
+    assert store.requests[0]["If-Range"] == '"v1"'
+
+
+def test_download_restarts_when_object_changed(tmp_path, no_backoff):
+    from src.downloader import download_file
+    url = "https://example/video.mp4"
+    dest = str(tmp_path / "video.mp4")
+    old, new = os.urandom(1000), os.urandom(1200)
+    with pytest.raises(ConnectionError):
+        download_file(FakeObjectStore(old, cuts=[500]), url, dest, max_attempts=1)
+
+    # 支持 If-Range 的服务端: 直接返回新对象的 200
+    download_file(FakeObjectStore(new, etag='"v2"'), url, dest)
+    assert open(dest, "rb").read() == new
+
+    # 忽略 If-Range 的服务端: 206 里的 ETag 变了，丢弃旧 .part 从头下载
+    with pytest.raises(ConnectionError):
+        download_file(FakeObjectStore(old, cuts=[500]), url, dest, max_attempts=1)
+    store = FakeObjectStore(new, etag='"v2"', honor_if_range=False)
+    download_file(store, url, dest)
+    assert open(dest, "rb").read() == new
+    assert "Range" in store.requests[0] and "Range" not in store.requests[1]
+
+
+def test_download_part_from_other_url_is_discarded(tmp_path, no_backoff):
+    from src.downloader import download_file
+    dest = str(tmp_path / "video.mp4")
+    with pytest.raises(ConnectionError):
+        download_file(FakeObjectStore(os.urandom(1000), cuts=[500]), "https://example/a.mp4", dest, max_attempts=1)
+
+    data = os.urandom(1000)
+    store = FakeObjectStore(data)
+    download_file(store, "https://example/b.mp4", dest)
+    assert open(dest, "rb").read() == data
+    assert "Range" not in store.requests[0]
+
+
+def test_download_md5_mismatch_removes_part(tmp_path, no_backoff):
+    from src.downloader import DownloadError, download_file
+    data = os.urandom(1000)
+    dest = str(tmp_path / "video.mp4")
+    store = FakeObjectStore(data, md5_of=b"something else")
+
+    with pytest.raises(DownloadError, match="md5"):
+        download_file(store, "https://example/video.mp4", dest)
+    assert not os.path.exists(dest)
+    assert not os.path.exists(dest + ".part") and not os.path.exists(dest + ".part.json")
+
+
+# ----------------------------------------------------------------------
+# OutputManifest
+# ----------------------------------------------------------------------
+def _record_many(output_dir, worker, count):
+    # 子进程入口: 每个进程用自己的 OutputManifest 实例写同一个清单
+    from src.manifest import OutputManifest
+    manifest = OutputManifest(output_dir)
+    for i in range(count):
+        path = os.path.join(output_dir, f"{worker}_{i}.png")
+        with open(path, "wb") as f:
+            f.write(b"x")
+        manifest.record(f"{worker}-{i}", path, style_key="ghibli")
+    return worker
+
+
+def test_manifest_concurrent_processes_merge(tmp_path):
+    from src.manifest import OutputManifest
+    from src.utils import process_pool
+    output_dir = str(tmp_path)
+    workers, per_worker = 4, 25
+    with process_pool(max_workers=workers) as pool:
+        futures = [pool.submit(_record_many, output_dir, f"w{n}", per_worker) for n in range(workers)]
+        assert sorted(f.result() for f in futures) == [f"w{n}" for n in range(workers)]
+
+    with open(os.path.join(output_dir, "manifest.json"), encoding="utf-8") as f:
+        jobs = json.load(f)["jobs"]
+    assert len(jobs) == workers * per_worker
+
+    # 已经打开的实例在未命中时重新读盘，能看到其他进程的记录
+    manifest = OutputManifest(output_dir)
+    assert manifest.lookup("w3-24") == os.path.join(output_dir, "w3_24.png")
+
+
+def test_manifest_instance_sees_later_writes_from_other_instance(tmp_path):
+    from src.manifest import OutputManifest
+    output_dir = str(tmp_path)
+    reader, writer = OutputManifest(output_dir), OutputManifest(output_dir)
+    assert reader.lookup("k") is None
+    _record_many(output_dir, "late", 1)
+    assert reader.lookup("late-0") is not None
+    reader.record("mine", os.path.join(output_dir, "late_0.png"))
+    writer.record("theirs", os.path.join(output_dir, "late_0.png"))
+    with open(os.path.join(output_dir, "manifest.json"), encoding="utf-8") as f:
+        assert {"late-0", "mine", "theirs"} <= set(json.load(f)["jobs"])